@@ -11,6 +11,7 @@ mf_module_path = os.path.abspath(os.path.join('../python'))
 if mf_module_path not in sys.path:
     sys.path.append(mf_module_path)
 import mf
+import mf_parallel
 import mf_random
 import synergy_tree
 from ontology import Ontology
@@ -468,8 +469,8 @@ def summary_textHpo_labHpo(batch_size, textHpo_occurrance_min,
     M2 = len(labHpoOfInterest)
 
     summary_rad_lab = mf.SummaryXY(textHpoOfInterest, labHpoOfInterest)
-    summary_rad_rad = mf.SummaryXY(textHpoOfInterest, textHpoOfInterest)
-    summary_lab_lab = mf.SummaryXY(labHpoOfInterest, labHpoOfInterest)
+    summary_rad_rad = mf.SymmetricSummaryXY(textHpoOfInterest)
+    summary_lab_lab = mf.SymmetricSummaryXY(labHpoOfInterest)
 
     ## find the start and end ROW_ID for patient*encounter
 
@@ -500,8 +501,8 @@ def summary_textHpo_labHpo(batch_size, textHpo_occurrance_min,
         labHpo_matrix = labHpo.PHEN_LAB_VALUE.values.astype(int).reshape(
             [actual_batch_size, M2], order='F')
         summary_rad_lab.add_batch(textHpo_matrix, labHpo_matrix)
-        summary_rad_rad.add_batch(textHpo_matrix, textHpo_matrix)
-        summary_lab_lab.add_batch(labHpo_matrix, labHpo_matrix)
+        summary_rad_rad.add_batch(textHpo_matrix)
+        summary_lab_lab.add_batch(labHpo_matrix)
         pbar.update(1)
 
     pbar.close()
@@ -737,6 +738,69 @@ def batch_query(start_index,
     return diagnosisVector, textHpoFlat, labHpoFlat
 
 
+def diagnosis_batches(ADM_ID_START, batch_N, batch_size,
+                      textHpoOfInterest, labHpoOfInterest,
+                      textHpo_occurrance_min, labHpo_occurrance_min,
+                      textHpo_threshold_min, textHpo_threshold_max,
+                      labHpo_threshold_min, labHpo_threshold_max, logger):
+    """
+    Query the database batch by batch of ROW_ID (see batch_query) and yield
+    the matrices of each batch.
+    :return: a generator of (textHpo matrix, labHpo matrix, diagnosis
+    vector) for every batch with encounters
+    """
+    TOTAL_BATCH = math.ceil(batch_N / batch_size)  # total number of batches
+    for i in np.arange(TOTAL_BATCH):
+        start_index = i * batch_size + ADM_ID_START
+        if i < TOTAL_BATCH - 1:
+            end_index = start_index + batch_size - 1
+        else:
+            end_index = batch_N
+
+        diagnosisFlat, textHpoFlat, labHpoFlat = \
+            batch_query(start_index,
+                        end_index,
+                        textHpo_occurrance_min,
+                        labHpo_occurrance_min,
+                        textHpo_threshold_min,
+                        textHpo_threshold_max,
+                        labHpo_threshold_min,
+                        labHpo_threshold_max)
+
+        batch_size_actual = len(diagnosisFlat)
+        textHpoOfInterest_size = len(textHpoOfInterest)
+        labHpoOfInterest_size = len(labHpoOfInterest)
+        assert (
+            len(textHpoFlat) == batch_size_actual * textHpoOfInterest_size)
+        assert (
+            len(labHpoFlat) == batch_size_actual * labHpoOfInterest_size)
+
+        if batch_size_actual > 0:
+            diagnosisVector = diagnosisFlat.DIAGNOSIS.values.astype(int)
+            # reformat the flat vector into N x M matrix, N is batch size,
+            # i.e. number of encounters, M is the length of HPO terms
+            textHpoMatrix = textHpoFlat.VALUE.values.astype(int).reshape(
+                [batch_size_actual, textHpoOfInterest_size], order='F')
+            labHpoMatrix = labHpoFlat.VALUE.values.astype(int).reshape(
+                [batch_size_actual, labHpoOfInterest_size], order='F')
+            # check the matrix formatting is correct
+            # disable the following 4 lines to speed things up
+            textHpoLabelsMatrix = textHpoFlat.MAP_TO.values.reshape(
+                [batch_size_actual, textHpoOfInterest_size], order='F')
+            labHpoLabelsMatrix = labHpoFlat.MAP_TO.values.reshape(
+                [batch_size_actual, labHpoOfInterest_size], order='F')
+            assert (textHpoLabelsMatrix[0, :] == textHpoOfInterest).all()
+            assert (labHpoLabelsMatrix[0, :] == labHpoOfInterest).all()
+            if i % 100 == 0:
+                logger.info(
+                    'new batch: start_index={}, end_index={}, '
+                    'batch_size= {}, textHpo_size = {}, labHpo_size = {}'.
+                        format(start_index, end_index, batch_size_actual,
+                               textHpoMatrix.shape[1],
+                               labHpoMatrix.shape[1]))
+            yield textHpoMatrix, labHpoMatrix, diagnosisVector
+
+
 def summarize_diagnosis_textHpo_labHpo(primary_diagnosis_only,
                                        textHpo_occurrance_min,
                                        labHpo_occurrance_min,
@@ -746,7 +810,9 @@ def summarize_diagnosis_textHpo_labHpo(primary_diagnosis_only,
                                        labHpo_threshold_min,
                                        labHpo_threshold_max,
                                        disease_of_interest,
-                                       logger):
+                                       logger,
+                                       compact=False,
+                                       workers=1):
     """
     Iterate database to get summary statistics. For each disease of
     interest, automatically determine a list of phenotypes derived from labs
@@ -769,6 +835,10 @@ def summarize_diagnosis_textHpo_labHpo(primary_diagnosis_only,
     :param disease_of_interest: either set to "calculated", or a list of
     ICD-9 codes (get all possible codes from temp table JAX_diagFrequencyRank)
     :param logger: logger for logging
+    :param compact: whether to keep summary statistics in the compact format
+    (see mf.SummaryXYz)
+    :param workers: number of processes that count batches; if more than
+    one, see mf_parallel.summarize_in_parallel
 
     :return: three dictionaries of summary statistics, of which the keys are
     diagnosis codes and the values are instances of the SummaryXYz class.
@@ -777,6 +847,8 @@ def summarize_diagnosis_textHpo_labHpo(primary_diagnosis_only,
     Secondary dictionary, all terms in X, Y are from textHpo;
     Third dictionary, all terms in X, Y are all from labHpo. Note that terms
     in X and Y are calculated separately for each diagnosis and may be different.
+    The second and third dictionaries hold SymmetricSummaryXYz instances,
+    which only keep one of the pairs (a, b) and (b, a).
     """
     logger.info('starting iterate_in_batch()')
     batch_size = 100
@@ -832,70 +904,40 @@ def summarize_diagnosis_textHpo_labHpo(primary_diagnosis_only,
             'SELECT MIN(ROW_ID) AS min, MAX(ROW_ID) AS max FROM JAX_mf_diag',
             mydb).iloc[0]
         batch_N = ADM_ID_END - ADM_ID_START + 1
-        TOTAL_BATCH = math.ceil(batch_N / batch_size)  # total number of batches
 
         summaries_diag_textHpo_labHpo[diagnosis] = mf.SummaryXYz(
-            textHpoOfInterest, labHpoOfInterest, diagnosis)
-        summaries_diag_textHpo_textHpo[diagnosis] = mf.SummaryXYz(
-            textHpoOfInterest, textHpoOfInterest, diagnosis)
-        summaries_diag_labHpo_labHpo[diagnosis] = mf.SummaryXYz(
-            labHpoOfInterest, labHpoOfInterest, diagnosis)
+            textHpoOfInterest, labHpoOfInterest, diagnosis, compact)
+        summaries_diag_textHpo_textHpo[diagnosis] = mf.SymmetricSummaryXYz(
+            textHpoOfInterest, diagnosis, compact)
+        summaries_diag_labHpo_labHpo[diagnosis] = mf.SymmetricSummaryXYz(
+            labHpoOfInterest, diagnosis, compact)
 
         logger.info('starting batch queries for {}'.format(diagnosis))
-        for i in np.arange(TOTAL_BATCH):
-            start_index = i * batch_size + ADM_ID_START
-            if i < TOTAL_BATCH - 1:
-                end_index = start_index + batch_size - 1
-            else:
-                end_index = batch_N
-
-            diagnosisFlat, textHpoFlat, labHpoFlat = \
-                batch_query(start_index,
-                            end_index,
-                            textHpo_occurrance_min,
-                            labHpo_occurrance_min,
-                            textHpo_threshold_min,
-                            textHpo_threshold_max,
-                            labHpo_threshold_min,
-                            labHpo_threshold_max)
-
-            batch_size_actual = len(diagnosisFlat)
-            textHpoOfInterest_size = len(textHpoOfInterest)
-            labHpoOfInterest_size = len(labHpoOfInterest)
-            assert (
-                len(textHpoFlat) == batch_size_actual * textHpoOfInterest_size)
-            assert (
-                len(labHpoFlat) == batch_size_actual * labHpoOfInterest_size)
-
-            if batch_size_actual > 0:
-                diagnosisVector = diagnosisFlat.DIAGNOSIS.values.astype(int)
-                # reformat the flat vector into N x M matrix, N is batch size,
-                # i.e. number of encounters, M is the length of HPO terms
-                textHpoMatrix = textHpoFlat.VALUE.values.astype(int).reshape(
-                    [batch_size_actual, textHpoOfInterest_size], order='F')
-                labHpoMatrix = labHpoFlat.VALUE.values.astype(int).reshape(
-                    [batch_size_actual, labHpoOfInterest_size], order='F')
-                # check the matrix formatting is correct
-                # disable the following 4 lines to speed things up
-                textHpoLabelsMatrix = textHpoFlat.MAP_TO.values.reshape(
-                    [batch_size_actual, textHpoOfInterest_size], order='F')
-                labHpoLabelsMatrix = labHpoFlat.MAP_TO.values.reshape(
-                    [batch_size_actual, labHpoOfInterest_size], order='F')
-                assert (textHpoLabelsMatrix[0, :] == textHpoOfInterest).all()
-                assert (labHpoLabelsMatrix[0, :] == labHpoOfInterest).all()
-                if i % 100 == 0:
-                    logger.info(
-                        'new batch: start_index={}, end_index={}, '
-                        'batch_size= {}, textHpo_size = {}, labHpo_size = {}'.
-                            format(start_index, end_index, batch_size_actual,
-                                   textHpoMatrix.shape[1],
-                                   labHpoMatrix.shape[1]))
-                summaries_diag_textHpo_labHpo[diagnosis].add_batch(
-                    textHpoMatrix, labHpoMatrix, diagnosisVector)
-                summaries_diag_textHpo_textHpo[diagnosis].add_batch(
-                    textHpoMatrix, textHpoMatrix, diagnosisVector)
-                summaries_diag_labHpo_labHpo[diagnosis].add_batch(
-                    labHpoMatrix, labHpoMatrix, diagnosisVector)
+        batches = diagnosis_batches(ADM_ID_START, batch_N, batch_size,
+                                    textHpoOfInterest, labHpoOfInterest,
+                                    textHpo_occurrance_min,
+                                    labHpo_occurrance_min,
+                                    textHpo_threshold_min,
+                                    textHpo_threshold_max,
+                                    labHpo_threshold_min,
+                                    labHpo_threshold_max, logger)
+        summaries = [summaries_diag_textHpo_labHpo[diagnosis],
+                     summaries_diag_textHpo_textHpo[diagnosis],
+                     summaries_diag_labHpo_labHpo[diagnosis]]
+        # arrays of a batch passed to each of the summaries
+        routes = [(0, 1, 2), (0, 2), (1, 2)]
+        if workers > 1:
+            # batches are read here, in the MySQL session that owns the
+            # temporary tables, and counted by worker processes
+            summaries = mf_parallel.summarize_in_parallel(
+                summaries, batches, routes, workers=workers)
+            summaries_diag_textHpo_labHpo[diagnosis], \
+            summaries_diag_textHpo_textHpo[diagnosis], \
+            summaries_diag_labHpo_labHpo[diagnosis] = summaries
+        else:
+            for batch in batches:
+                for summary, route in zip(summaries, routes):
+                    summary.add_batch(*[batch[i] for i in route])
 
         pbar.update(1)
 
@@ -931,6 +973,8 @@ def pipeline_calculate_summary_statistics_for_mf_regarding_diseases(test_mode):
     labHpo_threshold_min = analysis_parameters['labHpo_threshold_min']
     labHpo_threshold_max = analysis_parameters['labHpo_threshold_max']
     disease_of_interest = analysis_parameters['disease_of_interest']
+    compact = analysis_parameters.get('compact_summary_statistics', False)
+    workers = analysis_parameters.get('summary_workers', 1)
 
     summaries_diag_textHpo_labHpo, \
     summaries_diag_textHpo_textHpo, \
@@ -940,7 +984,7 @@ def pipeline_calculate_summary_statistics_for_mf_regarding_diseases(test_mode):
         diagnosis_threshold_min, textHpo_threshold_min,
         textHpo_threshold_max,
         labHpo_threshold_min, labHpo_threshold_max, disease_of_interest,
-        logger)
+        logger, compact, workers)
 
     # save to file
     diagnosis_dir = 'primary_only' if primary_diagnosis_only else \
@@ -1003,6 +1047,10 @@ def mf_dataframes_regarding_diagnosis(mutualInfoXYz, **p_values):
     X_labels, Y_labels = mutualInfoXYz.vars_labels.values()
     M1 = len(X_labels)
     M2 = len(Y_labels)
+    # index of X and Y for each pair; for symmetric summary statistics,
+    # only one of (a, b) and (b, a) is present
+    X_index, Y_index = mutualInfoXYz.pair_index()
+    n_pairs = len(X_index)
 
     mf_Xz = mutualInfoXYz.mutual_info_Xz()
     mf_Yz = mutualInfoXYz.mutual_info_Yz()
@@ -1026,10 +1074,10 @@ def mf_dataframes_regarding_diagnosis(mutualInfoXYz, **p_values):
 
     # mutual information between phenotype pairs and diagnosis
     df_mf_XY_z = pd.DataFrame()
-    df_mf_XY_z['X'] = np.repeat(X_labels, M2)
-    df_mf_XY_z['Y'] = np.tile(Y_labels, [M1])
-    df_mf_XY_z['mf_Xz'] = np.repeat(mf_Xz, M2)
-    df_mf_XY_z['mf_Yz'] = np.tile(mf_Yz, [M1])
+    df_mf_XY_z['X'] = X_labels[X_index]
+    df_mf_XY_z['Y'] = Y_labels[Y_index]
+    df_mf_XY_z['mf_Xz'] = mf_Xz[X_index]
+    df_mf_XY_z['mf_Yz'] = mf_Yz[Y_index]
     df_mf_XY_z['mf_XY_z'] = mf_XY_z.flat
     df_mf_XY_z[
         'synergy'] = mf_synergy.flat  # synergy = mf_XY_z - mf_Xz - mf_Yz
@@ -1045,23 +1093,22 @@ def mf_dataframes_regarding_diagnosis(mutualInfoXYz, **p_values):
         'mf_XY_omit_z']
 
     # add p values; otherwise, assign -1
-    df_mf_XY_z['p_mf_Xz'] = np.repeat(p_mf_Xz,
-                                      M2) if p_mf_Xz is not None else np.repeat(
-        -1, M1 * M2)
-    df_mf_XY_z['p_mf_Yz'] = np.tile(p_mf_Yz, [
-        M1]) if p_mf_Yz is not None else np.repeat(-1, M1 * M2)
+    df_mf_XY_z['p_mf_Xz'] = p_mf_Xz[
+        X_index] if p_mf_Xz is not None else np.repeat(-1, n_pairs)
+    df_mf_XY_z['p_mf_Yz'] = p_mf_Yz[
+        Y_index] if p_mf_Yz is not None else np.repeat(-1, n_pairs)
     df_mf_XY_z[
         'p_mf_XY_z'] = p_mf_XY_z.flat if p_mf_XY_z is not None else np.repeat(
-        -1, M1 * M2)
+        -1, n_pairs)
     df_mf_XY_z[
         'p_synergy'] = p_synergy.flat if p_synergy is not None else np.repeat(
-        -1, M1 * M2)
+        -1, n_pairs)
     df_mf_XY_z[
         'p_mf_XY_omit_z'] = p_mf_XY_omit_z.flat if p_mf_XY_omit_z is not None else np.repeat(
-        -1, M1 * M2)
+        -1, n_pairs)
     df_mf_XY_z[
         'p_mf_XY_given_z'] = p_mf_XY_given_z.flat if p_mf_XY_given_z is not None else np.repeat(
-        -1, M1 * M2)
+        -1, n_pairs)
 
     # add raw counts: 8 additional columns
     joint_dist_keys = ['+++', '++-', '+-+', '+--', '-++', '-+-', '--+',
@@ -1460,8 +1507,54 @@ def precompute_mf(variables):
     return mf, summary_counts
 
 
-def precompute_mf_dict(var_ids):
+def precompute_joint_counts(var_ids):
+    """
+    Count the joint patterns of all the variables and the medical outcome
+    with one query
+    :return: a vector of pattern counts (see
+    synergy_tree.joint_pattern_counts), and the query result
+    """
+    variables = sorted(var_ids)
+    summary_counts = pd.read_sql_query("""
+        SELECT {}, DIAGNOSIS, COUNT(*) AS N
+        FROM Jax_multivariant_synergy_table
+        GROUP BY {}, DIAGNOSIS
+    """.format(','.join(variables), ','.join(variables)), mydb)
+    counts = synergy_tree.joint_pattern_counts(
+        summary_counts[variables].values, summary_counts.DIAGNOSIS.values,
+        summary_counts.N.values)
+    return counts, summary_counts
+
+
+def precompute_mf_dict(var_ids, single_query=True, cache=None,
+                       diagnosis=None, cohort=None, var_dict=None):
+    """
+    Compute the mutual information between every subset of the variables and
+    the medical outcome
+    :param single_query: if true, the joint counts of all the variables are
+    queried once and the subsets are marginalized in memory; otherwise, each
+    subset is queried with precompute_mf
+    :param cache: a synergy_tree.MutualInfoCache. If all subsets are cached
+    for the diagnosis and cohort, nothing is queried; otherwise the computed
+    values are cached.
+    :param diagnosis, cohort: the keys of the cache
+    :param var_dict: the phenotypes of the variables, which key the cache
+    :return: a dictionary of the mutual information of subsets, and a
+    dictionary of the summary counts of the queries
+    """
     var_subsets = synergy_tree.subsets(var_ids, include_self=True)
+    if cache is not None:
+        cached = cache.source(diagnosis, cohort, names=var_dict)
+        if not cached.missing(var_subsets):
+            return {subset: cached(subset) for subset in var_subsets}, {}
+
+    if single_query:
+        counts, summary_counts = precompute_joint_counts(var_ids)
+        mf_dict = synergy_tree.mf_dict_from_counts(var_ids, counts)
+        if cache is not None:
+            cached.update(mf_dict)
+        return mf_dict, {tuple(sorted(var_ids)): summary_counts}
+
     mf_dict = {}
     summary_dict = {}
     pbar = tqdm_notebook(total=len(var_subsets))
@@ -1471,6 +1564,8 @@ def precompute_mf_dict(var_ids):
         summary_dict[var_subset] = summary_count
         pbar.update(1)
     pbar.close()
+    if cache is not None:
+        cached.update(mf_dict)
 
     return mf_dict, summary_dict
 
@@ -1728,7 +1823,18 @@ def pipeline_synergy_tree():
                                      textHpos=textHpoOfInterest, \
                                      labHpo_threshold_min=labHpo_occurrance_min, \
                                      textHpo_threshold_min=textHpo_occurrance_min)
-    mf_dict, summary_dict = precompute_mf_dict(var_dict.keys())
+    # the mutual information of subsets is cached between sessions, for the
+    # same diagnosis and selection of encounters
+    cache = synergy_tree.MutualInfoCache(
+        path=os.path.join(base_dir, 'synergy_tree_mf_cache.obj'))
+    cohort = synergy_tree.cohort_fingerprint(primary_diagnosis_only,
+                                             labHpo_occurrance_min,
+                                             textHpo_occurrance_min)
+    mf_dict, summary_dict = precompute_mf_dict(var_dict.keys(), cache=cache,
+                                               diagnosis=diagnosis,
+                                               cohort=cohort,
+                                               var_dict=var_dict)
+    cache.save()
 
     syntree_038 = synergy_tree.SynergyTree(var_dict.keys(), var_dict, mf_dict)
     syntree_038.synergy_tree().show()
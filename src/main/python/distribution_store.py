@@ -0,0 +1,235 @@
+import numpy as np
+import glob
+import json
+import os
+import os.path
+import logging.config
+
+
+log_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'log_config.conf')
+logging.config.fileConfig(log_file_path)
+logger = logging.getLogger(__name__)
+
+
+class DistributionStore:
+    """
+    On-disk store of the empirical distributions of one disease, in chunks
+    of simulations. Every metric of a chunk is a .npy file whose last
+    dimension is the simulation, so the distribution of a phenotype pair is
+    contiguous and can be read from a memory map without loading the rest.
+
+    Every job appends to its own manifest (manifest_<job_id>.json), which
+    lists the chunks that were completely written. A chunk file is written
+    before it is added to the manifest, and manifests are replaced
+    atomically, so an interrupted job leaves a consistent store and can
+    resume from the number of simulations in its manifest. Jobs of a PBS
+    array can write into the same store without locking.
+    """
+    def __init__(self, path, dtype=np.float32, compress=False):
+        """
+        :param path: directory of the store, created if it does not exist
+        :param dtype: data type of the stored values
+        :param compress: if true, chunks are written as compressed .npz
+        files. They are smaller, but have to be decompressed as a whole
+        and cannot be memory mapped.
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.compress = compress
+        os.makedirs(path, exist_ok=True)
+
+    def _manifest_path(self, job_id):
+        return os.path.join(self.path, 'manifest_{}.json'.format(job_id))
+
+    def manifest(self, job_id):
+        """
+        :return: the manifest of a job, a dictionary with a list of chunks;
+        every chunk has its index, number of simulations and the file of
+        each metric
+        """
+        path = self._manifest_path(job_id)
+        if not os.path.exists(path):
+            return {'job_id': job_id, 'chunks': []}
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest):
+        path = self._manifest_path(manifest['job_id'])
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(temporary, path)
+
+    def chunks(self):
+        """
+        :return: all chunks of all jobs, ordered by job and chunk index
+        """
+        manifests = []
+        for path in glob.glob(os.path.join(self.path, 'manifest_*.json')):
+            with open(path, 'r') as f:
+                manifests.append(json.load(f))
+        manifests.sort(key=lambda manifest: str(manifest['job_id']))
+        return [chunk for manifest in manifests
+                for chunk in manifest['chunks']]
+
+    def simulations(self, job_id=None):
+        """
+        :param job_id: count the simulations of one job only
+        :return: number of simulations in the store
+        """
+        if job_id is not None:
+            chunks = self.manifest(job_id)['chunks']
+        else:
+            chunks = self.chunks()
+        return sum(chunk['simulations'] for chunk in chunks)
+
+    def append(self, distributions, job_id=0):
+        """
+        Write a chunk of simulations and add it to the manifest of the job
+        :param distributions: a dictionary of metric name to array, with
+        the simulations in the last dimension, e.g. the return value of
+        mf_random.create_empirical_distribution
+        :param job_id: id of the job that simulated the chunk
+        """
+        manifest = self.manifest(job_id)
+        index = len(manifest['chunks'])
+        sizes = {value.shape[-1] for value in distributions.values()}
+        if len(sizes) != 1:
+            raise ValueError('metrics with different numbers of simulations')
+        files = dict()
+        for metric, value in distributions.items():
+            name = '{}_{}_{}'.format(metric, job_id, index)
+            value = np.ascontiguousarray(value, dtype=self.dtype)
+            if self.compress:
+                name += '.npz'
+                temporary = os.path.join(self.path, name + '.tmp.npz')
+                np.savez_compressed(temporary, value=value)
+            else:
+                name += '.npy'
+                temporary = os.path.join(self.path, name + '.tmp.npy')
+                np.save(temporary, value)
+            os.replace(temporary, os.path.join(self.path, name))
+            files[metric] = name
+        manifest['chunks'].append({'index': index,
+                                   'simulations': sizes.pop(),
+                                   'files': files})
+        self._write_manifest(manifest)
+        logger.debug('chunk {} of job {} written to {}'.format(index, job_id,
+                                                              self.path))
+
+    def _open(self, name):
+        path = os.path.join(self.path, name)
+        if name.endswith('.npz'):
+            with np.load(path) as chunk:
+                return chunk['value']
+        return np.load(path, mmap_mode='r')
+
+    def read(self, metric, index=Ellipsis):
+        """
+        Read the distribution of a metric, optionally of some phenotypes or
+        pairs only. Only the requested values of every chunk are read.
+        :param metric: name of the metric, e.g. 'synergy'
+        :param index: an index into the leading dimensions of the metric,
+        e.g. (i, j) for a pair, np.s_[0:100] for a block of rows, or
+        (rows, columns) arrays for a list of pairs
+        :return: an array of the indexed values with all simulations in the
+        last dimension
+        """
+        parts = [self._open(chunk['files'][metric])[index]
+                 for chunk in self.chunks()]
+        if not parts:
+            raise ValueError('no simulations in {}'.format(self.path))
+        return np.concatenate(parts, axis=-1)
+
+    def load(self):
+        """
+        :return: a dictionary of all distributions in memory, in the format
+        of mf_random.create_empirical_distribution
+        """
+        chunks = self.chunks()
+        if not chunks:
+            return dict()
+        return {metric: self.read(metric) for metric in chunks[0]['files']}
+
+    def p_values(self, observed, pairs=None, alternative='two.sided',
+                 memory_budget=2**30):
+        """
+        Estimate p values as mf_random.p_value_estimate, block by block of
+        phenotypes, so that only the distributions of one block are in
+        memory at a time.
+        :param observed: a dictionary of observed metrics, e.g.
+        MutualInfoXYz.metrics(); metrics that are not in the store are
+        skipped
+        :param pairs: row and column indices of the packed pairs of the
+        observed pairwise metrics (SymmetricSummaryXYz.pairs); the stored
+        distributions are always M1 x M2
+        :param alternative: alternative hypothesis
+        :param memory_budget: approximate number of bytes of distributions
+        read at a time
+        :return: a dictionary of p values, with the shapes of the observed
+        metrics
+        """
+        chunks = self.chunks()
+        if not chunks:
+            raise ValueError('no simulations in {}'.format(self.path))
+        P = self.simulations()
+        p = dict()
+        for metric, value in observed.items():
+            if metric not in chunks[0]['files']:
+                continue
+            value = np.asarray(value)
+            if pairs is not None and value.ndim == 1 and \
+                    metric not in ('mf_Xz', 'mf_Yz'):
+                index = pairs
+            else:
+                index = np.unravel_index(np.arange(value.size), value.shape)
+            # number of phenotypes (or pairs) per block
+            step = max(1, memory_budget // (P * 8))
+            result = np.zeros(value.size)
+            for start in range(0, value.size, step):
+                block = slice(start, min(start + step, value.size))
+                distribution = self.read(metric, tuple(i[block]
+                                                       for i in index))
+                result[block] = exceedances(value.ravel()[block],
+                                            distribution, alternative) / P
+            p[metric] = result.reshape(value.shape)
+        return p
+
+
+def exceedances(observed, distribution, alternative='two.sided'):
+    """
+    Number of simulations at least as extreme as the observed values, the
+    same counts as mf_random.p_value_estimate takes from sorted
+    distributions
+    :param observed: a vector of observed values
+    :param distribution: a matrix of their distributions, simulations in the
+    last dimension
+    :param alternative: alternative hypothesis
+    :return: a vector of counts
+    """
+    observed = observed[:, np.newaxis]
+    # thresholds are compared at the precision of the distribution, e.g.
+    # float32 in a store, so that simulated values equal to the observed
+    # ones are counted
+    if np.issubdtype(distribution.dtype, np.floating):
+        dtype = distribution.dtype
+    else:
+        dtype = np.float64
+    observed = observed.astype(dtype)
+    if alternative == 'two.sided':
+        center = np.mean(distribution, axis=-1, dtype=np.float64)[
+                 :, np.newaxis]
+        distance = np.abs(observed - center)
+        # values at the center are counted in both tails
+        return np.minimum(
+            np.sum(distribution <= (center - distance).astype(dtype),
+                   axis=-1) +
+            np.sum(distribution >= (center + distance).astype(dtype),
+                   axis=-1), distribution.shape[-1])
+    elif alternative == 'left':
+        return np.sum(distribution <= observed, axis=-1)
+    elif alternative == 'right':
+        return np.sum(distribution >= observed, axis=-1)
+    else:
+        raise ValueError
@@ -1,5 +1,9 @@
+import copy
+import functools
 import numpy as np
 import pandas as pd
+from scipy import sparse
+from scipy.linalg import blas
 import os
 import logging.config
 
@@ -8,6 +12,15 @@ log_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
 logging.config.fileConfig(log_file_path)
 logger = logging.getLogger(__name__)
 
+# integer type of the counts kept by compact summary statistics
+COMPACT_DTYPE = np.int32
+# pairwise metrics computed by MutualInfoXYz, keyed as in the empirical
+# distributions of mf_random
+PAIRWISE_METRICS = ('mf_XY_omit_z', 'mf_XY_z', 'mf_XY_given_z', 'synergy')
+# rough upper bound of the bytes of temporaries needed per pair when the
+# pairwise metrics are computed, used to size tiles
+BYTES_PER_PAIR = 1024
+
 
 class SummaryXY:
     """
@@ -27,12 +40,25 @@ class SummaryXY:
         self.Y_names = np.array(Y_names)
         self.M1 = len(self.X_names)
         self.M2 = len(self.Y_names)
-        self.m = np.zeros([self.M1, self.M2, 4])
+        self.m = np.zeros(self._pair_shape() + [4])
         self.N = 0
 
+    @property
+    def pairs(self):
+        """
+        Row and column indices of the stored pairs if they are packed,
+        or None if counts are kept for every (x, y) in X x Y
+        """
+        return None
+
+    def _pair_shape(self):
+        return [self.M1, self.M2]
+
     def add_batch(self, X, Y):
         """
-        Add a batch of observations for X and Y
+        Add a batch of observations for X and Y.
+        Dense arrays and scipy.sparse matrices are accepted; a long-format
+        event list can be converted with events_to_matrix.
         :param X: a N x M1 matrix of binary values for random variables in X
         :param Y: a N x M2 matrix of binary values for random variables in Y
         :return: updated summary statistics of X and Y
@@ -42,9 +68,40 @@ class SummaryXY:
         assert X.shape[0] == Y.shape[0]
         n = X.shape[0]
         self.N = self.N + n
-        d = np.repeat(1, n)
-        s = summarize_XYz(X, Y, d)[:, :, [0, 2, 4, 6]]
-        self.m = self.m + s
+        add_XY_counts(self.m, X, Y, workspace=self._workspace())
+
+    def merge(self, other):
+        """
+        Add the counts of another instance, e.g. one that summarized a
+        different set of observations, to this one.
+        :param other: an instance of the same class with the same variables
+        :return: self
+        """
+        _check_mergeable(self, other, ['X_names', 'Y_names'])
+        self.m += other.m
+        self.N = self.N + other.N
+        return self
+
+    def __add__(self, other):
+        return copy.deepcopy(self).merge(other)
+
+    def __radd__(self, other):
+        # so that sum() works on a list of summary statistics
+        if isinstance(other, int) and other == 0:
+            return copy.deepcopy(self)
+        return NotImplemented
+
+    def _workspace(self):
+        # scratch buffers are not part of the summary statistics; they are
+        # created on first use and dropped when the instance is pickled
+        if getattr(self, '_buffers', None) is None:
+            self._buffers = Workspace()
+        return self._buffers
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_buffers', None)
+        return state
 
 
 class SummaryXYz:
@@ -62,21 +119,32 @@ class SummaryXYz:
     M2 is the size of random variables in Y,
     N is the number of observations.
     """
-    def __init__(self, X_names, Y_names, z_name):
+    def __init__(self, X_names, Y_names, z_name, compact=False):
+        """
+        :param X_names: names of random variables in X
+        :param Y_names: names of random variables in Y
+        :param z_name: name of random variable z
+        :param compact: if true, only the +++ and ++- counts of each pair are
+        stored (as int32); the other six counts are implied by m1, case_N and
+        control_N. The full M1 x M2 x 8 table is reconstructed every time m2
+        is accessed.
+        """
         # name of random variables
         self.vars_labels = {'set1': np.array(X_names),
                             'set2': np.array(Y_names)}
         self.z_name = z_name
         self.M1 = len(X_names)
         self.M2 = len(Y_names)
+        self.compact = compact
+        count_dtype = COMPACT_DTYPE if compact else np.float64
         # set1: summary statistics for the joint distribution of xz, x is one
         #  of the random variables in X. dimension, M1 x 4
         # set2: summary statistics for the joint distribution of yz, y is one
         #  of the random variables in Y. dimension, M2 x 4
         # column: counts for joint distribution of xz or yz in the following
         # order: ++, +-, -+, --
-        self.m1 = {'set1': np.zeros([self.M1, 4]),
-                   'set2': np.zeros([self.M2, 4])}
+        self.m1 = {'set1': np.zeros([self.M1, 4], dtype=count_dtype),
+                   'set2': np.zeros([self.M2, 4], dtype=count_dtype)}
 
         # summary statistic for the joint distribution of xyz, x is one of
         # the random variables in X, y is one of the random variables in Y
@@ -84,24 +152,448 @@ class SummaryXYz:
         # dimension 2: number of random variables in Y
         # dimension 3: counts for joint distribution of xyz in the
         # following order: +++, ++-, +-+, +--, -++, -+-, --+, ---
-        self.m2 = np.zeros([self.M1, self.M2, 8])
+        # In compact mode, dimension 3 only holds +++ and ++-.
+        if compact:
+            self.m2_compact = np.zeros(self._pair_shape() + [2],
+                                       dtype=count_dtype)
+        else:
+            self._m2 = np.zeros(self._pair_shape() + [8])
 
         # count of 1s of z
         self.case_N = 0
         # count of 0s of z
         self.control_N = 0
+        # incremented whenever the counts change, so that results computed
+        # from them can be invalidated
+        self.version = 0
+
+    @property
+    def pairs(self):
+        return None
+
+    def _pair_shape(self):
+        return [self.M1, self.M2]
+
+    @property
+    def m2(self):
+        """
+        M1 x M2 x 8 counts of xyz. For compact instances, this is a new
+        array reconstructed from the stored counts on every access.
+        """
+        if self.compact:
+            return expand_XYz_counts(self.m2_compact, self.m1['set1'],
+                                     self.m1['set2'], self.case_N,
+                                     self.control_N, self.pairs)
+        return self._m2
+
+    @m2.setter
+    def m2(self, value):
+        if self.compact:
+            self.m2_compact[...] = value[..., 0:2]
+        else:
+            self._m2 = value
+        self.version = getattr(self, 'version', 0) + 1
 
     def add_batch(self, P1, P2, d):
         """
         Add a batch of samples for the current disease. Calling this
         function automatically update summary statistics.
+        Dense arrays and scipy.sparse matrices are accepted; a long-format
+        event list can be converted with events_to_matrix.
         :param P: a batch_size X M matrix of phenotype profiles
         :param d: a batch_size vector of binary values representing
         the presence (1) or absence (0) of the disease
         :return: None
         """
-        self.m1, self.m2, self.case_N, self.control_N = summarize(
-            P1, P2, d, current=[self.m1, self.m2, self.case_N, self.control_N])
+        counts = self.m2_compact if self.compact else self._m2
+        self.m1, _, self.case_N, self.control_N = summarize(
+            P1, P2, d, current=[self.m1, counts, self.case_N, self.control_N],
+            workspace=self._workspace())
+        self._keep_count_dtype()
+        self.version = getattr(self, 'version', 0) + 1
+
+    def _keep_count_dtype(self):
+        # adding float counts, e.g. those of summarize_Xz or of a full
+        # instance, would otherwise upcast the int32 counts of compact mode
+        if self.compact:
+            self.m1 = {key: value.astype(COMPACT_DTYPE, copy=False)
+                       for key, value in self.m1.items()}
+
+    def merge(self, other):
+        """
+        Add the counts of another instance, e.g. one that summarized a
+        different set of observations, to this one. Compact and full
+        instances can be merged into each other.
+        :param other: an instance of the same class with the same variables
+        and the same z
+        :return: self
+        """
+        _check_mergeable(self, other, ['vars_labels', 'z_name'])
+        self.m1 = {key: self.m1[key] + other.m1[key] for key in self.m1}
+        self._keep_count_dtype()
+        if self.compact:
+            other_counts = other.m2_compact if other.compact else \
+                other.m2[..., 0:2]
+            np.add(self.m2_compact, other_counts, out=self.m2_compact,
+                   casting='unsafe')
+        else:
+            self._m2 += other.m2
+        self.case_N = self.case_N + other.case_N
+        self.control_N = self.control_N + other.control_N
+        self.version = getattr(self, 'version', 0) + 1
+        return self
+
+    def __add__(self, other):
+        return copy.deepcopy(self).merge(other)
+
+    def __radd__(self, other):
+        # so that sum() works on a list of summary statistics
+        if isinstance(other, int) and other == 0:
+            return copy.deepcopy(self)
+        return NotImplemented
+
+    def _workspace(self):
+        if getattr(self, '_buffers', None) is None:
+            self._buffers = Workspace()
+        return self._buffers
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_buffers', None)
+        return state
+
+    def __setstate__(self, state):
+        # instances pickled before compact mode existed store m2 directly
+        if 'm2' in state:
+            state['_m2'] = state.pop('m2')
+        state.setdefault('compact', False)
+        state.setdefault('version', 0)
+        self.__dict__.update(state)
+
+
+class SymmetricSummaryXY(SummaryXY):
+    """
+    Summary statistics of xy when X and Y are the same set of random
+    variables. The counts of (x_i, x_j) and (x_j, x_i) carry the same
+    information, so only pairs with i <= j are counted and stored, packed
+    in the order of np.triu_indices. m has dimension M(M+1)/2 x 4. Variables
+    are kept sorted by name, so the first variable of a packed pair never
+    sorts after the second one. Call full() for an equivalent SummaryXY.
+    """
+    def __init__(self, X_names):
+        self.order = np.argsort(X_names, kind='stable')
+        X_names = np.array(X_names)[self.order]
+        SummaryXY.__init__(self, X_names, X_names)
+
+    @property
+    def pairs(self):
+        if getattr(self, '_pairs', None) is None:
+            self._pairs = np.triu_indices(self.M1)
+        return self._pairs
+
+    def _pair_shape(self):
+        return [self.M1 * (self.M1 + 1) // 2]
+
+    def add_batch(self, X):
+        """
+        Add a batch of observations for X
+        :param X: a N x M matrix of binary values for random variables in X,
+        columns in the order of the names given to the constructor
+        :return: updated summary statistics
+        """
+        assert X.shape[1] == self.M1
+        X = _select_columns(X, self.order)
+        self.N = self.N + X.shape[0]
+        add_symmetric_XY_counts(self.m, X, self.pairs,
+                                workspace=self._workspace())
+
+    def full(self):
+        """
+        Expand the packed counts to an equivalent SummaryXY
+        :return: a SummaryXY instance with counts for all M x M pairs
+        """
+        summary = SummaryXY(self.X_names, self.Y_names)
+        summary.m = expand_symmetric(self.m, self.pairs, self.M1,
+                                     cells=[0, 2, 1, 3])
+        summary.N = self.N
+        return summary
+
+    def __getstate__(self):
+        state = SummaryXY.__getstate__(self)
+        state.pop('_pairs', None)
+        return state
+
+
+class SymmetricSummaryXYz(SummaryXYz):
+    """
+    Summary statistics of xyz when X and Y are the same set of random
+    variables. Only pairs (x_i, x_j) with i <= j are counted and stored,
+    packed in the order of np.triu_indices, so m2 (or m2_compact) has
+    dimension M(M+1)/2 x 8 (or x 2). As in SymmetricSummaryXY, variables are
+    kept sorted by name. Call full() for an equivalent SummaryXYz.
+    """
+    def __init__(self, X_names, z_name, compact=False):
+        self.order = np.argsort(X_names, kind='stable')
+        X_names = np.array(X_names)[self.order]
+        SummaryXYz.__init__(self, X_names, X_names, z_name, compact)
+
+    @property
+    def pairs(self):
+        if getattr(self, '_pairs', None) is None:
+            self._pairs = np.triu_indices(self.M1)
+        return self._pairs
+
+    def _pair_shape(self):
+        return [self.M1 * (self.M1 + 1) // 2]
+
+    def add_batch(self, P, d):
+        """
+        Add a batch of samples for the current disease.
+        :param P: a batch_size X M matrix of phenotype profiles, columns in
+        the order of the names given to the constructor
+        :param d: a batch_size vector of binary values representing
+        the presence (1) or absence (0) of the disease
+        :return: None
+        """
+        assert P.shape[1] == self.M1
+        P = _select_columns(P, self.order)
+        d_positive, d_negative = summarize_z(d)
+        self.case_N = self.case_N + d_positive
+        self.control_N = self.control_N + d_negative
+        pd = summarize_Xz(P, d)
+        self.m1['set1'] = self.m1['set1'] + pd
+        self.m1['set2'] = self.m1['set2'] + pd
+        self._keep_count_dtype()
+        counts = self.m2_compact if self.compact else self._m2
+        add_symmetric_XYz_counts(counts, P, d, self.pairs,
+                                 workspace=self._workspace())
+        self.version = getattr(self, 'version', 0) + 1
+
+    def full(self):
+        """
+        Expand the packed counts to an equivalent SummaryXYz
+        :return: a SummaryXYz instance with counts for all M x M pairs
+        """
+        summary = SummaryXYz(self.vars_labels['set1'],
+                             self.vars_labels['set2'], self.z_name)
+        summary.m1 = {'set1': self.m1['set1'].astype(np.float64),
+                      'set2': self.m1['set2'].astype(np.float64)}
+        summary.m2 = expand_symmetric(self.m2, self.pairs, self.M1,
+                                      cells=[0, 1, 4, 5, 2, 3, 6, 7])
+        summary.case_N = self.case_N
+        summary.control_N = self.control_N
+        return summary
+
+    def __getstate__(self):
+        state = SummaryXYz.__getstate__(self)
+        state.pop('_pairs', None)
+        return state
+
+
+class MultiOutcomeSummaryXYz:
+    """
+    Summary statistics of xyz for K outcomes z at once, e.g. K diagnoses.
+    It is updated by calling the add_batch method with a N x M1 matrix for
+    X, a N x M2 matrix for Y and a N x K matrix for the outcomes, so one
+    scan over the observations counts all outcomes.
+    The phenotype pair work is shared: X^T Y over all observations is
+    counted once per batch, and for every outcome only the "both present"
+    counts among its cases, X^T diag(z_k) Y, are counted; the counts among
+    controls are the difference of the two. Counting one outcome then costs
+    in proportion to its number of cases instead of N.
+    Counts are stored as int32. Memory is dominated by the K x M1 x M2 case
+    counts. Call view() to get a compact SummaryXYz for one outcome.
+    """
+    def __init__(self, X_names, Y_names, z_names):
+        """
+        :param X_names: names of random variables in X
+        :param Y_names: names of random variables in Y
+        :param z_names: names of the K outcomes
+        """
+        self.vars_labels = {'set1': np.array(X_names),
+                            'set2': np.array(Y_names)}
+        self.z_names = np.array(z_names)
+        self.M1 = len(X_names)
+        self.M2 = len(Y_names)
+        self.K = len(z_names)
+        self.N = 0
+        # count of 1s of x (or y), regardless of z
+        self.X_N = np.zeros(self.M1, dtype=COMPACT_DTYPE)
+        self.Y_N = np.zeros(self.M2, dtype=COMPACT_DTYPE)
+        # count of 1s of x (or y) among the cases of each outcome, K x M1
+        # (or K x M2)
+        self.Xz = np.zeros([self.K, self.M1], dtype=COMPACT_DTYPE)
+        self.Yz = np.zeros([self.K, self.M2], dtype=COMPACT_DTYPE)
+        # count of 1s of each outcome
+        self.case_N = np.zeros(self.K, dtype=COMPACT_DTYPE)
+        # count of x=1, y=1 regardless of z, and among the cases of each
+        # outcome (leading dimension K)
+        self.XY = np.zeros(self._pair_shape(), dtype=COMPACT_DTYPE)
+        self.XYz = np.zeros([self.K] + self._pair_shape(),
+                            dtype=COMPACT_DTYPE)
+
+    @property
+    def pairs(self):
+        return None
+
+    def _pair_shape(self):
+        return [self.M1, self.M2]
+
+    def _count_both(self, X, Y, workspace):
+        return _cross_counts(X, Y, workspace)
+
+    def add_batch(self, P1, P2, D):
+        """
+        Add a batch of samples for all outcomes.
+        :param P1: a batch_size x M1 matrix of binary values for X
+        :param P2: a batch_size x M2 matrix of binary values for Y
+        :param D: a batch_size x K matrix of binary values representing the
+        presence (1) or absence (0) of each outcome
+        :return: None
+        """
+        N, M1 = P1.shape
+        assert P2.shape[0] == N and M1 == self.M1 and P2.shape[1] == self.M2
+        D = np.asarray(D).reshape([N, self.K]) != 0
+        workspace = self._workspace()
+        rows = np.ones(N, dtype=bool)
+        X = _select_rows(P1, rows, 'X', workspace)
+        Y = _select_rows(P2, rows, 'Y', workspace)
+        D_float = D.astype(np.float64)
+
+        self.N = self.N + N
+        self.case_N += np.sum(D, axis=0, dtype=COMPACT_DTYPE)
+        self.X_N += _column_sums(X).astype(COMPACT_DTYPE)
+        self.Y_N += _column_sums(Y).astype(COMPACT_DTYPE)
+        np.add(self.Xz, (X.T @ D_float).T, out=self.Xz, casting='unsafe')
+        np.add(self.Yz, (Y.T @ D_float).T, out=self.Yz, casting='unsafe')
+        np.add(self.XY, self._count_both(X, Y, workspace),
+               out=self.XY, casting='unsafe')
+        for k in np.flatnonzero(np.any(D, axis=0)):
+            X_case = _select_rows(P1, D[:, k], 'X_case', workspace)
+            Y_case = _select_rows(P2, D[:, k], 'Y_case', workspace)
+            np.add(self.XYz[k], self._count_both(X_case, Y_case, workspace),
+                   out=self.XYz[k], casting='unsafe')
+
+    def merge(self, other):
+        """
+        Add the counts of another instance to this one.
+        :param other: an instance of the same class with the same variables
+        and outcomes
+        :return: self
+        """
+        _check_mergeable(self, other, ['vars_labels', 'z_names'])
+        for name in ['X_N', 'Y_N', 'Xz', 'Yz', 'case_N', 'XY', 'XYz']:
+            getattr(self, name)[...] += getattr(other, name)
+        self.N = self.N + other.N
+        return self
+
+    def __add__(self, other):
+        return copy.deepcopy(self).merge(other)
+
+    def __radd__(self, other):
+        if isinstance(other, int) and other == 0:
+            return copy.deepcopy(self)
+        return NotImplemented
+
+    def _index(self, z):
+        if isinstance(z, (int, np.integer)):
+            return int(z)
+        matches = np.flatnonzero(self.z_names == z)
+        if len(matches) == 0:
+            raise KeyError(z)
+        return int(matches[0])
+
+    def _empty_view(self, z_name):
+        return SummaryXYz(self.vars_labels['set1'], self.vars_labels['set2'],
+                          z_name, compact=True)
+
+    def view(self, z):
+        """
+        Summary statistics of one outcome
+        :param z: name or index of the outcome
+        :return: a compact SummaryXYz instance with the counts of that outcome
+        """
+        k = self._index(z)
+        summary = self._empty_view(self.z_names[k])
+        summary.case_N = int(self.case_N[k])
+        summary.control_N = self.N - summary.case_N
+        for key, var_N, var_z in [('set1', self.X_N, self.Xz[k]),
+                                  ('set2', self.Y_N, self.Yz[k])]:
+            summary.m1[key] = np.stack(
+                [var_z,
+                 var_N - var_z,
+                 summary.case_N - var_z,
+                 summary.control_N - var_N + var_z],
+                axis=-1).astype(COMPACT_DTYPE)
+        summary.m2_compact[..., 0] = self.XYz[k]
+        summary.m2_compact[..., 1] = self.XY - self.XYz[k]
+        return summary
+
+    def views(self):
+        """
+        Summary statistics of every outcome
+        :return: a dictionary of outcome name to compact SummaryXYz
+        """
+        return {z_name: self.view(k) for k, z_name in enumerate(self.z_names)}
+
+    def _workspace(self):
+        if getattr(self, '_buffers', None) is None:
+            self._buffers = Workspace()
+        return self._buffers
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_buffers', None)
+        return state
+
+
+class SymmetricMultiOutcomeSummaryXYz(MultiOutcomeSummaryXYz):
+    """
+    MultiOutcomeSummaryXYz when X and Y are the same set of random
+    variables. As in SymmetricSummaryXYz, only pairs with i <= j are counted
+    and variables are kept sorted by name; view() returns a compact
+    SymmetricSummaryXYz.
+    """
+    def __init__(self, X_names, z_names):
+        self.order = np.argsort(X_names, kind='stable')
+        X_names = np.array(X_names)[self.order]
+        MultiOutcomeSummaryXYz.__init__(self, X_names, X_names, z_names)
+
+    @property
+    def pairs(self):
+        if getattr(self, '_pairs', None) is None:
+            self._pairs = np.triu_indices(self.M1)
+        return self._pairs
+
+    def _pair_shape(self):
+        return [self.M1 * (self.M1 + 1) // 2]
+
+    def _count_both(self, X, Y, workspace):
+        rows, cols = self.pairs
+        return _gram_upper(X, workspace)[rows, cols]
+
+    def add_batch(self, P, D):
+        """
+        Add a batch of samples for all outcomes.
+        :param P: a batch_size x M matrix of phenotype profiles, columns in
+        the order of the names given to the constructor
+        :param D: a batch_size x K matrix of binary values representing the
+        presence (1) or absence (0) of each outcome
+        :return: None
+        """
+        assert P.shape[1] == self.M1
+        P = _select_columns(P, self.order)
+        MultiOutcomeSummaryXYz.add_batch(self, P, P, D)
+
+    def _empty_view(self, z_name):
+        # names are already sorted, so the view keeps the same order
+        return SymmetricSummaryXYz(self.vars_labels['set1'], z_name,
+                                   compact=True)
+
+    def __getstate__(self):
+        state = MultiOutcomeSummaryXYz.__getstate__(self)
+        state.pop('_pairs', None)
+        return state
 
 
 class MutualInfoXY:
@@ -118,36 +610,43 @@ class MutualInfoXY:
         self.M2 = len(self.Y_names)
         self.m = summaryXY.m
         self.N = summaryXY.N
+        # packed pairs of a symmetric summary, None otherwise
+        self.pairs = getattr(summaryXY, 'pairs', None)
 
     def mf(self):
         """
         Compute and return the pairwise mutual information between variable
         pairs in X and Y
-        :return: a M1 X M2 matrix of pairwise mutual information
-        """
-        p = self.m / self.N
-        p_x = np.repeat(np.sum(self.m.reshape(self.M1, self.M2, 2, 2),
-                               axis=-1), 2, axis=-1) / self.N
-        p_y = np.tile(np.sum(self.m.reshape(self.M1, self.M2, 2, 2,
-                              order='F'), axis=-1), [2]) / self.N
-        temp = np.zeros_like(p)
-        non_zero_idx = np.logical_not(np.array([p == 0]).squeeze())
-        temp[non_zero_idx] = p[non_zero_idx] * np.log2(p[non_zero_idx]/(p_x[non_zero_idx] * p_y[non_zero_idx]))
-        mutual_info = np.sum(temp, axis=-1)
-        return mutual_info
+        :return: a M1 X M2 matrix of pairwise mutual information, or a vector
+        over the packed pairs for a symmetric summary
+        """
+        return mf_XY(self.m, self.N)
+
+    def pair_index(self):
+        """
+        Indices of x and y for every value returned by mf(), flattened
+        :return: two vectors, the index of x and the index of y
+        """
+        return pair_index(self.M1, self.M2, self.pairs)
 
     def mf_labeled(self):
         """
         Return a labeled dataframe instead of matrix
         :return: a dataframe
         """
-        p1 = np.repeat(self.X_names, self.M2)
-        p2 = np.tile(self.Y_names, [self.M1])
+        rows, cols = self.pair_index()
+        p1 = self.X_names[rows]
+        p2 = self.Y_names[cols]
         mf_value = self.mf().ravel()
         df = pd.DataFrame(data={'P1': p1, 'P2': p2, 'mf': mf_value})
         return df
 
     def entropies(self):
+        if self.pairs is not None:
+            # the packed pair (x, x) holds the counts of x alone
+            diagonal = self.m[self.pairs[0] == self.pairs[1]]
+            counts = np.sum(diagonal.reshape([self.M1, 2, 2]), axis=-1)
+            return {'X': entropy(counts), 'Y': entropy(counts)}
         X_alone = self.m[:, 0, :].squeeze()
         assert X_alone.shape[0] == self.M1
         assert X_alone.shape[1] == 4
@@ -209,41 +708,265 @@ class MutualInfoXYz:
         self.z_name = summaryXYz.z_name
         self.M1 = len(summaryXYz.vars_labels['set1'])
         self.M2 = len(summaryXYz.vars_labels['set2'])
-        # summary statistic for phenotype*diagnosis joint distribution
-        # rows: phenotypes
-        # column: ++, +-, -+, -- of phenotype*diagnosis joint distribution
-        self.m1 = summaryXYz.m1
-        # summary statistic for phenotype_pair*diagnosis joint distribution
-        # dimension 1: phenotype 1
-        # dimension 2: phenotype 2
-        # dimension 3: +++, ++-, +-+, +--, -++, -+-, --+, --- of phenotype1
-        # * phenotype 2 * diagnosis joint distribution
-        self.m2 = summaryXYz.m2
-        # count of positive diagnoses
-        self.case_N = summaryXYz.case_N
-        # count of negative diagnoses
-        self.control_N = summaryXYz.control_N
+        # counts are read from the summary statistics when needed, so that
+        # compact counts are only expanded tile by tile by tiled_metrics()
+        self.summary = summaryXYz
+        # results of metrics() and the version of the summary they were
+        # computed from
+        self._metrics = None
+        self._metrics_version = None
         # name of phenotypes
         self.vars_labels = summaryXYz.vars_labels
+        # packed pairs of a symmetric summary, None otherwise. If not None,
+        # pairwise results are vectors over the packed pairs instead of
+        # M1 x M2 matrices; use expand() to get the matrices.
+        self.pairs = getattr(summaryXYz, 'pairs', None)
         self.S = np.empty(1)
 
+    @property
+    def m1(self):
+        """
+        summary statistic for phenotype*diagnosis joint distribution
+        rows: phenotypes
+        column: ++, +-, -+, -- of phenotype*diagnosis joint distribution
+        """
+        return self.summary.m1
+
+    @property
+    def m2(self):
+        """
+        summary statistic for phenotype_pair*diagnosis joint distribution
+        dimension 1: phenotype 1
+        dimension 2: phenotype 2
+        dimension 3: +++, ++-, +-+, +--, -++, -+-, --+, --- of phenotype1
+        * phenotype 2 * diagnosis joint distribution
+        """
+        return self.summary.m2
+
+    @property
+    def case_N(self):
+        # count of positive diagnoses
+        return self.summary.case_N
+
+    @property
+    def control_N(self):
+        # count of negative diagnoses
+        return self.summary.control_N
+
+    def pair_index(self):
+        """
+        Indices of x and y for every pairwise value, flattened
+        :return: two vectors, the index of x and the index of y
+        """
+        return pair_index(self.M1, self.M2, self.pairs)
+
+    def tiles(self, memory_budget=2**30):
+        """
+        Split the pairwise results into blocks whose computation needs
+        about memory_budget bytes of temporaries.
+        :param memory_budget: bytes available for one block
+        :return: a generator of indices into the pairwise results, (row
+        slice, column slice) for M1 x M2 results or (slice,) for packed
+        pairs
+        """
+        pairs_per_tile = max(1, memory_budget // BYTES_PER_PAIR)
+        if self.pairs is not None:
+            K = len(self.pairs[0])
+            for start in range(0, K, pairs_per_tile):
+                yield (slice(start, min(start + pairs_per_tile, K)),)
+            return
+        col_block = min(self.M2, pairs_per_tile)
+        row_block = max(1, pairs_per_tile // col_block)
+        for row_start in range(0, self.M1, row_block):
+            for col_start in range(0, self.M2, col_block):
+                yield (slice(row_start, min(row_start + row_block, self.M1)),
+                       slice(col_start, min(col_start + col_block, self.M2)))
+
+    def m2_tile(self, index):
+        """
+        Counts of xyz for one block of pairs. Compact summary statistics are
+        only expanded for the pairs in the block.
+        :param index: an index returned by tiles()
+        :return: a array of counts, the last dimension +++, ++-, +-+, +--,
+        -++, -+-, --+, ---
+        """
+        if not getattr(self.summary, 'compact', False):
+            return self.summary.m2[index]
+        m1 = self.summary.m1
+        if self.pairs is None:
+            rows, cols = index
+            return expand_XYz_counts(self.summary.m2_compact[rows, cols],
+                                     m1['set1'][rows], m1['set2'][cols],
+                                     self.case_N, self.control_N)
+        pairs = (self.pairs[0][index[0]], self.pairs[1][index[0]])
+        return expand_XYz_counts(self.summary.m2_compact[index], m1['set1'],
+                                 m1['set2'], self.case_N, self.control_N,
+                                 pairs)
+
+    def tiled_metrics(self, metrics=PAIRWISE_METRICS, memory_budget=2**30,
+                      out=None):
+        """
+        Compute pairwise metrics block by block, so that the temporaries
+        never exceed memory_budget bytes and the full M1 x M2 x 8 counts of
+        compact summary statistics are never materialized.
+        :param metrics: names of metrics to compute, any of PAIRWISE_METRICS
+        :param memory_budget: bytes available for one block
+        :param out: where to write the results: None to allocate arrays in
+        memory, a directory to write each metric to <metric>.npy through a
+        memory-mapped array, or a dictionary of preallocated arrays (e.g.
+        np.memmap) for each metric
+        :return: a dictionary of metric name to results, M1 x M2 matrices or
+        vectors over the packed pairs
+        """
+        unknown = set(metrics) - set(PAIRWISE_METRICS)
+        if unknown:
+            raise ValueError('unknown metrics: {}'.format(sorted(unknown)))
+        shape = ((len(self.pairs[0]),) if self.pairs is not None
+                 else (self.M1, self.M2))
+        if out is None:
+            out = {metric: np.empty(shape) for metric in metrics}
+        elif isinstance(out, str):
+            out = {metric: np.lib.format.open_memmap(
+                       os.path.join(out, metric + '.npy'), mode='w+',
+                       dtype=np.float64, shape=shape)
+                   for metric in metrics}
+        for index, values in self._metric_tiles(memory_budget):
+            for metric in metrics:
+                out[metric][index] = values[metric]
+        for values in out.values():
+            if isinstance(values, np.memmap):
+                values.flush()
+        return out
+
+    def _metric_tiles(self, memory_budget):
+        """
+        Compute the pairwise metrics block by block
+        :return: a generator of (index, dictionary of metric name to values
+        for the pairs in the block)
+        """
+        summary_z = np.array([self.case_N, self.control_N])
+        Ia = mf_Xz_from_entropies(self.m1['set1'], summary_z)
+        Ib = mf_Xz_from_entropies(self.m1['set2'], summary_z)
+        for index in self.tiles(memory_budget):
+            values = pairwise_metrics(self.m2_tile(index), summary_z)
+            II = values['mf_XY_z']
+            if self.pairs is None:
+                rows, cols = index
+                values['synergy'] = synergy(Ia[rows], Ib[cols], II)
+            else:
+                values['synergy'] = (II - Ia[self.pairs[0][index[0]]] -
+                                     Ib[self.pairs[1][index[0]]])
+            yield index, values
+
+    def top_pairs(self, metric='synergy', k=None, threshold=None,
+                  largest=True, p_values=None, memory_budget=2**30):
+        """
+        Select the pairs with the highest (or lowest) values of a metric
+        without building a dataframe of all pairs. Values are selected block
+        by block with a partial sort, so only the selected pairs are
+        labeled and sorted. Memoized results of metrics() are used if they
+        are up to date; otherwise the metric is computed tile by tile.
+        :param metric: one of PAIRWISE_METRICS
+        :param k: number of pairs to return; None for all pairs beyond the
+        threshold
+        :param threshold: if not None, only pairs with values >= threshold
+        (<= threshold if largest is False) are returned
+        :param largest: select the largest values if true, the smallest
+        otherwise
+        :param p_values: optional p values of the metric, in the same shape
+        as the metric, added to the result as column p
+        :param memory_budget: bytes available for one block
+        :return: a dataframe with columns P1, P2, the metric (and p),
+        sorted by the metric
+        """
+        if metric not in PAIRWISE_METRICS:
+            raise ValueError('unknown metric: {}'.format(metric))
+        if k is None and threshold is None:
+            raise ValueError('either k or threshold is required')
+        sign = 1 if largest else -1
+        if self._metrics is not None and \
+                self._metrics_version == getattr(self.summary, 'version', 0):
+            whole = tuple(slice(0, n) for n in self._metrics[metric].shape)
+            tiles = [(whole, self._metrics)]
+        else:
+            tiles = self._metric_tiles(memory_budget)
+        selected = np.empty(0, dtype=np.int64)
+        scores = np.empty(0)
+        for index, values in tiles:
+            if self.pairs is None:
+                rows, cols = index
+                flat = (np.arange(rows.start, rows.stop)[:, np.newaxis] *
+                        self.M2 + np.arange(cols.start, cols.stop)).ravel()
+            else:
+                flat = np.arange(index[0].start, index[0].stop)
+            tile_scores = sign * values[metric].ravel()
+            keep = np.isfinite(tile_scores)
+            if threshold is not None:
+                keep &= tile_scores >= sign * threshold
+            selected = np.concatenate([selected, flat[keep]])
+            scores = np.concatenate([scores, tile_scores[keep]])
+            if k is not None and len(scores) > k:
+                best = np.argpartition(-scores, k - 1)[:k]
+                selected = selected[best]
+                scores = scores[best]
+        order = np.argsort(-scores, kind='stable')
+        selected = selected[order]
+        if self.pairs is None:
+            rows, cols = np.unravel_index(selected, (self.M1, self.M2))
+        else:
+            rows, cols = self.pairs[0][selected], self.pairs[1][selected]
+        df = pd.DataFrame(data={'P1': self.vars_labels['set1'][rows],
+                                'P2': self.vars_labels['set2'][cols],
+                                metric: sign * scores[order]})
+        if p_values is not None:
+            df['p'] = np.asarray(p_values).ravel()[selected]
+        return df
+
+    def metrics(self):
+        """
+        Compute all metrics in one pass over the counts. The results are
+        memoized and computed again only after the summary statistics
+        change (see SummaryXYz.version). The returned arrays are shared by
+        later calls, so do not modify them in place.
+        :return: a dictionary with mf_Xz, mf_Yz (vectors) and the
+        PAIRWISE_METRICS (M1 x M2 matrices or vectors over packed pairs)
+        """
+        version = getattr(self.summary, 'version', 0)
+        if self._metrics is None or self._metrics_version != version:
+            summary_z = np.array([self.case_N, self.control_N])
+            metrics = self.tiled_metrics()
+            metrics['mf_Xz'] = mf_Xz_from_entropies(self.m1['set1'],
+                                                    summary_z)
+            metrics['mf_Yz'] = mf_Xz_from_entropies(self.m1['set2'],
+                                                    summary_z)
+            self._metrics = metrics
+            self._metrics_version = version
+        return self._metrics
+
+    def expand(self, values):
+        """
+        Expand pairwise values of a symmetric summary to a M x M matrix. All
+        pairwise metrics are symmetric in x and y.
+        :param values: a vector over the packed pairs
+        :return: a M x M matrix
+        """
+        if self.pairs is None:
+            return values
+        return expand_symmetric(values, self.pairs, self.M1)
+
     def mutual_info_Xz(self):
         """
         Return the mutual information between x and z, x is a random variable in X
         :return: a size M1 vector for the mutual information between each x-z
         """
-        Ia, _, _ = mf_Xz(self.m1['set1'], np.array([self.case_N,
-                                                    self.control_N]))
-        return Ia
+        return self.metrics()['mf_Xz']
 
     def mutual_info_Yz(self):
         """
         Return the mutual information between y and z, y is a random variable in Y
         :return: a size M1 vector for the mutual information between each y-z
         """
-        Ib, _, _ = mf_Xz(self.m1['set2'], np.array([self.case_N,
-                                                    self.control_N]))
-        return Ib
+        return self.metrics()['mf_Yz']
 
     def mutual_info_XY_omit_z(self):
         """
@@ -252,14 +975,7 @@ class MutualInfoXYz:
         :return: a M1 x M2 matrix, each element corresponding to the mutual
         information between x and y. Information on z is discarded.
         """
-        # first transform the summary statistics of XY_z to XY (omit z)
-        summary_XY = SummaryXY(self.vars_labels['set1'],
-                               self.vars_labels['set2'])
-        summary_XY.N = self.control_N + self.case_N
-        summary_XY.m = np.sum(self.m2.reshape([self.M1, self.M2, 4, 2]), axis=-1)
-        mutualInfo_XY = MutualInfoXY(summary_XY)
-        mf_XY_omit_z = mutualInfo_XY.mf()
-        return mf_XY_omit_z
+        return self.metrics()['mf_XY_omit_z']
 
     def mutual_info_XY_z(self):
         """
@@ -268,8 +984,7 @@ class MutualInfoXYz:
         :return: a M1 x M2 matrix, each element corresponding to the mutual
         information between the joint distribution of xy and z
         """
-        II = mf_XY_z(self.m2, np.array([self.case_N, self.control_N]))
-        return II
+        return self.metrics()['mf_XY_z']
 
     def mutual_info_XY_given_z(self):
         """
@@ -278,35 +993,31 @@ class MutualInfoXYz:
         :return: a M1 x M2 matrix, each element corresponding to the
         conditional mutual information between xy in respect to z.
         """
-        mf_conditional = mf_XY_given_z(self.m2, np.array([self.case_N,
-                                                   self.control_N]))
-        return mf_conditional
+        return self.metrics()['mf_XY_given_z']
 
     def synergy_XY2z(self):
         """
         Calculate the pairwise synergy of phenotype pairs for the current disease.
         :return: the synergy of phenotype pairs for the current disease
         """
-        Ia = self.mutual_info_Xz()
-        Ib = self.mutual_info_Yz()
-        II = self.mutual_info_XY_z()
-        S = synergy(Ia, Ib, II)
-        return S
+        return self.metrics()['synergy']
 
     def formatted_result(self, p_value=None):
+        rows, cols = self.pair_index()
         df = pd.DataFrame()
-        df['X'] = np.repeat(self.vars_labels['set1'], self.M2)
-        df['Y'] = np.tile(self.vars_labels['set2'], [self.M1])
+        df['X'] = self.vars_labels['set1'][rows]
+        df['Y'] = self.vars_labels['set2'][cols]
         df['mf_joint'] = self.mutual_info_XY_z().flat
         df['mf_conditional'] = self.mutual_info_XY_given_z().flat
         df['synergy'] = self.synergy_XY2z().flat
-        df['mf_Xz'] = np.repeat(self.mutual_info_Xz().flat, self.M2)
-        df['mf_Yz'] = np.tile(self.mutual_info_Yz().flat, [self.M2])
+        df['mf_Xz'] = self.mutual_info_Xz()[rows]
+        df['mf_Yz'] = self.mutual_info_Yz()[cols]
         return df
 
     def synergy_XY2z_df(self):
-        P1 = np.repeat(self.vars_labels['set1'], self.M2)
-        P2 = np.tile(self.vars_labels['set2'], [self.M1])
+        rows, cols = self.pair_index()
+        P1 = self.vars_labels['set1'][rows]
+        P2 = self.vars_labels['set2'][cols]
         assert(len(P1) == len(P2))
         S = self.synergy_XY2z()
         df = pd.DataFrame(data = {'P1': P1, 'P2': P2, 'synergy':
@@ -315,8 +1026,9 @@ class MutualInfoXYz:
         return df
 
     def synergy_XY2z_df_with_P_values(self, p_values):
-        P1 = np.repeat(self.vars_labels['set1'], self.M2)
-        P2 = np.tile(self.vars_labels['set2'], [self.M1])
+        rows, cols = self.pair_index()
+        P1 = self.vars_labels['set1'][rows]
+        P2 = self.vars_labels['set2'][cols]
         assert (len(P1) == len(P2))
         S = self.synergy_XY2z()
         df = pd.DataFrame(data={'P1': P1, 'P2': P2, 'synergy':
@@ -325,6 +1037,47 @@ class MutualInfoXYz:
         return df
 
 
+def _check_mergeable(summary, other, attributes):
+    """
+    Check that two summary statistics count the same variables, so that
+    their counts can be added.
+    :param attributes: names of the attributes that must be equal; arrays
+    and dictionaries of arrays are compared element-wise
+    """
+    if type(other) is not type(summary):
+        raise TypeError('cannot merge {} into {}'.format(
+            type(other).__name__, type(summary).__name__))
+    for attribute in attributes:
+        a = getattr(summary, attribute)
+        b = getattr(other, attribute)
+        if isinstance(a, dict):
+            same = a.keys() == b.keys() and \
+                   all(np.array_equal(a[key], b[key]) for key in a)
+        else:
+            same = np.array_equal(a, b)
+        if not same:
+            raise ValueError('cannot merge summary statistics with different '
+                             '{}'.format(attribute))
+
+
+class Workspace:
+    """
+    Scratch buffers that are reused across batches so that counting does
+    not allocate new M1 x M2 temporaries for every call. A buffer is
+    identified by name and grows when a larger shape is requested.
+    """
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape, dtype=np.float64):
+        size = int(np.prod(shape))
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.size < size or buffer.dtype != dtype:
+            buffer = np.empty(size, dtype=dtype)
+            self._buffers[name] = buffer
+        return buffer[:size].reshape(shape)
+
+
 def summarize_z(z):
     """
     Calculate the summary statistics of a binary vector
@@ -341,21 +1094,266 @@ def summarize_Xz(X, z):
     Calculate the summary statistics for the joint distribution of xz,
     x is a random variable in X
     :param X: a N x M matrix representing the profiles of X in N observations.
-    Values are 0 or 1.
+    Values are 0 or 1. The matrix may be dense or scipy.sparse.
     :param z: a vector of binary values (0, or 1).
     :return: a M X 4 matrix for summary statistics. The first dimension (size
     M) indicates random variables, the second dimension represent 4 outcomes (
     ++, +-, -+, --) for the joint distribution of xz.
     """
     N, M = X.shape
-    z = z.reshape([N, 1])
-    pd = np.stack([np.sum(X * z, axis=0),
-                   np.sum(X * (1 - z), axis=0),
-                   np.sum((1 - X) * z, axis=0),
-                   np.sum((1 - X) * (1 - z), axis=0)], axis=-1)
+    z = np.asarray(z).reshape(N)
+    case_N = np.sum(z)
+    # x=1, z=1 and x=1 (regardless of z); the other cells follow from them
+    if sparse.issparse(X):
+        Xz = sparse.csr_matrix(X).T @ z
+    else:
+        Xz = np.dot(z, X)
+    X_N = _column_sums(X)
+    pd = np.stack([Xz,
+                   X_N - Xz,
+                   case_N - Xz,
+                   N - case_N - X_N + Xz], axis=-1)
     return pd
 
 
+def _select_rows(X, rows, name, workspace):
+    """
+    Select rows of a binary matrix for counting. Dense matrices are copied
+    into a float64 buffer so that the products below run as BLAS GEMMs
+    (integer matmul does not use BLAS). Sparse matrices stay sparse and are
+    returned as float64 CSR.
+    """
+    if sparse.issparse(X):
+        X = sparse.csr_matrix(X, dtype=np.float64)
+        return X if np.all(rows) else X[rows]
+    buffer = workspace.get(name, (int(np.count_nonzero(rows)), X.shape[1]))
+    buffer[...] = X[rows]
+    return buffer
+
+
+def _cross_counts(X, Y, workspace):
+    """
+    X^T Y for two matrices returned by _select_rows. If either of them is
+    sparse, a sparse product is used and the result is densified, otherwise
+    the product is written into a reusable buffer.
+    """
+    if sparse.issparse(X) or sparse.issparse(Y):
+        return (sparse.csr_matrix(X).T @ sparse.csr_matrix(Y)).toarray()
+    both = workspace.get('both', (X.shape[1], Y.shape[1]))
+    return np.matmul(X.T, Y, out=both)
+
+
+def _column_sums(X):
+    return np.asarray(X.sum(axis=0)).reshape(-1)
+
+
+def _select_columns(X, columns):
+    if sparse.issparse(X):
+        return sparse.csr_matrix(X)[:, columns]
+    return np.asarray(X)[:, columns]
+
+
+def events_to_matrix(encounters, terms, N, names):
+    """
+    Convert a long-format event list to a sparse binary matrix that can be
+    passed to add_batch or summarize in place of a dense matrix.
+    :param encounters: row index (0 to N - 1) of the encounter of each event
+    :param terms: name of the random variable (e.g. HPO term) of each event;
+    events of names that are not in names are ignored
+    :param N: number of encounters
+    :param names: names of the random variables, which define the columns
+    :return: a N x len(names) CSR matrix with 1 for every (encounter, term)
+    that has at least one event
+    """
+    column_of = {name: i for i, name in enumerate(names)}
+    columns = np.array([column_of.get(term, -1) for term in terms],
+                       dtype=np.int64)
+    encounters = np.asarray(encounters, dtype=np.int64)
+    known = columns >= 0
+    matrix = sparse.csr_matrix(
+        (np.ones(np.count_nonzero(known)),
+         (encounters[known], columns[known])),
+        shape=(N, len(names)))
+    # repeated events are summed when converting to CSR
+    matrix.data[:] = 1
+    return matrix
+
+
+def add_XY_counts(m, X, Y, workspace=None):
+    """
+    Add the counts of a batch of observations to the summary statistics of
+    xy in place. Only the "both present" cell is counted directly with one
+    GEMM, X^T Y; the other three cells are derived from the marginal counts
+    of x and y.
+    :param m: a M1 x M2 x 4 matrix of counts (++, +-, -+, --) to update
+    :param X: a N x M1 matrix of binary values for random variables in X
+    :param Y: a N x M2 matrix of binary values for random variables in Y
+    :param workspace: an optional Workspace to reuse buffers across calls
+    :return: the updated m
+    """
+    if workspace is None:
+        workspace = Workspace()
+    N, M1 = X.shape
+    M2 = Y.shape[1]
+    rows = np.ones(N, dtype=bool)
+    X_selected = _select_rows(X, rows, 'X', workspace)
+    Y_selected = _select_rows(Y, rows, 'Y', workspace)
+    both = _cross_counts(X_selected, Y_selected, workspace)
+    X_N = _column_sums(X_selected).reshape([M1, 1])
+    Y_N = _column_sums(Y_selected).reshape([1, M2])
+
+    m[:, :, 0] += both
+    m[:, :, 1] += X_N - both
+    m[:, :, 2] += Y_N - both
+    m[:, :, 3] += N - X_N - Y_N + both
+    return m
+
+
+def add_XYz_counts(m2, X, Y, z, workspace=None):
+    """
+    Add the counts of a batch of observations to the summary statistics of
+    xyz in place. Only the two "both present" cells, X^T diag(z) Y and
+    X^T diag(1 - z) Y, are counted directly. They are computed as two GEMMs
+    over the case rows and the control rows, so together they cost as much
+    as a single X^T Y. The remaining six cells are derived from the
+    marginal counts of x and y among cases and controls.
+    :param m2: a M1 x M2 x 8 matrix of counts (+++, ++-, +-+, +--, -++, -+-,
+    --+, ---) to update, or a M1 x M2 x 2 matrix of compact counts (+++,
+    ++-), in which case only the two directly counted cells are updated
+    :param X: a N x M1 matrix of binary values for random variables in X
+    :param Y: a N x M2 matrix of binary values for random variables in Y
+    :param z: a vector of binary values (0, or 1).
+    :param workspace: an optional Workspace to reuse buffers across calls
+    :return: the updated m2
+    """
+    if workspace is None:
+        workspace = Workspace()
+    N1, M1 = X.shape
+    N2, M2 = Y.shape
+    assert N1 == N2
+    z = np.asarray(z).reshape(N1) != 0
+    for k, rows in enumerate([z, np.logical_not(z)]):
+        n = np.count_nonzero(rows)
+        X_selected = _select_rows(X, rows, 'X', workspace)
+        Y_selected = _select_rows(Y, rows, 'Y', workspace)
+        both = _cross_counts(X_selected, Y_selected, workspace)
+        X_N = _column_sums(X_selected).reshape([M1, 1])
+        Y_N = _column_sums(Y_selected).reshape([1, M2])
+        # k = 0 fills the z=1 cells (even), k = 1 the z=0 cells (odd)
+        np.add(m2[:, :, k], both, out=m2[:, :, k], casting='unsafe')
+        if m2.shape[-1] == 2:
+            continue
+        m2[:, :, 2 + k] += X_N - both
+        m2[:, :, 4 + k] += Y_N - both
+        m2[:, :, 6 + k] += n - X_N - Y_N + both
+    return m2
+
+
+def _gram_upper(X_float, workspace):
+    """
+    Upper triangle of X^T X computed with BLAS syrk, which does half the
+    work of a GEMM. The lower triangle of the returned matrix is not set.
+    A sparse X is multiplied with a sparse product instead.
+    """
+    if sparse.issparse(X_float):
+        return (X_float.T @ X_float).toarray()
+    M = X_float.shape[1]
+    buffer = workspace.get('gram', (M, M))
+    # syrk writes a Fortran-ordered matrix; the transposed view of the
+    # C-ordered buffer is one, so no copy is made
+    return blas.dsyrk(1.0, X_float.T, c=buffer.T, overwrite_c=1)
+
+
+def add_symmetric_XY_counts(m, X, pairs, workspace=None):
+    """
+    Add the counts of a batch of observations to the packed summary
+    statistics of xx' in place, where x and x' are random variables in X.
+    :param m: a K x 4 matrix of counts (++, +-, -+, --) for the K packed pairs
+    :param X: a N x M matrix of binary values for random variables in X
+    :param pairs: row and column indices of the packed pairs
+    :param workspace: an optional Workspace to reuse buffers across calls
+    :return: the updated m
+    """
+    if workspace is None:
+        workspace = Workspace()
+    rows, cols = pairs
+    N = X.shape[0]
+    X_selected = _select_rows(X, np.ones(N, dtype=bool), 'X', workspace)
+    both = _gram_upper(X_selected, workspace)[rows, cols]
+    X_N = _column_sums(X_selected)
+
+    m[:, 0] += both
+    m[:, 1] += X_N[rows] - both
+    m[:, 2] += X_N[cols] - both
+    m[:, 3] += N - X_N[rows] - X_N[cols] + both
+    return m
+
+
+def add_symmetric_XYz_counts(m2, X, z, pairs, workspace=None):
+    """
+    Add the counts of a batch of observations to the packed summary
+    statistics of xx'z in place, where x and x' are random variables in X.
+    Same as add_XYz_counts, but only the upper triangle of X^T diag(z) X
+    and X^T diag(1 - z) X is computed.
+    :param m2: a K x 8 matrix of counts for the K packed pairs, or a K x 2
+    matrix of compact counts (+++, ++-)
+    :param X: a N x M matrix of binary values for random variables in X
+    :param z: a vector of binary values (0, or 1).
+    :param pairs: row and column indices of the packed pairs
+    :param workspace: an optional Workspace to reuse buffers across calls
+    :return: the updated m2
+    """
+    if workspace is None:
+        workspace = Workspace()
+    rows, cols = pairs
+    z = np.asarray(z).reshape(X.shape[0]) != 0
+    for k, selected in enumerate([z, np.logical_not(z)]):
+        n = np.count_nonzero(selected)
+        X_selected = _select_rows(X, selected, 'X', workspace)
+        both = _gram_upper(X_selected, workspace)[rows, cols]
+        X_N = _column_sums(X_selected)
+        np.add(m2[:, k], both, out=m2[:, k], casting='unsafe')
+        if m2.shape[-1] == 2:
+            continue
+        m2[:, 2 + k] += X_N[rows] - both
+        m2[:, 4 + k] += X_N[cols] - both
+        m2[:, 6 + k] += n - X_N[rows] - X_N[cols] + both
+    return m2
+
+
+def pair_index(M1, M2, pairs=None):
+    """
+    Indices of x and y of pairwise results when they are flattened
+    :param M1: number of random variables in X
+    :param M2: number of random variables in Y
+    :param pairs: row and column indices of packed pairs, or None for all
+    M1 x M2 pairs in row-major order
+    :return: two vectors, the index of x and the index of y
+    """
+    if pairs is not None:
+        return pairs
+    return np.repeat(np.arange(M1), M2), np.tile(np.arange(M2), M1)
+
+
+def expand_symmetric(values, pairs, M, cells=None):
+    """
+    Expand values of packed pairs (i <= j) to a M x M matrix.
+    :param values: a K x ... array, first dimension over the packed pairs
+    :param pairs: row and column indices of the packed pairs
+    :param M: number of random variables
+    :param cells: if the last dimension holds joint counts, the order in
+    which they are written to the mirrored (j, i) positions, e.g. [0, 2, 1,
+    3] swaps +- and -+ of xy counts
+    :return: a M x M x ... array
+    """
+    rows, cols = pairs
+    values = np.asarray(values)
+    expanded = np.empty((M, M) + values.shape[1:], dtype=values.dtype)
+    expanded[cols, rows] = values if cells is None else values[..., cells]
+    expanded[rows, cols] = values
+    return expanded
+
+
 def summarize_XYz(X, Y, z):
     """
     Calculate the summary statistics for the joint distribution of xyz,
@@ -367,6 +1365,7 @@ def summarize_XYz(X, Y, z):
     :param Y: a N x M2 matrix representing the profiles of Y in N
     observations. Each size M2 vector represent the values of M2 random
     variables of Y.
+    X and Y may be dense or scipy.sparse matrices.
     :param z: a vector of binary values (0, or 1).
     :return: a M1 X M2 X 8 matrix for the summary statistics for joint
     distributions of xyz.
@@ -378,62 +1377,55 @@ def summarize_XYz(X, Y, z):
     N1, M1 = X.shape
     N2, M2 = Y.shape
     assert N1 == N2
-    N = N1
-    p1_reshape1 = X.reshape([N, M1, 1])
-    p2_reshape2 = Y.reshape([N, 1, M2])
-
-    # distribution of phenotype pairs, 1 if both phenotypes are present, 0 otherwise
-    pp = np.matmul(p1_reshape1, p2_reshape2)
-    # compute the joint distribution of diagnosis and phenotype pairs
-    z = z.reshape([N, 1, 1])
-    # pp * d: 1 if both phenotypes are present and positive diagnosis
-    joint = pp * z
-    ppd = np.sum(joint, axis=0)  # summary count
-
-    # pp * (1 - d): 1 if both phenotypes are present and negative diagnosis
-    joint = pp * (1 - z)
-    ppd = np.concatenate((ppd.reshape([M1, M2, 1]), np.sum(joint,
-            axis=0).reshape([M1, M2, 1])), axis=-1)
-
-    # distribution of phenotype pairs, 1 if phenotypes are +-, 0 otherwise
-    pp = np.matmul(p1_reshape1, 1 - p2_reshape2)
-    # pp * d: 1 if phenotypes are +- and positive diagnosis
-    ppd = np.concatenate((ppd, np.sum(pp * z, axis=0).reshape([M1, M2, 1])),
-                         axis=-1)
-    # pp * (1 - d): 1 if phenotypes are +- and negative diagnosis
-    ppd = np.concatenate((ppd, np.sum(pp * (1 - z), axis=0).reshape([M1, M2,
-                                                                     1])), axis=-1)
-
-    # distribution of phenotype pairs, 1 if phenotypes are -+, 0 otherwise
-    pp = np.matmul(1 - p1_reshape1, p2_reshape2)
-    # pp * d: 1 if phenotypes are -+ and positive diagnosis
-    ppd = np.concatenate((ppd, np.sum(pp * z, axis=0).reshape([M1, M2, 1])),
-                         axis=-1)
-    # pp * (1 - d): 1 if phenotypes are +- and negative diagnosis
-    ppd = np.concatenate((ppd, np.sum(pp * (1 - z), axis=0).reshape([M1, M2,
-                                                                     1])), axis=-1)
-
-    # distribution of phenotype pairs, 1 if phenotypes are --, 0 otherwise
-    pp = np.matmul(1 - p1_reshape1, 1 - p2_reshape2)
-    # pp * d: 1 if phenotypes are -- and positive diagnosis
-    ppd = np.concatenate((ppd, np.sum(pp * z, axis=0).reshape([M1, M2, 1])),
-                         axis=-1)
-    # pp * (1 - d): 1 if phenotypes are -- and negative diagnosis
-    ppd = np.concatenate((ppd, np.sum(pp * (1 - z), axis=0).reshape([M1, M2,
-                                                                     1])), axis=-1)
-
-    return ppd
-
-
-def summarize(P1, P2, d, current=None):
+    ppd = np.zeros([M1, M2, 8])
+    return add_XYz_counts(ppd, X, Y, z)
+
+
+def expand_XYz_counts(m2_compact, m1_X, m1_Y, case_N, control_N,
+                      pairs=None):
+    """
+    Reconstruct the full summary statistics of xyz from the compact counts.
+    Given the +++ and ++- counts of a pair, the other six counts follow from
+    the xz and yz counts and the number of cases and controls.
+    :param m2_compact: a M1 x M2 x 2 matrix of +++ and ++- counts
+    :param m1_X: a M1 x 4 matrix of xz counts (++, +-, -+, --)
+    :param m1_Y: a M2 x 4 matrix of yz counts (++, +-, -+, --)
+    :param case_N: count of 1s of z
+    :param control_N: count of 0s of z
+    :param pairs: row and column indices if m2_compact holds K packed pairs
+    (K x 2) instead of all M1 x M2 pairs
+    :return: a M1 x M2 x 8 (or K x 8) matrix of counts (+++, ++-, +-+, +--,
+    -++, -+-, --+, ---)
+    """
+    both = m2_compact.astype(np.float64)
+    X_N = np.asarray(m1_X, dtype=np.float64)[:, 0:2]
+    Y_N = np.asarray(m1_Y, dtype=np.float64)[:, 0:2]
+    if pairs is None:
+        X_N = X_N[:, np.newaxis, :]
+        Y_N = Y_N[np.newaxis, :, :]
+    else:
+        X_N = X_N[pairs[0]]
+        Y_N = Y_N[pairs[1]]
+    z_N = np.array([case_N, control_N], dtype=np.float64)
+    m2 = np.empty(both.shape[:-1] + (8,))
+    m2[..., 0:2] = both
+    m2[..., 2:4] = X_N - both
+    m2[..., 4:6] = Y_N - both
+    m2[..., 6:8] = z_N - X_N - Y_N + both
+    return m2
+
+
+def summarize(P1, P2, d, current=None, workspace=None):
     """
     Given patient profile matrix and diagnosis vector, return the counts of
     joint distribution.
     :param P: a N X M matrix of patient phenotype profile, N: sample size,
-    M: number of phenotype set
+    M: number of phenotype set. P1 and P2 may be dense or scipy.sparse
+    matrices.
     :param d: a vector representing patient diagnosis
     :param current: a list of summary statistics that new summary statistics
-    will be added to
+    will be added to. Counts are updated in place.
+    :param workspace: an optional Workspace to reuse buffers across calls
     :return: a list of summary statistics
     """
     N1, M1 = P1.shape
@@ -481,12 +1473,154 @@ def summarize(P1, P2, d, current=None):
     m1['set2'] = m1['set2'] + pd
 
     # compute summary statistics for diagnosis*phenotype_pairs
-    ppd = summarize_XYz(P1, P2, d)
-    m2 = m2 + ppd
+    m2 = add_XYz_counts(m2, P1, P2, d, workspace)
 
     return [m1, m2, case_N, control_N]
 
 
+@functools.lru_cache(maxsize=32)
+def plog2p_table(N):
+    """
+    Lookup table of n * log2(n) normalized by the number of observations,
+    i.e. p * log2(p) for p = n / N, for every integer count n from 0 to N.
+    Tables are cached, so repeated computations with the same N (e.g. the
+    replicates of a simulation) only take the logarithms once.
+    :param N: total number of observations, an integer
+    :return: a read-only vector of size N + 1
+    """
+    p = np.arange(N + 1) / N
+    table = np.zeros(N + 1)
+    table[1:] = p[1:] * np.log2(p[1:])
+    table.flags.writeable = False
+    return table
+
+
+def plog2p(counts, N):
+    """
+    p * log2(p) of the probabilities p = counts / N, with 0 * log2(0) = 0.
+    Integer counts (of any dtype) with an integer N are looked up in
+    plog2p_table(N), so no logarithm is taken; other inputs are computed
+    directly, with the same result.
+    :param counts: an array of non-negative counts
+    :param N: total number of observations
+    :return: an array of the same shape
+    """
+    counts = np.asarray(counts)
+    if np.ndim(N) == 0 and N > 0 and float(N).is_integer() and \
+            counts.size > 0:
+        index = counts.astype(np.intp)
+        if (counts.dtype.kind in 'iu' or np.array_equal(index, counts)) and \
+                index.min() >= 0 and index.max() <= N:
+            return plog2p_table(int(N))[index]
+    p = counts.astype(np.float64) / N
+    result = np.zeros_like(p)
+    positive = p > 0
+    result[positive] = p[positive] * np.log2(p[positive])
+    return result
+
+
+def _as_counts(counts):
+    # integer counts are kept as they are, anything else becomes float64
+    counts = np.asarray(counts)
+    if counts.dtype.kind in 'iu':
+        return counts
+    return counts.astype(np.float64)
+
+
+def _entropy_term(counts, N):
+    # negative entropy, sum of p * log2(p) over the cells of a distribution
+    # in the last dimension
+    return np.sum(plog2p(counts, N), axis=-1)
+
+
+def _marginals_XY(xy):
+    """
+    Marginal counts of x and y from the counts of xy (++, +-, -+, --) in the
+    last dimension. Marginals are taken with strided additions, which are
+    much faster than reductions over short axes.
+    :return: counts of x (+, -) and counts of y (+, -)
+    """
+    return xy[..., 0::2] + xy[..., 1::2], xy[..., 0:2] + xy[..., 2:4]
+
+
+def _marginals_XYz(xyz):
+    """
+    Marginal counts of xy, xz and yz from the counts of xyz (+++, ++-, +-+,
+    +--, -++, -+-, --+, ---) in the last dimension
+    :return: counts of xy, xz and yz, each in the order ++, +-, -+, --
+    """
+    xy = xyz[..., 0::2] + xyz[..., 1::2]
+    xz = np.concatenate([xyz[..., 0:2] + xyz[..., 2:4],
+                         xyz[..., 4:6] + xyz[..., 6:8]], axis=-1)
+    yz = xyz[..., 0:4] + xyz[..., 4:8]
+    return xy, xz, yz
+
+
+def _z_terms(summary_z):
+    """
+    Total number of observations and the entropy term T(z) from the counts
+    (or probabilities) of z (+, -) in the last dimension. Leading dimensions, e.g. one per
+    simulation, are kept in T(z); all of them must have the same total.
+    """
+    summary_z = _as_counts(summary_z)
+    totals = np.sum(summary_z, axis=-1)
+    N = totals.flat[0]
+    # probabilities may differ from their total in the last bits
+    if not np.allclose(totals, N, rtol=1e-12, atol=0):
+        raise ValueError('counts of z with different totals')
+    return N, _entropy_term(summary_z, N)
+
+
+def mf_Xz_from_entropies(summary_Xd, summary_z):
+    """
+    Mutual information between each x in X and z (the first value returned
+    by mf_Xz), computed from entropy terms as in pairwise_metrics:
+    I(x;z) = T(xz) - T(x) - T(z)
+    :param summary_Xd: summary statistics for the joint distribution of
+    each x in X and z (++, +-, -+, --)
+    :param summary_z: summary statistics for random variable z (+, -), see
+    pairwise_metrics
+    :return: a vector of mutual information between each x in X and z
+    """
+    N, T_z = _z_terms(summary_z)
+    xz = _as_counts(summary_Xd)
+    T_xz = _entropy_term(xz, N)
+    T_x = _entropy_term(_marginals_XY(xz)[0], N)
+    return T_xz - T_x - T_z
+
+
+def pairwise_metrics(summary_XYz, summary_z):
+    """
+    Compute the pairwise mutual information of xyz in one pass. All metrics
+    are derived from shared entropy terms of the joint counts and their
+    marginals, where T(.) = sum of p * log2(p) over the cells of a
+    distribution (the negative entropy):
+    I(x,y;z) = T(xyz) - T(xy) - T(z)
+    I(x;y|z) = T(xyz) + T(z) - T(xz) - T(yz)
+    I(x;y) = T(xy) - T(x) - T(y)
+    :param summary_XYz: counts for the joint distribution of xyz (+++, ++-,
+    +-+, +--, -++, -+-, --+, ---) in the last dimension, e.g. M1 x M2 x 8
+    :param summary_z: summary statistics for random variable z (+, -) in the
+    last dimension. Leading dimensions, e.g. one per simulation, are
+    broadcast against those of summary_XYz; the total must be the same.
+    :return: a dictionary of mf_XY_omit_z, mf_XY_z and mf_XY_given_z, each
+    with the leading dimensions of summary_XYz
+    """
+    N, T_z = _z_terms(summary_z)
+    xyz = _as_counts(summary_XYz)
+    xy, xz, yz = _marginals_XYz(xyz)
+    x, y = _marginals_XY(xy)
+    T_xyz = _entropy_term(xyz, N)
+    T_xy = _entropy_term(xy, N)
+    T_xz = _entropy_term(xz, N)
+    T_yz = _entropy_term(yz, N)
+    T_x = _entropy_term(x, N)
+    T_y = _entropy_term(y, N)
+    return {'mf_XY_omit_z': T_xy - T_x - T_y,
+            'mf_XY_z': T_xyz - T_xy - T_z,
+            'mf_XY_given_z': T_xyz + T_z - T_xz - T_yz}
+
+
 def mf_Xz(summary_Xd, summary_z):
     '''
     Given the summary statistics for single phenotypes, return the mutual
@@ -497,47 +1631,47 @@ def mf_Xz(summary_Xd, summary_z):
     :return: a vector of mutual information between each x in X and z
     '''
     case_N, control_N = summary_z
-    M = summary_Xd.shape[0]
     N = case_N + control_N
-    prob = summary_Xd / N
     prob_diag = case_N / N
-    prob_pheno = np.sum(prob[:, [0,1]], axis=1)
-    prob_diag_M = np.stack([np.repeat(prob_diag, M),
-                            np.repeat(1 - prob_diag, M),
-                            np.repeat(prob_diag, M),
-                            np.repeat(1 - prob_diag, M)], axis=1)
-    prob_pheno_M = np.stack([prob_pheno, prob_pheno, 1 - prob_pheno, 1 - prob_pheno], axis=1)
-    # prob could be 0
-    non_zero_idx = np.logical_and(prob != 0, prob_diag_M * prob_pheno_M != 0)
-    temp = np.zeros_like(prob)
-    temp[non_zero_idx] = prob[non_zero_idx] * np.log2(prob[non_zero_idx] / (
-        prob_diag_M[non_zero_idx] * prob_pheno_M[non_zero_idx]))
-    I = np.sum(temp, axis=1)
+    prob_pheno = np.sum(np.asarray(summary_Xd)[:, [0, 1]], axis=1) / N
+    I = mf_Xz_from_entropies(summary_Xd, summary_z)
     return I, prob_diag, prob_pheno
 
 
+def mf_XY(summary_XY, N):
+    """
+    Given the summary statistics for XY, return the mutual information
+    between x and y, computed from entropy terms as in pairwise_metrics:
+    I(x;y) = T(xy) - T(x) - T(y)
+    :param summary_XY: counts for the joint distribution of xy (++, +-, -+,
+    --) in the last dimension, e.g. M1 x M2 x 4
+    :param N: total number of observations
+    :return: the mutual information between x and y, e.g. M1 x M2
+    """
+    xy = _as_counts(summary_XY)
+    x, y = _marginals_XY(xy)
+    T_xy = _entropy_term(xy, N)
+    T_x = _entropy_term(x, N)
+    T_y = _entropy_term(y, N)
+    return T_xy - T_x - T_y
+
+
 def mf_XY_z(summary_XYz, summary_z):
     '''
     Given the summary statistics for XYz, return the mutual
-    information between pairs of XY and z
+    information between pairs of XY and z:
+    I(x,y;z) = T(xyz) - T(xy) - T(z) (see pairwise_metrics)
     :param summary_Xd: summary statistics for the joint distribution of xy
     and z (++, +-, -+, --) for x in X and y in Y
     :param summary_z: summary statistics for random variable z (+, -)
     :return: the mutual information between joint distribution XY and z
     '''
-    case_N, control_N = summary_z
-    N = case_N + control_N
-    prob_diag = case_N / N
-    M1, M2 = summary_XYz.shape[0:2]
-    prob = summary_XYz / N
-    prob_pheno_M = np.repeat(prob[:,:,[1,3,5,7]] + prob[:,:,[0,2,4,6]], 2, axis=-1)
-    prob_diag_M = np.tile(np.array([prob_diag, 1 - prob_diag]).reshape([1,1,2]), 4)
-    temp = np.zeros([M1, M2, 8])
-    non_zero_valued_indices = np.logical_and(prob != 0, prob_pheno_M * prob_diag_M != 0)
-    temp2 = prob_pheno_M * prob_diag_M
-    temp[non_zero_valued_indices] = np.log2(prob[non_zero_valued_indices] / temp2[non_zero_valued_indices])
-    II = np.sum(prob * temp, axis=-1)
-    return II
+    N = np.sum(summary_z)
+    xyz = _as_counts(summary_XYz)
+    T_xyz = _entropy_term(xyz, N)
+    T_xy = _entropy_term(xyz[..., 0::2] + xyz[..., 1::2], N)
+    T_z = np.sum(plog2p(summary_z, N))
+    return T_xyz - T_xy - T_z
 
 
 def synergy(I1, I2, II):
@@ -571,12 +1705,14 @@ def entropy(X):
     outcome counts, + and -.
     :return: a 1 x M vector.
     """
-    TOTAL = np.sum(X, axis=-1).reshape([-1, 1])
-    p = X / TOTAL
-    temp = np.zeros_like(p)
-    non_zero_idx = (p != 0)
-    temp[non_zero_idx] = -p[non_zero_idx] * np.log2(p[non_zero_idx])
-    entropies = np.sum(temp, axis=-1).squeeze()
+    X = _as_counts(X)
+    TOTAL = np.sum(X, axis=-1)
+    if TOTAL.size > 0 and np.all(TOTAL == TOTAL.flat[0]):
+        # usually all variables are counted over the same observations
+        TOTAL = TOTAL.flat[0]
+    else:
+        TOTAL = TOTAL.reshape(TOTAL.shape + (1,))
+    entropies = -np.sum(plog2p(X, TOTAL), axis=-1).squeeze()
     return entropies
 
 def mf_XY_given_z(summary_XYz, summary_z):
@@ -586,42 +1722,18 @@ def mf_XY_given_z(summary_XYz, summary_z):
     to compute I(x, y|z):
     I(x, y|z) = sum(p(x,y,z) * log2(p(z) * p(x, y, z) / p(x, z) * p(y, z)),
     x, y, z take all values in their space
+    It is computed as T(xyz) + T(z) - T(xz) - T(yz) (see pairwise_metrics).
     :param summary_Xd: summary statistics for the joint distribution of xy
     and z (++, +-, -+, --) for x in X and y in Y
     :param summary_z: summary statistics for random variable z (+, -)
     :return: the mutual information between joint distribution XY given z
 
     """
-    case_N, control_N = summary_z
-    N = case_N + control_N
-    prob_diag = case_N / N
-    M1, M2 = summary_XYz.shape[0:2]
-    # dimension: M1, M2, 8
-    # last axis: +++, ++-, +-+, +--, -++, -+-, --+, --- for xyz joint
-    # distribution
-    prob = summary_XYz / N
-
-    # calculate Xz joint prob, order ++, +-, -+, --
-    prob_Xz = np.sum(np.stack((prob[:, :, [0,1,4,5]], prob[:, :, [2,3,6,7]]),
-                              axis=-1),axis=-1)
-    ## need to repeat the values in the order: ++, +-, ++, +-, -+, --, -+, --
-    prob_Xz = np.tile(prob_Xz.reshape([M1, M2, 2, 2]), 2).reshape([M1, M2, 8,
-               1]).squeeze()
-
-    # calculate Yz joint prob, order ++, +-, -+, --
-    prob_Yz = np.sum(prob.reshape([M1, M2, 2, 4]), axis=2)
-    ## repeat the values twice in the order: ++, +-, -+, --, ++, +-, -+, --
-    prob_Yz = np.tile(prob_Yz, [1, 1, 2])
-
-    # format z dimension in the order: +, -, +, -, +, -, +, -
-    prob_z = np.tile(np.array([prob_diag, 1-prob_diag]), [4]).reshape([1, 1, 8])
-
-    temp = np.zeros([M1, M2, 8])
-    non_zero_valued_indices = np.logical_and(prob != 0,
-                                             prob_Xz*prob_Yz != 0)
-
-    temp[non_zero_valued_indices] = prob[non_zero_valued_indices] * \
-                                    np.log2((prob_z * prob)[non_zero_valued_indices] /
-                                    (prob_Xz[non_zero_valued_indices] * prob_Yz[non_zero_valued_indices]))
-    mf_XY_condition_on_z = np.sum(temp, axis=-1)
-    return mf_XY_condition_on_z
+    N = np.sum(summary_z)
+    xyz = _as_counts(summary_XYz)
+    _, xz, yz = _marginals_XYz(xyz)
+    T_xyz = _entropy_term(xyz, N)
+    T_xz = _entropy_term(xz, N)
+    T_yz = _entropy_term(yz, N)
+    T_z = np.sum(plog2p(summary_z, N))
+    return T_xyz + T_z - T_xz - T_yz
@@ -0,0 +1,202 @@
+import numpy as np
+import copy
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import os
+import queue
+import traceback
+import logging.config
+
+
+log_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'log_config.conf')
+logging.config.fileConfig(log_file_path)
+logger = logging.getLogger(__name__)
+
+
+class SharedBatchSlots:
+    """
+    A fixed number of shared memory blocks (slots) that hold batches of
+    observations on their way to worker processes, so that the matrices are
+    copied once into shared memory instead of being pickled through a pipe.
+    A slot is reused once the worker that received it has counted its batch;
+    it grows when a batch does not fit.
+    """
+    def __init__(self, n_slots):
+        self.blocks = [None] * n_slots
+
+    def write(self, slot, arrays):
+        """
+        Copy a batch into a slot
+        :param slot: index of a free slot
+        :param arrays: a tuple of arrays
+        :return: name of the shared memory block and the layout (shape,
+        dtype and offset of every array) needed to read the batch back
+        """
+        arrays = [np.ascontiguousarray(array) for array in arrays]
+        size = sum(array.nbytes for array in arrays)
+        block = self.blocks[slot]
+        if block is None or block.size < size:
+            if block is not None:
+                block.close()
+                block.unlink()
+            block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            self.blocks[slot] = block
+        layout = []
+        offset = 0
+        for array in arrays:
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf,
+                              offset=offset)
+            view[...] = array
+            layout.append((array.shape, array.dtype.str, offset))
+            offset += array.nbytes
+        return block.name, layout
+
+    def close(self):
+        for block in self.blocks:
+            if block is not None:
+                block.close()
+                block.unlink()
+        self.blocks = [None] * len(self.blocks)
+
+
+def read_batch(block, layout):
+    """
+    Arrays of a batch written by SharedBatchSlots.write. The arrays are
+    views of the shared memory and must be released before it is closed.
+    """
+    return tuple(np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf,
+                            offset=offset)
+                 for shape, dtype, offset in layout)
+
+
+def _attach(name):
+    # the block is owned (and unlinked) by the parent process. Workers share
+    # the resource tracker of the parent, where attaching registers the
+    # block again at no cost; unregistering it here would remove the
+    # registration of the parent.
+    return shared_memory.SharedMemory(name=name)
+
+
+def _summarize_worker(summaries, routes, tasks, free_slots, results):
+    """
+    Count every batch received from the task queue into this worker's
+    partial summary statistics, then send them back.
+    """
+    blocks = {}
+    error = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, name, layout = task
+        if error is None:
+            try:
+                if slot not in blocks or blocks[slot].name != name:
+                    if slot in blocks:
+                        blocks[slot].close()
+                    blocks[slot] = _attach(name)
+                arrays = read_batch(blocks[slot], layout)
+                for summary, route in zip(summaries, routes):
+                    if route is None:
+                        summary.add_batch(*arrays)
+                    else:
+                        summary.add_batch(*[arrays[i] for i in route])
+                del arrays
+            except Exception:
+                # keep releasing slots so that the parent does not block
+                error = traceback.format_exc()
+        free_slots.put(slot)
+    for block in blocks.values():
+        block.close()
+    results.put(error if error is not None else summaries)
+
+
+def summarize_in_parallel(summaries, batches, routes=None, workers=None,
+                          slots=None):
+    """
+    Count batches of observations in worker processes and merge the
+    partial summary statistics of the workers (map-reduce). The batches are
+    read in this process, e.g. from the database, and are passed to the
+    workers through shared memory.
+    The ROW_ID range is deliberately not sharded across the workers for
+    them to query: the batch queries of analysis_pipeline read TEMPORARY
+    tables, which only exist in the MySQL session of the parent, and a
+    connection cannot be shared by forked processes. The parent only
+    reads; the pair counts, which grow with M1 x M2, are what run in the
+    workers. Once reading a batch takes longer than counting it, adding
+    workers no longer helps.
+    :param summaries: a list of empty summary statistics, e.g. SummaryXYz or
+    SymmetricSummaryXYz instances. Every worker counts into its own copy.
+    :param batches: an iterable of batches; a batch is a tuple of arrays,
+    e.g. (textHpo matrix, labHpo matrix, diagnosis vector)
+    :param routes: for every summary, the indices of the arrays of a batch
+    that are passed to its add_batch method. By default, all arrays of a
+    batch are passed to every summary.
+    :param workers: number of worker processes, default to the number of
+    CPUs
+    :param slots: number of batches that can be in shared memory at a time,
+    default to twice the number of workers
+    :return: a list of summary statistics of all batches, in the order of
+    summaries
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    if slots is None:
+        slots = 2 * workers
+    if routes is None:
+        routes = [None] * len(summaries)
+    tasks = multiprocessing.Queue()
+    free_slots = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    shared = SharedBatchSlots(slots)
+    for slot in range(slots):
+        free_slots.put(slot)
+    # workers share the resource tracker of this process only if it is
+    # running before they start
+    resource_tracker.ensure_running()
+    processes = []
+    try:
+        for i in range(workers):
+            process = multiprocessing.Process(
+                target=_summarize_worker,
+                args=(copy.deepcopy(summaries), routes, tasks, free_slots,
+                      results))
+            process.start()
+            processes.append(process)
+        logger.info('workers started: {}'.format(workers))
+        for batch in batches:
+            slot = _get(free_slots, processes)
+            name, layout = shared.write(slot, batch)
+            tasks.put((slot, name, layout))
+        for _ in processes:
+            tasks.put(None)
+        partials = []
+        for _ in processes:
+            partials.append(_get(results, processes))
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        shared.close()
+    errors = [partial for partial in partials if isinstance(partial, str)]
+    if errors:
+        raise RuntimeError('summarizing failed in a worker:\n' + errors[0])
+    merged = []
+    for k in range(len(summaries)):
+        merged.append(sum(partial[k] for partial in partials))
+    return merged
+
+
+def _get(messages, processes):
+    # wait for a message from the workers, but do not hang if one of them
+    # died
+    while True:
+        try:
+            return messages.get(timeout=1)
+        except queue.Empty:
+            if any(process.exitcode not in (None, 0)
+                   for process in processes):
+                raise RuntimeError('a worker process exited unexpectedly')
@@ -1,8 +1,12 @@
 import numpy as np
+from scipy import sparse
+from scipy import stats
 import mf
+import functools
 import multiprocessing
 import os
 import os.path
+import tempfile
 import logging.config
 
 
@@ -12,6 +16,12 @@ logging.config.fileConfig(log_file_path)
 logger = logging.getLogger(__name__)
 
 
+# degrees of freedom of the chi-square distributions that 2 * N * ln(2) *
+# mutual information (the G statistic) approximates under independence
+DEGREES_OF_FREEDOM = {'mf_Xz': 1, 'mf_Yz': 1, 'mf_XY_omit_z': 1,
+                      'mf_XY_z': 3, 'mf_XY_given_z': 2}
+
+
 class MutualInfoRandomizer:
 
     def __init__(self, observed_summary_statistics):
@@ -19,30 +29,79 @@ class MutualInfoRandomizer:
         self.case_N = self.observed.case_N
         self.control_N = self.observed.control_N
         self.m1 = self.observed.m1
-        self.m2 = self.observed.m2
         self.empirical_distribution = {}
         logger.info('randomizer initiated')
 
-    def simulate(self, per_simulation=None, simulations=100, cpu=None,
-                 job_id=0):
+    @property
+    def m2(self):
+        # read through, so that compact summary statistics are only
+        # expanded when the full table is actually asked for
+        return self.observed.m2
+
+    def _null_parameters(self):
         TOTAL = self.case_N + self.control_N
         diag_prob = self.case_N / TOTAL
-        phenotype_prob1 = np.sum(self.m1['set1'][:, 0:1], axis=1) / TOTAL
-        phenotype_prob2 = np.sum(self.m1['set2'][:, 0:1], axis=1) / TOTAL
+        # x+ regardless of z: the ++ and +- counts of xz
+        phenotype_prob1 = np.sum(self.m1['set1'][:, 0:2], axis=1) / TOTAL
+        phenotype_prob2 = np.sum(self.m1['set2'][:, 0:2], axis=1) / TOTAL
+        return diag_prob, phenotype_prob1, phenotype_prob2, TOTAL
+
+    def simulate(self, per_simulation=None, simulations=100, cpu=None,
+                 job_id=0, method='bernoulli', first=0, last=None,
+                 pool=None):
+        diag_prob, phenotype_prob1, phenotype_prob2, TOTAL = \
+            self._null_parameters()
         if per_simulation is None:
             per_simulation = TOTAL
         self.empirical_distribution = create_empirical_distribution(diag_prob,
               phenotype_prob1, phenotype_prob2, per_simulation, simulations,
-              cpu, job_id)
+              cpu, job_id, method, first, last, pool)
 
-    def p_values(self, adjust=None):
+    def simulate_p_values(self, per_simulation=None, simulations=100,
+                          cpu=None, job_id=0, method='bernoulli',
+                          burn_in=100, adjust=None):
+        """
+        Estimate p values while simulating: every simulation updates the
+        counts of values at least as extreme as the observed ones and is
+        then discarded, so memory does not grow with the number of
+        simulations. The accumulator is kept as self.accumulator, so that
+        the counts of several jobs can be merged.
+        :param burn_in: number of extra simulations used to estimate the
+        centers of the null distributions for two-sided p values
+        :param adjust: see p_values
+        :return: a dictionary of p values, same as p_values
+        """
+        diag_prob, phenotype_prob1, phenotype_prob2, TOTAL = \
+            self._null_parameters()
+        if per_simulation is None:
+            per_simulation = TOTAL
+        self.accumulator = ExceedanceAccumulator(
+            mf.MutualInfoXYz(self.observed).metrics(), burn_in=burn_in,
+            pairs=getattr(self.observed, 'pairs', None))
+        for simulated in iterate_simulations(diag_prob, phenotype_prob1,
+                phenotype_prob2, per_simulation,
+                simulations + self.accumulator.burn_in, cpu, job_id, method):
+            self.accumulator.update(simulated)
+        return self._adjust(self.accumulator.p_values(), adjust)
+
+    def p_values(self, adjust=None, method='empirical', min_expected=5,
+                 simulations=1000, seed=None):
         """
         Estimate p values for each observed phenotype pair by comparing the
         observed synergy score with empirical distributions created by random
         sampling.
-        :param sampling: sampling times
+        :param adjust: 'Bonferroni' or None
+        :param method: 'empirical' to compare with the empirical
+        distributions (see simulate), or 'asymptotic' to use the G test (see
+        asymptotic_p_values)
+        :param min_expected, simulations, seed: see asymptotic_p_values
         :return: p value matrix
         """
+        if method == 'asymptotic':
+            return self._adjust(self.asymptotic_p_values(
+                min_expected, simulations, seed), adjust)
+        elif method != 'empirical':
+            raise ValueError('unknown method: {}'.format(method))
         # observed mutual information
         mutualInfo_XYz = mf.MutualInfoXYz(self.observed)
         mf_Xz = mutualInfo_XYz.mutual_info_Xz()
@@ -68,30 +127,396 @@ class MutualInfoRandomizer:
         p['mf_Yz'] = p_value_estimate(mf_Yz.reshape([1, M2]),
             self.empirical_distribution['mf_Yz'].reshape([1, M2, -1]),
                                       'two.sided').squeeze()
-        p['mf_XY_z'] = p_value_estimate(mf_XY_z, self.empirical_distribution[
-            'mf_XY_z'], 'two.sided')
-        p['mf_XY_given_z'] = p_value_estimate(mf_XY_given_z,
-           self.empirical_distribution['mf_XY_given_z'], 'two.sided')
-        p['synergy'] = p_value_estimate(synergy, self.empirical_distribution[
-            'synergy'], 'two.sided')
-        p['mf_XY_omit_z'] = p_value_estimate(mf_XY_omit_z,
-            self.empirical_distribution['mf_XY_omit_z'], 'two.sided')
+        p['mf_XY_z'] = self._pairwise_p_value(mf_XY_z, 'mf_XY_z')
+        p['mf_XY_given_z'] = self._pairwise_p_value(mf_XY_given_z,
+                                                    'mf_XY_given_z')
+        p['synergy'] = self._pairwise_p_value(synergy, 'synergy')
+        p['mf_XY_omit_z'] = self._pairwise_p_value(mf_XY_omit_z,
+                                                   'mf_XY_omit_z')
+        return self._adjust(p, adjust)
+
+    def asymptotic_p_values(self, min_expected=5, simulations=1000,
+                            seed=None):
+        """
+        Closed-form p values of the mutual information metrics from the G
+        test: under independence, 2 * N * ln(2) * I follows a chi-square
+        distribution (see DEGREES_OF_FREEDOM). The approximation is poor
+        when expected counts are small, so tests whose minimum expected cell
+        count is below min_expected are estimated by Monte Carlo instead,
+        with count tables sampled directly for those phenotypes and pairs
+        only. Both test the upper tail, as mutual information only grows
+        with dependence. Synergy has no asymptotic distribution; its p values are only
+        returned if empirical distributions were created (see simulate).
+        :param min_expected: minimum expected cell count for the G test
+        :param simulations: number of simulations for the other tests; 0
+        to keep the G test p values for all of them
+        :param seed: seed of the random number generator
+        :return: a dictionary of p values, same as p_values
+        """
+        mutualInfo_XYz = mf.MutualInfoXYz(self.observed)
+        observed = mutualInfo_XYz.metrics()
+        N = self.case_N + self.control_N
+        p = dict()
+        for key, df in DEGREES_OF_FREEDOM.items():
+            G = 2 * N * np.log(2) * np.maximum(observed[key], 0)
+            p[key] = stats.chi2.sf(G, df)
+        expected = min_expected_counts(mutualInfo_XYz)
+        small = {key: value < min_expected for key, value in expected.items()}
+        if simulations > 0:
+            rng = np.random.default_rng(seed)
+            diag_prob, phenotype_prob1, phenotype_prob2, _ = \
+                self._null_parameters()
+            for key, phenotype_prob in [('mf_Xz', phenotype_prob1),
+                                        ('mf_Yz', phenotype_prob2)]:
+                if np.any(small[key]):
+                    simulated = simulate_Xz_metrics(
+                        diag_prob, phenotype_prob[small[key]], N,
+                        simulations, rng)
+                    p[key][small[key]] = p_value_estimate(
+                        observed[key][small[key]].reshape([1, -1]),
+                        simulated.T[np.newaxis], 'right')[0]
+            pairwise = [key for key in DEGREES_OF_FREEDOM
+                        if np.ndim(observed[key]) == np.ndim(
+                            observed['mf_XY_z'])]
+            residual = np.any([small[key] for key in pairwise], axis=0)
+            if np.any(residual):
+                pairs = getattr(self.observed, 'pairs', None)
+                if pairs is None:
+                    pairs = np.nonzero(residual)
+                else:
+                    pairs = (pairs[0][residual], pairs[1][residual])
+                logger.info('pairs simulated: {}'.format(len(pairs[0])))
+                simulated = simulate_pair_metrics(
+                    diag_prob, phenotype_prob1[pairs[0]],
+                    phenotype_prob2[pairs[1]], N, simulations, rng)
+                for key in pairwise:
+                    estimated = p_value_estimate(
+                        observed[key][residual].reshape([1, -1]),
+                        simulated[key].T[np.newaxis], 'right')[0]
+                    update = small[key][residual]
+                    p[key][small[key]] = estimated[update]
+        if 'synergy' in self.empirical_distribution:
+            p['synergy'] = self._pairwise_p_value(observed['synergy'],
+                                                  'synergy')
+        return p
+
+    def importance_p_values(self, samples=1000, defensive=0.2,
+                            alternative='two.sided', mask=None, seed=None):
+        """
+        Estimate p values of synergy by importance sampling (see
+        importance_p_values), so that p values far below 1 / samples, as
+        needed after Bonferroni adjustment, can be resolved.
+        :param samples: number of sampled tables per pair
+        :param defensive: fraction of the tables sampled from the null
+        :param alternative: alternative hypothesis
+        :param mask: a boolean array with the shape of the observed synergy,
+        to estimate p values for some pairs only, e.g. the candidates after
+        a first pass; other pairs are NaN
+        :param seed: seed of the random number generator
+        :return: a matrix of p values and a matrix of their standard errors,
+        with the shape of the observed synergy
+        """
+        diag_prob, phenotype_prob1, phenotype_prob2, TOTAL = \
+            self._null_parameters()
+        observed = mf.MutualInfoXYz(self.observed).metrics()['synergy']
+        if mask is None:
+            mask = np.ones(observed.shape, dtype=bool)
+        pairs = getattr(self.observed, 'pairs', None)
+        if pairs is None:
+            pairs = np.nonzero(mask)
+        else:
+            pairs = (pairs[0][mask], pairs[1][mask])
+        p_values = np.full(observed.shape, np.nan)
+        standard_errors = np.full(observed.shape, np.nan)
+        p_values[mask], standard_errors[mask] = importance_p_values(
+            observed[mask], diag_prob, phenotype_prob1[pairs[0]],
+            phenotype_prob2[pairs[1]], TOTAL, samples, defensive,
+            alternative, np.random.default_rng(seed))
+        return p_values, standard_errors
+
+    def library_p_values(self, library, metrics=mf.PAIRWISE_METRICS,
+                         alternative='two.sided', seed=None):
+        """
+        Estimate p values of pairwise metrics from the reference
+        distributions of a null library (null_library.NullLibrary), which
+        are shared by all diseases. Only the grid points that are not in the
+        library yet are simulated.
+        :param library: a NullLibrary
+        :param metrics: pairwise metrics to estimate p values for
+        :param alternative: alternative hypothesis
+        :param seed: seed of the random number generator for missing grid
+        points
+        :return: a dictionary of p values, with the shapes of the observed
+        metrics
+        """
+        diag_prob, phenotype_prob1, phenotype_prob2, TOTAL = \
+            self._null_parameters()
+        observed = mf.MutualInfoXYz(self.observed).metrics()
+        pairs = getattr(self.observed, 'pairs', None)
+        if pairs is None:
+            pairs = np.unravel_index(np.arange(self.observed.M1 *
+                                               self.observed.M2),
+                                     [self.observed.M1, self.observed.M2])
+        p = library.p_values(
+            {metric: observed[metric].ravel() for metric in metrics},
+            diag_prob, phenotype_prob1[pairs[0]], phenotype_prob2[pairs[1]],
+            TOTAL, alternative, np.random.default_rng(seed))
+        return {metric: value.reshape(observed[metric].shape)
+                for metric, value in p.items()}
 
+    def sequential_p_values(self, h=10, max_simulations=10000,
+                            metrics=('synergy',), per_simulation=None,
+                            burn_in=100, batch=100, seed=None):
+        """
+        Estimate p values of pairwise metrics with sequential Monte Carlo
+        (Besag and Clifford, 1991): simulations of a pair stop as soon as h
+        of them are at least as extreme as the observed value, so that the
+        simulations are spent on the pairs with small p values. The count
+        tables of the pairs are sampled directly, as in
+        simulate_count_tables, and only for pairs that have not stopped.
+        :param h: number of extreme simulations to stop at
+        :param max_simulations: maximum number of simulations of a pair
+        :param metrics: pairwise metrics to estimate p values for
+        :param burn_in: number of extra simulations to estimate the centers
+        of the null distributions from (two-sided p values)
+        :param batch: number of simulations sampled at a time
+        :param seed: seed of the random number generator
+        :return: a dictionary of p values and a dictionary of the number of
+        simulations that each p value is based on, with the shape of the
+        observed metrics
+        """
+        diag_prob, phenotype_prob1, phenotype_prob2, TOTAL = \
+            self._null_parameters()
+        if per_simulation is None:
+            per_simulation = TOTAL
+        observed = mf.MutualInfoXYz(self.observed).metrics()
+        pairs = getattr(self.observed, 'pairs', None)
+        if pairs is None:
+            pairs = np.unravel_index(np.arange(self.observed.M1 *
+                                               self.observed.M2),
+                                     [self.observed.M1, self.observed.M2])
+        p, simulations = sequential_p_values(
+            {metric: observed[metric].ravel() for metric in metrics},
+            diag_prob, phenotype_prob1[pairs[0]], phenotype_prob2[pairs[1]],
+            per_simulation, h, max_simulations, burn_in=burn_in,
+            batch=batch, rng=np.random.default_rng(seed))
+        shape = observed[metrics[0]].shape
+        return {metric: value.reshape(shape) for metric, value in p.items()}, \
+               {metric: value.reshape(shape) for metric, value in
+                simulations.items()}
+
+    def permute(self, P1, P2, d, permutations=1000, batch=16, seed=None):
+        """
+        Create empirical distributions by permuting the diagnosis labels of
+        the observed data, instead of simulating independent phenotypes.
+        The permutation null keeps the correlations among phenotypes.
+        p_values can be called afterwards, as after simulate.
+        :param P1: the N x M1 phenotype matrix the observed summary
+        statistics were counted from (dense or scipy.sparse)
+        :param P2: the N x M2 phenotype matrix
+        :param d: the size N diagnosis vector
+        :param permutations: number of permutations
+        :param batch: number of permutations counted at a time
+        :param seed: seed of the random number generator
+        """
+        P1, P2 = self._observed_columns(P1, P2)
+        results = [simulated_metrics(summary) for summary in
+                   permuted_summaries(P1, P2, d, permutations, batch,
+                                      np.random.default_rng(seed))]
+        self.empirical_distribution = {
+            key: np.stack([res[key] for res in results], axis=-1)
+            for key in results[0]}
+
+    def permutation_p_values(self, P1, P2, d, permutations=1000, batch=16,
+                             seed=None, burn_in=100, adjust=None):
+        """
+        Same as permute, but the p values are accumulated while permuting
+        (see simulate_p_values), so the distributions are not kept.
+        :return: a dictionary of p values, same as p_values
+        """
+        P1, P2 = self._observed_columns(P1, P2)
+        self.accumulator = ExceedanceAccumulator(
+            mf.MutualInfoXYz(self.observed).metrics(), burn_in=burn_in,
+            pairs=getattr(self.observed, 'pairs', None))
+        for summary in permuted_summaries(
+                P1, P2, d, permutations + self.accumulator.burn_in, batch,
+                np.random.default_rng(seed)):
+            self.accumulator.update(simulated_metrics(summary))
+        return self._adjust(self.accumulator.p_values(), adjust)
+
+    def _observed_columns(self, P1, P2):
+        # symmetric summaries keep the variables sorted by name, so the
+        # columns are put in the same order before they are counted
+        order = getattr(self.observed, 'order', None)
+        if order is None:
+            return P1, P2
+        return mf._select_columns(P1, order), mf._select_columns(P2, order)
+
+    def _adjust(self, p, adjust):
         if adjust == 'Bonferroni':
-            n_test_X = M1
-            n_test_Y = M2
-            n_test_XY = len(np.triu(synergy))
+            n_test_X = self.m1['set1'].shape[0]
+            n_test_Y = self.m1['set2'].shape[0]
+            # pairs of the same set are counted once, as the packed pairs
+            # of symmetric summaries are
+            n_test_XY = np.size(p['mf_XY_z'])
+            labels = self.observed.vars_labels
+            if np.ndim(p['mf_XY_z']) == 2 and \
+                    np.array_equal(labels['set1'], labels['set2']):
+                n_test_XY = n_test_X * (n_test_X + 1) // 2
 
             p['mf_Xz'] = p['mf_Xz'] * n_test_X
             p['mf_Yz'] = p['mf_Yz'] * n_test_Y
             p['mf_XY_z'] = p['mf_XY_z'] * n_test_XY
             p['mf_XY_given_z'] = p['mf_XY_given_z'] * n_test_XY
-            p['synergy'] = p['synergy'] * n_test_XY
+            if 'synergy' in p:
+                p['synergy'] = p['synergy'] * n_test_XY
             p['mf_XY_omit_z'] = p['mf_XY_omit_z'] * n_test_XY
 
         return p
 
 
+    def _pairwise_p_value(self, observed, key):
+        """
+        Estimate p values of a pairwise metric. Empirical distributions are
+        always simulated for all M1 x M2 pairs; if the observed summary
+        statistics are symmetric (packed pairs), the distributions of the
+        packed pairs are picked out first.
+        """
+        distribution = self.empirical_distribution[key]
+        pairs = getattr(self.observed, 'pairs', None)
+        if pairs is None:
+            return p_value_estimate(observed, distribution, 'two.sided')
+        distribution = distribution[pairs[0], pairs[1]]
+        return p_value_estimate(observed.reshape([1, -1]),
+                                distribution[np.newaxis], 'two.sided')[0]
+
+
+class ExceedanceAccumulator:
+    """
+    Streaming estimate of p values. For every metric, it counts the
+    simulations whose values are at least as extreme as the observed ones,
+    as each simulation arrives, instead of keeping the empirical
+    distributions. The estimates are the same as p_value_estimate on the
+    counted simulations.
+
+    Two-sided p values are measured from the center (mean) of the null
+    distribution, which is not known in advance. Unless it is provided, the
+    first burn_in simulations only update the running means; the center is
+    then fixed to their mean and the following simulations are counted.
+    """
+    def __init__(self, observed, alternative='two.sided', center=None,
+                 burn_in=100, pairs=None):
+        """
+        :param observed: a dictionary of observed metrics, e.g.
+        MutualInfoXYz.metrics()
+        :param alternative: alternative hypothesis
+        :param center: a dictionary of the centers of the null distributions
+        of the metrics, only used for two-sided p values
+        :param burn_in: number of simulations to estimate the centers from,
+        if they are not provided
+        :param pairs: row and column indices of the packed pairs of the
+        observed metrics (SymmetricSummaryXYz.pairs); simulated M1 x M2
+        metrics are reduced to them
+        """
+        if alternative not in ('two.sided', 'left', 'right'):
+            raise ValueError('unknown alternative: {}'.format(alternative))
+        self.observed = {key: np.asarray(value, dtype=np.float64)
+                         for key, value in observed.items()}
+        self.alternative = alternative
+        self.pairs = pairs
+        # simulations counted in exceedances
+        self.n = 0
+        self.exceedances = {key: np.zeros(value.shape, dtype=np.int64)
+                            for key, value in self.observed.items()}
+        # running sums of all simulations, including the burn in
+        self.n_total = 0
+        self.sums = {key: np.zeros(value.shape)
+                     for key, value in self.observed.items()}
+        self.center = None
+        self.burn_in = 0
+        if alternative == 'two.sided':
+            if center is None:
+                self.burn_in = max(burn_in, 1)
+            else:
+                self._set_center(center)
+
+    @property
+    def mean(self):
+        """
+        Running means of the metrics over all simulations
+        """
+        return {key: value / self.n_total for key, value in self.sums.items()}
+
+    def _set_center(self, center):
+        self.center = {key: np.asarray(center[key], dtype=np.float64)
+                       for key in self.observed}
+        distance = {key: np.abs(self.observed[key] - self.center[key])
+                    for key in self.observed}
+        self._lower = {key: self.center[key] - distance[key]
+                       for key in self.observed}
+        self._upper = {key: self.center[key] + distance[key]
+                       for key in self.observed}
+
+    def _select(self, value):
+        if self.pairs is not None and value.ndim == 2:
+            return value[self.pairs[0], self.pairs[1]]
+        return value
+
+    def update(self, simulated):
+        """
+        Count one simulation
+        :param simulated: a dictionary of simulated metrics, e.g. from
+        synergy_random
+        """
+        simulated = {key: self._select(np.asarray(simulated[key]))
+                     for key in self.observed}
+        self.n_total += 1
+        for key, value in simulated.items():
+            self.sums[key] += value
+        if self.alternative == 'two.sided' and self.center is None:
+            if self.n_total >= self.burn_in:
+                self._set_center(self.mean)
+            return
+        self.n += 1
+        for key, value in simulated.items():
+            if self.alternative == 'two.sided':
+                self.exceedances[key] += value <= self._lower[key]
+                self.exceedances[key] += value >= self._upper[key]
+            elif self.alternative == 'left':
+                self.exceedances[key] += value <= self.observed[key]
+            else:
+                self.exceedances[key] += value >= self.observed[key]
+
+    def p_values(self):
+        """
+        :return: a dictionary of p value estimates of the metrics
+        """
+        if self.n == 0:
+            raise ValueError('no simulations were counted')
+        return {key: np.minimum(value / self.n, 1) for key, value in
+                self.exceedances.items()}
+
+    def merge(self, other):
+        """
+        Add the counts of another accumulator, e.g. from another job. Both
+        must measure two-sided p values from the same centers.
+        """
+        if self.alternative != other.alternative or \
+                self.observed.keys() != other.observed.keys():
+            raise ValueError('accumulators of different tests')
+        if self.alternative == 'two.sided':
+            if self.center is None or other.center is None or \
+                    any(not np.array_equal(self.center[key], other.center[key])
+                        for key in self.center):
+                raise ValueError('accumulators with different centers')
+        self.n += other.n
+        self.n_total += other.n_total
+        for key in self.observed:
+            self.exceedances[key] += other.exceedances[key]
+            self.sums[key] += other.sums[key]
+        return self
+
+
 def p_value_estimate(observed, empirical_distribution, alternative='two.sided'):
     """
     Estimate P value of observed synergy scores from the empirical distribution.
@@ -111,11 +536,13 @@ def p_value_estimate(observed, empirical_distribution, alternative='two.sided'):
     ordered = np.sort(empirical_distribution, axis=-1)
     center = np.mean(empirical_distribution, axis=-1)
     if alternative == 'two.sided':
-        return matrix_searchsorted(ordered, center - np.abs(observed - center),
-                                   side='right') / P + \
-               1 - \
-               matrix_searchsorted(ordered, center + np.abs(observed - center),
-                                   side='left') / P
+        # values at the center are counted in both tails
+        return np.minimum(
+            matrix_searchsorted(ordered, center - np.abs(observed - center),
+                                side='right') / P +
+            1 -
+            matrix_searchsorted(ordered, center + np.abs(observed - center),
+                                side='left') / P, 1)
     elif alternative == 'left':
         return matrix_searchsorted(ordered, observed, side='right') / P
     elif alternative == 'right':
@@ -162,8 +589,6 @@ def synergy_random(disease_prevalence, phenotype_prob1, phenotype_prob2,
     mocked_XYz = mf.SummaryXYz(X_names=np.arange(len(phenotype_prob1)),
                         Y_names=np.arange(len(phenotype_prob2)),
                         z_name='mocked')
-    mocked_XY = mf.SummaryXY(X_names=np.arange(len(phenotype_prob1)),
-                        Y_names=np.arange(len(phenotype_prob2)))
     BATCH_SIZE = 100
     M1 = len(phenotype_prob1)
     M2 = len(phenotype_prob2)
@@ -186,9 +611,705 @@ def synergy_random(disease_prevalence, phenotype_prob1, phenotype_prob2,
             actual_batch_size, M2])
         P2 = (P2 < phenotype_prob2.reshape([1, M2])).astype(int)
         mocked_XYz.add_batch(P1, P2, d)
-        mocked_XY.add_batch(P1, P2)
     logger.debug('end simulation {}'.format(seed))
+    return simulated_metrics(mocked_XYz)
+
+
+def _rare_positions(rng, phenotype_prob, sample_size):
+    """
+    Sample the observations that have rare phenotypes, without sampling
+    every observation: the gaps between successive positive observations
+    of a phenotype are geometric.
+    :return: the phenotype and the observation of every positive
+    """
+    M = len(phenotype_prob)
+    if M == 0 or sample_size == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    # phenotypes that never occur are given a dummy probability and dropped
+    absent = phenotype_prob <= 0
+    p = np.where(absent, 1.0, phenotype_prob)
+    expected = sample_size * np.max(np.where(absent, 0.0, p))
+    width = int(np.ceil(expected + 6 * np.sqrt(expected) + 10))
+    positions = np.cumsum(rng.geometric(p[:, np.newaxis], size=[M, width]),
+                          axis=1) - 1
+    phenotypes = [np.nonzero(positions < sample_size)[0]]
+    observations = [positions[positions < sample_size]]
+    # the few phenotypes with more positives than width
+    for j in np.flatnonzero(positions[:, -1] < sample_size):
+        last = positions[j, -1]
+        while last < sample_size:
+            more = last + np.cumsum(rng.geometric(p[j], size=width))
+            kept = more[more < sample_size]
+            phenotypes.append(np.full(len(kept), j))
+            observations.append(kept)
+            last = more[-1]
+    phenotypes = np.concatenate(phenotypes)
+    observations = np.concatenate(observations)
+    present = ~absent[phenotypes]
+    return phenotypes[present], observations[present]
+
+
+def _rare_matrix(rngs, phenotype_prob, sample_size):
+    # rare phenotypes of all replicates as one sparse matrix; row i * R + r is
+    # observation i of replicate r, column r * M + j is phenotype j of
+    # replicate r, so products never mix replicates
+    R = len(rngs)
+    M = len(phenotype_prob)
+    rows = []
+    columns = []
+    for r, rng in enumerate(rngs):
+        phenotypes, observations = _rare_positions(rng, phenotype_prob,
+                                                   sample_size)
+        rows.append(observations * R + r)
+        columns.append(r * M + phenotypes)
+    rows = np.concatenate(rows)
+    return sparse.csr_matrix((np.ones(len(rows)),
+                              (rows, np.concatenate(columns))),
+                             shape=[sample_size * R, R * M])
+
+
+def simulate_summaries(disease_prevalence, phenotype_prob1, phenotype_prob2,
+                       sample_size, rngs, sparse_threshold=0.05, block=1024):
+    """
+    Simulate observations of R replicates at once and count them, the
+    batched version of synergy_random. Every replicate draws from its own
+    random Generator, so a replicate does not depend on the others it is
+    batched with.
+    Phenotypes with a prevalence above sparse_threshold are drawn for blocks
+    of observations of all replicates, and counted with a batched float32
+    matrix product; rare phenotypes are drawn as positions (see
+    _rare_positions) and counted with sparse products.
+    :param disease_prevalence: a scalar representation of the disease prevalence
+    :param phenotype_prob1: a size M1 vector of the prevalence of phenotypes X
+    :param phenotype_prob2: a size M2 vector of the prevalence of phenotypes Y
+    :param sample_size: number of observations of a simulation
+    :param rngs: a list of R numpy random Generators, one per replicate
+    :param sparse_threshold: prevalence up to which phenotypes are rare
+    :param block: number of observations drawn at a time. Float32 counts are
+    exact as long as it is below 2^24.
+    :return: a list of R compact SummaryXYz
+    """
+    phenotype_prob1 = np.asarray(phenotype_prob1, dtype=np.float64)
+    phenotype_prob2 = np.asarray(phenotype_prob2, dtype=np.float64)
+    R = len(rngs)
+    M1 = len(phenotype_prob1)
+    M2 = len(phenotype_prob2)
+    rare1 = np.flatnonzero(phenotype_prob1 <= sparse_threshold)
+    rare2 = np.flatnonzero(phenotype_prob2 <= sparse_threshold)
+    common1 = np.flatnonzero(phenotype_prob1 > sparse_threshold)
+    common2 = np.flatnonzero(phenotype_prob2 > sparse_threshold)
+    threshold1 = phenotype_prob1[common1].astype(np.float32)
+    threshold2 = phenotype_prob2[common2].astype(np.float32)
+
+    # disease status, observations x replicates
+    d = np.stack([rng.random(sample_size) < disease_prevalence
+                  for rng in rngs], axis=1)
+    case_N = np.sum(d, axis=0)
+    S1 = _rare_matrix(rngs, phenotype_prob1[rare1], sample_size)
+    S2 = _rare_matrix(rngs, phenotype_prob2[rare2], sample_size)
+
+    # counts among cases and among all observations
+    xy_case = np.zeros([R, M1, M2])
+    xy_N = np.zeros([R, M1, M2])
+    x_case = np.zeros([R, M1])
+    x_N = np.zeros([R, M1])
+    y_case = np.zeros([R, M2])
+    y_N = np.zeros([R, M2])
 
+    # rare x rare
+    dS1 = S1.multiply(d.reshape([-1, 1])).tocsr()
+    for counts, product in [(xy_case, dS1.T @ S2), (xy_N, S1.T @ S2)]:
+        product = product.tocoo()
+        replicate, j = np.divmod(product.row, max(len(rare1), 1))
+        counts[replicate, rare1[j], rare2[product.col % len(rare2)]] = \
+            product.data
+    x_case[:, rare1] = np.asarray(dS1.sum(axis=0)).reshape([R, -1])
+    x_N[:, rare1] = np.asarray(S1.sum(axis=0)).reshape([R, -1])
+    y_case[:, rare2] = np.asarray(
+        S2.multiply(d.reshape([-1, 1])).sum(axis=0)).reshape([R, -1])
+    y_N[:, rare2] = np.asarray(S2.sum(axis=0)).reshape([R, -1])
+
+    for start in range(0, sample_size, block):
+        end = min(start + block, sample_size)
+        n = end - start
+        # n x R x M bits of the common phenotypes
+        X = np.stack([rng.random([n, len(common1)], dtype=np.float32)
+                      for rng in rngs], axis=1) < threshold1
+        Y = np.stack([rng.random([n, len(common2)], dtype=np.float32)
+                      for rng in rngs], axis=1) < threshold2
+        X = X.astype(np.float32)
+        Y = Y.astype(np.float32)
+        z = d[start:end].astype(np.float32)[:, :, np.newaxis]
+        Xz = X * z
+        Yz = Y * z
+        # common x common, batched over replicates
+        Xr = X.transpose([1, 2, 0])
+        xy_case[:, common1[:, np.newaxis], common2] += \
+            np.matmul(Xz.transpose([1, 2, 0]), Y.transpose([1, 0, 2]))
+        xy_N[:, common1[:, np.newaxis], common2] += \
+            np.matmul(Xr, Y.transpose([1, 0, 2]))
+        x_case[:, common1] += np.sum(Xz, axis=0)
+        x_N[:, common1] += np.sum(X, axis=0)
+        y_case[:, common2] += np.sum(Yz, axis=0)
+        y_N[:, common2] += np.sum(Y, axis=0)
+        # rare x common and common x rare
+        rows = slice(start * R, end * R)
+        S1_block = S1[rows].T
+        S2_block = S2[rows].T
+        xy_case[:, rare1[:, np.newaxis], common2] += \
+            (S1_block @ Yz.reshape([n * R, -1])).reshape([R, len(rare1), -1])
+        xy_N[:, rare1[:, np.newaxis], common2] += \
+            (S1_block @ Y.reshape([n * R, -1])).reshape([R, len(rare1), -1])
+        xy_case[:, common1[:, np.newaxis], rare2] += \
+            (S2_block @ Xz.reshape([n * R, -1])).reshape(
+                [R, len(rare2), -1]).transpose([0, 2, 1])
+        xy_N[:, common1[:, np.newaxis], rare2] += \
+            (S2_block @ X.reshape([n * R, -1])).reshape(
+                [R, len(rare2), -1]).transpose([0, 2, 1])
+
+    summaries = []
+    for r in range(R):
+        summary = mf.SummaryXYz(X_names=np.arange(M1), Y_names=np.arange(M2),
+                                z_name='mocked', compact=True)
+        control_N = sample_size - int(case_N[r])
+        summary.m1['set1'] = _Xz_counts(x_case[r], x_N[r], int(case_N[r]),
+                                        control_N)
+        summary.m1['set2'] = _Xz_counts(y_case[r], y_N[r], int(case_N[r]),
+                                        control_N)
+        summary.m2_compact = np.stack([xy_case[r], xy_N[r] - xy_case[r]],
+                                      axis=-1).astype(mf.COMPACT_DTYPE)
+        summary.case_N = int(case_N[r])
+        summary.control_N = control_N
+        summary.version += 1
+        summaries.append(summary)
+    return summaries
+
+
+def synergy_random_batched(disease_prevalence, phenotype_prob1,
+                           phenotype_prob2, sample_size, seeds, batch=32):
+    """
+    Simulate replicates with simulate_summaries, batch replicates at a time.
+    :param seeds: random seeds, one per replicate
+    :return: a dictionary of metrics, as synergy_random, with the replicates
+    in the last dimension
+    """
+    results = []
+    for start in range(0, len(seeds), batch):
+        rngs = [np.random.default_rng(seed)
+                for seed in seeds[start:start + batch]]
+        for summary in simulate_summaries(disease_prevalence, phenotype_prob1,
+                                          phenotype_prob2, sample_size, rngs):
+            results.append(simulated_metrics(summary))
+    return {key: np.stack([res[key] for res in results], axis=-1)
+            for key in results[0]}
+
+
+def synergy_random_bits(disease_prevalence, phenotype_prob1, phenotype_prob2,
+                        sample_size, seed=None):
+    """
+    Same as synergy_random, with the kernel of simulate_summaries for one
+    replicate.
+    """
+    return {key: value[..., 0] for key, value in synergy_random_batched(
+        disease_prevalence, phenotype_prob1, phenotype_prob2, sample_size,
+        [seed]).items()}
+
+
+def simulate_count_tables(disease_prevalence, phenotype_prob1,
+                          phenotype_prob2, sample_size, rng):
+    """
+    Sample the summary statistics of a simulation directly, without
+    simulating individual observations. Under the null, z, every x and every
+    y are independent Bernoulli variables, so:
+    the count of z is Binomial(N, prevalence);
+    the counts of x among cases and among controls are Binomial(case_N, p_x)
+    and Binomial(control_N, p_x), and similarly for y;
+    given those counts, the count of xy among cases (or controls) is
+    hypergeometric, as x and y are independent within them.
+    The cost does not depend on the sample size.
+    :param disease_prevalence: a scalar representation of the disease prevalence
+    :param phenotype_prob1: a size M1 vector of the prevalence of phenotypes X
+    :param phenotype_prob2: a size M2 vector of the prevalence of phenotypes Y
+    :param sample_size: number of observations of a simulation
+    :param rng: a numpy random Generator
+    :return: a compact SummaryXYz
+    """
+    phenotype_prob1 = np.asarray(phenotype_prob1, dtype=np.float64)
+    phenotype_prob2 = np.asarray(phenotype_prob2, dtype=np.float64)
+    M1 = len(phenotype_prob1)
+    M2 = len(phenotype_prob2)
+    summary = mf.SummaryXYz(X_names=np.arange(M1), Y_names=np.arange(M2),
+                            z_name='mocked', compact=True)
+    case_N = int(rng.binomial(sample_size, disease_prevalence))
+    control_N = sample_size - case_N
+    # counts of x+ (y+) among cases and among controls
+    x_case = rng.binomial(case_N, phenotype_prob1)
+    x_control = rng.binomial(control_N, phenotype_prob1)
+    y_case = rng.binomial(case_N, phenotype_prob2)
+    y_control = rng.binomial(control_N, phenotype_prob2)
+    # counts of x+y+ among cases (+++) and among controls (++-)
+    xy_case = rng.hypergeometric(x_case[:, np.newaxis],
+                                 case_N - x_case[:, np.newaxis],
+                                 np.broadcast_to(y_case, [M1, M2]))
+    xy_control = rng.hypergeometric(x_control[:, np.newaxis],
+                                    control_N - x_control[:, np.newaxis],
+                                    np.broadcast_to(y_control, [M1, M2]))
+    summary.m1['set1'] = _Xz_counts(x_case, x_case + x_control, case_N,
+                                    control_N)
+    summary.m1['set2'] = _Xz_counts(y_case, y_case + y_control, case_N,
+                                    control_N)
+    summary.m2_compact = np.stack([xy_case, xy_control],
+                                  axis=-1).astype(mf.COMPACT_DTYPE)
+    summary.case_N = case_N
+    summary.control_N = control_N
+    summary.version += 1
+    return summary
+
+
+def synergy_random_tables(disease_prevalence, phenotype_prob1,
+                          phenotype_prob2, sample_size, seed=None):
+    """
+    Same as synergy_random, but the summary statistics are sampled directly
+    with simulate_count_tables instead of counting simulated observations.
+    """
+    rng = np.random.default_rng(seed)
+    summary = simulate_count_tables(disease_prevalence, phenotype_prob1,
+                                    phenotype_prob2, sample_size, rng)
+    return simulated_metrics(summary)
+
+
+def min_expected_counts(mutualInfo_XYz):
+    """
+    Minimum expected cell counts of the tests of independence behind each
+    mutual information metric, i.e. the smallest product of marginal counts
+    divided by the total (per stratum of z for mf_XY_given_z). Strata
+    without observations do not contribute.
+    :param mutualInfo_XYz: a MutualInfoXYz instance
+    :return: a dictionary of metric name to the minimum expected count of
+    each test, with the shapes of the metrics
+    """
+    z = np.array([mutualInfo_XYz.case_N, mutualInfo_XYz.control_N],
+                 dtype=np.float64)
+    N = np.sum(z)
+    expected = dict()
+    for key, set_name in [('mf_Xz', 'set1'), ('mf_Yz', 'set2')]:
+        x, _ = mf._marginals_XY(np.asarray(mutualInfo_XYz.m1[set_name],
+                                           dtype=np.float64))
+        expected[key] = np.min(x, axis=-1) * np.min(z) / N
+    xyz = np.asarray(mutualInfo_XYz.m2, dtype=np.float64)
+    xy, xz, yz = mf._marginals_XYz(xyz)
+    x, y = mf._marginals_XY(xy)
+    expected['mf_XY_omit_z'] = np.min(x, axis=-1) * np.min(y, axis=-1) / N
+    expected['mf_XY_z'] = np.min(xy, axis=-1) * np.min(z) / N
+    # within the cases (column 0 and 2 of xz) and the controls (1 and 3)
+    strata = []
+    for k in range(2):
+        if z[k] > 0:
+            strata.append(np.minimum(xz[..., k], xz[..., k + 2]) *
+                          np.minimum(yz[..., k], yz[..., k + 2]) / z[k])
+    expected['mf_XY_given_z'] = np.min(strata, axis=0)
+    return expected
+
+
+def simulate_Xz_metrics(disease_prevalence, phenotype_prob, sample_size,
+                        size, rng):
+    """
+    Sample the mutual information between phenotypes and the diagnosis
+    under the null, with the xz count tables sampled directly.
+    :return: a size x M matrix
+    """
+    case_N = rng.binomial(sample_size, disease_prevalence,
+                          [size, 1]).astype(np.int64)
+    control_N = sample_size - case_N
+    shape = [size, len(phenotype_prob)]
+    x_case = rng.binomial(case_N, phenotype_prob, shape)
+    x_control = rng.binomial(control_N, phenotype_prob, shape)
+    return mf.mf_Xz_from_entropies(
+        np.stack([x_case, x_control, case_N - x_case, control_N - x_control],
+                 axis=-1), np.stack([case_N, control_N], axis=-1))
+
+
+def table_metrics(xyz):
+    """
+    Pairwise metrics of a stack of count tables, e.g. one table per pair
+    and simulation
+    :param xyz: counts of xyz (+++, ++-, +-+, +--, -++, -+-, --+, ---) in
+    the last dimension; all tables have the same total
+    :return: a dictionary of the PAIRWISE_METRICS, with the leading
+    dimensions of xyz
+    """
+    summary_z = np.stack([np.sum(xyz[..., 0::2], axis=-1),
+                          np.sum(xyz[..., 1::2], axis=-1)], axis=-1)
+    values = mf.pairwise_metrics(xyz, summary_z)
+    _, xz, yz = mf._marginals_XYz(xyz)
+    values['synergy'] = values['mf_XY_z'] - \
+        mf.mf_Xz_from_entropies(xz, summary_z) - \
+        mf.mf_Xz_from_entropies(yz, summary_z)
+    return values
+
+
+def simulate_pair_metrics(disease_prevalence, pair_prob1, pair_prob2,
+                          sample_size, size, rng, block=2**22):
+    """
+    Sample the pairwise metrics of a list of pairs under the null, with the
+    count tables sampled directly as in simulate_count_tables. The tables of
+    every pair are sampled independently, so the metrics of a pair follow
+    the null distribution, but pairs sharing a phenotype are not
+    correlated as they are in one simulation of all phenotypes.
+    :param pair_prob1: a size K vector of the prevalence of x of each pair
+    :param pair_prob2: a size K vector of the prevalence of y of each pair
+    :param sample_size: number of observations of a simulation
+    :param size: number of simulations
+    :param rng: a numpy random Generator
+    :param block: maximum number of tables sampled at a time
+    :return: a dictionary of the PAIRWISE_METRICS, each size x K
+    """
+    K = len(pair_prob1)
+    values = {metric: np.empty([size, K]) for metric in mf.PAIRWISE_METRICS}
+    step = max(1, block // max(size, 1))
+    for start in range(0, K, step):
+        pairs = slice(start, min(start + step, K))
+        case_N = rng.binomial(sample_size, disease_prevalence,
+                              [size, 1]).astype(np.int64)
+        control_N = sample_size - case_N
+        shape = [size, len(pair_prob1[pairs])]
+        x_case = rng.binomial(case_N, pair_prob1[pairs], shape)
+        x_control = rng.binomial(control_N, pair_prob1[pairs], shape)
+        y_case = rng.binomial(case_N, pair_prob2[pairs], shape)
+        y_control = rng.binomial(control_N, pair_prob2[pairs], shape)
+        xy_case = rng.hypergeometric(x_case, case_N - x_case, y_case)
+        xy_control = rng.hypergeometric(x_control, control_N - x_control,
+                                        y_control)
+        xyz = np.stack([xy_case, xy_control,
+                        x_case - xy_case, x_control - xy_control,
+                        y_case - xy_case, y_control - xy_control,
+                        case_N - x_case - y_case + xy_case,
+                        control_N - x_control - y_control + xy_control],
+                       axis=-1)
+        block_values = table_metrics(xyz)
+        for metric in mf.PAIRWISE_METRICS:
+            values[metric][:, pairs] = block_values[metric]
+    return values
+
+
+def null_cell_probabilities(disease_prevalence, pair_prob1, pair_prob2):
+    """
+    Probabilities of the cells of xyz (+++, ++-, +-+, +--, -++, -+-, --+,
+    ---) when x, y and z are independent
+    :return: a K x 8 matrix, one row per pair
+    """
+    px = np.stack([pair_prob1, 1 - pair_prob1], axis=-1)
+    py = np.stack([pair_prob2, 1 - pair_prob2], axis=-1)
+    pz = np.array([disease_prevalence, 1 - disease_prevalence])
+    return (px[:, :, np.newaxis, np.newaxis] *
+            py[:, np.newaxis, :, np.newaxis] *
+            pz).reshape([-1, 8])
+
+
+def synergy_contrast(disease_prevalence):
+    """
+    Direction in which the log probabilities of the cells of xyz are tilted
+    to make synergy large: the association of x and y increases among
+    cases and decreases among controls, weighted by the prevalence so that
+    the association regardless of z does not change. Asymptotically,
+    2 * N * ln(2) * synergy under the null is the square of the normalized
+    count along this direction (a chi-square with 1 degree of freedom).
+    :return: a vector over the cells (+++, ++-, +-+, +--, -++, -+-, --+, ---)
+    """
+    # +1 if x and y agree, -1 otherwise, for the cells of xy (++, +-, -+, --)
+    agreement = np.array([1, -1, -1, 1])
+    contrast = np.zeros(8)
+    contrast[0::2] = agreement * (1 - disease_prevalence)
+    contrast[1::2] = -agreement * disease_prevalence
+    return contrast
+
+
+def tilted_cell_probabilities(p0, contrast, t):
+    """
+    Exponentially tilted cell probabilities, p0 * exp(t * contrast),
+    normalized
+    :param p0: a K x 8 matrix of cell probabilities
+    :param t: a size K vector of tilts
+    """
+    tilted = p0 * np.exp(np.asarray(t)[:, np.newaxis] * contrast)
+    return tilted / np.sum(tilted, axis=-1, keepdims=True)
+
+
+def _synergy_tilt(p0, contrast, target, iterations=50):
+    # the tilt of each pair at which the synergy of the cell probabilities
+    # reaches the target, found by bisection; synergy grows with |t|
+    def synergy(t):
+        return table_metrics(tilted_cell_probabilities(p0, contrast,
+                                                       t))['synergy']
+    lower = np.zeros(len(p0))
+    upper = np.ones(len(p0))
+    for _ in range(30):
+        below = synergy(upper) < target
+        if not np.any(below):
+            break
+        upper = np.where(below, 2 * upper, upper)
+    for _ in range(iterations):
+        middle = (lower + upper) / 2
+        below = synergy(middle) < target
+        lower = np.where(below, middle, lower)
+        upper = np.where(below, upper, middle)
+    return np.where(target > 0, (lower + upper) / 2, 0)
+
+
+def importance_p_values(observed, disease_prevalence, pair_prob1,
+                        pair_prob2, sample_size, samples=1000, defensive=0.2,
+                        alternative='two.sided', rng=None, block=2**22):
+    """
+    Importance sampling estimates of p values of synergy under the null,
+    where the count table of a pair is Multinomial(N, p0) with the cell
+    probabilities p0 of independent x, y and z. Simulating the null
+    directly cannot resolve p values below 1 / simulations. Instead, tables
+    are sampled from a mixture of the null (the defensive fraction) and of
+    the null tilted along synergy_contrast in both directions, by as much
+    as needed for the synergy of the cell probabilities to reach the
+    observed extreme. About half of the tilted tables are then as extreme as
+    the observed one however small the p value is. Each table is weighted
+    by the likelihood ratio of the null to the mixture, which is bounded by
+    1 / defensive. The center of a two-sided test is the weighted mean of
+    the tables, an estimate of the null mean.
+    :param observed: a size K vector of observed synergy of the pairs
+    :param disease_prevalence, pair_prob1, pair_prob2, sample_size: see
+    simulate_pair_metrics
+    :param samples: number of tables sampled per pair
+    :param defensive: fraction of the tables sampled from the null
+    :param alternative: alternative hypothesis
+    :param rng: a numpy random Generator
+    :param block: maximum number of tables sampled at a time
+    :return: a vector of p values and a vector of their standard errors
+    """
+    if alternative not in ('two.sided', 'left', 'right'):
+        raise ValueError('unknown alternative: {}'.format(alternative))
+    if rng is None:
+        rng = np.random.default_rng()
+    observed = np.asarray(observed, dtype=np.float64)
+    K = len(observed)
+    p0 = null_cell_probabilities(disease_prevalence,
+                                 np.asarray(pair_prob1, dtype=np.float64),
+                                 np.asarray(pair_prob2, dtype=np.float64))
+    contrast = synergy_contrast(disease_prevalence)
+    # the null mean of synergy, asymptotically (chi-square with 1 degree of
+    # freedom), only used to choose the tilt
+    approximate_center = 1 / (2 * sample_size * np.log(2))
+    if alternative == 'two.sided':
+        target = approximate_center + np.abs(observed - approximate_center)
+    elif alternative == 'right':
+        target = observed
+    else:
+        # tables with synergy below its null mean are not far from the null
+        target = np.zeros(K)
+    t = _synergy_tilt(p0, contrast, target)
+    from_null = int(round(defensive * samples))
+    if defensive > 0:
+        from_null = max(from_null, 1)
+    from_tilted = (samples - from_null) // 2
+    fractions = np.array([from_null, from_tilted,
+                          samples - from_null - from_tilted]) / samples
+    p = np.zeros(K)
+    se = np.zeros(K)
+    step = max(1, block // samples)
+    for start in range(0, K, step):
+        pairs = slice(start, min(start + step, K))
+        k = len(p0[pairs])
+        proposals = [p0[pairs],
+                     tilted_cell_probabilities(p0[pairs], contrast, t[pairs]),
+                     tilted_cell_probabilities(p0[pairs], contrast,
+                                               -t[pairs])]
+        tables = np.concatenate([
+            rng.multinomial(sample_size, proposal, size=[size, k])
+            for proposal, size in zip(proposals, [from_null, from_tilted,
+                                                  samples - from_null -
+                                                  from_tilted])])
+        # likelihood ratio of the mixture to the null
+        mixture = np.zeros(tables.shape[:-1])
+        with np.errstate(over='ignore'):
+            for proposal, fraction in zip(proposals, fractions):
+                log_ratio = np.log(proposal) - np.log(p0[pairs])
+                mixture += fraction * np.exp(np.sum(tables * log_ratio,
+                                                    axis=-1))
+        weights = 1 / mixture
+        values = table_metrics(tables)['synergy']
+        value = observed[pairs]
+        if alternative == 'two.sided':
+            center = np.mean(weights * values, axis=0)
+            distance = np.abs(value - center)
+            extreme = (values <= center - distance) | \
+                      (values >= center + distance)
+        elif alternative == 'left':
+            extreme = values <= value
+        else:
+            extreme = values >= value
+        weighted = weights * extreme
+        p[pairs] = np.minimum(np.mean(weighted, axis=0), 1)
+        se[pairs] = np.std(weighted, axis=0) / np.sqrt(samples)
+    return p, se
+
+
+def sequential_p_values(observed, disease_prevalence, pair_prob1,
+                        pair_prob2, sample_size, h=10, max_simulations=10000,
+                        alternative='two.sided', center=None, burn_in=100,
+                        batch=100, rng=None):
+    """
+    Sequential Monte Carlo p values (Besag and Clifford, 1991) of pairwise
+    metrics. Every pair is simulated until h simulations are at least as
+    extreme as the observed value, or max_simulations is reached. If it
+    stops after L simulations, the p value is h / L; otherwise it is
+    (k + 1) / (max_simulations + 1), where k is the number of extreme
+    simulations. Pairs stay in the simulation while any of their metrics
+    has not stopped.
+    :param observed: a dictionary of observed pairwise metrics, each a size
+    K vector
+    :param pair_prob1, pair_prob2, sample_size: see simulate_pair_metrics
+    :param h: number of extreme simulations to stop at
+    :param max_simulations: maximum number of simulations of a pair
+    :param alternative: alternative hypothesis
+    :param center: a dictionary of the centers of the null distributions,
+    for two-sided p values. If not provided, they are the means of burn_in
+    simulations, which are not counted.
+    :param batch: number of simulations sampled at a time
+    :param rng: a numpy random Generator
+    :return: a dictionary of p values and a dictionary of the number of
+    simulations that each p value is based on
+    """
+    if alternative not in ('two.sided', 'left', 'right'):
+        raise ValueError('unknown alternative: {}'.format(alternative))
+    if rng is None:
+        rng = np.random.default_rng()
+    pair_prob1 = np.asarray(pair_prob1, dtype=np.float64)
+    pair_prob2 = np.asarray(pair_prob2, dtype=np.float64)
+    K = len(pair_prob1)
+    if alternative == 'two.sided':
+        if center is None:
+            simulated = simulate_pair_metrics(disease_prevalence, pair_prob1,
+                                              pair_prob2, sample_size,
+                                              max(burn_in, 1), rng)
+            center = {metric: np.mean(simulated[metric], axis=0)
+                      for metric in observed}
+        lower = {metric: center[metric] - np.abs(value - center[metric])
+                 for metric, value in observed.items()}
+        upper = {metric: center[metric] + np.abs(value - center[metric])
+                 for metric, value in observed.items()}
+
+    def is_extreme(metric, values, pairs):
+        if alternative == 'two.sided':
+            return (values <= lower[metric][pairs]) | \
+                   (values >= upper[metric][pairs])
+        elif alternative == 'left':
+            return values <= observed[metric][pairs]
+        return values >= observed[metric][pairs]
+
+    exceedances = {metric: np.zeros(K, dtype=np.int64) for metric in observed}
+    simulations = {metric: np.zeros(K, dtype=np.int64) for metric in observed}
+    stopped = {metric: np.zeros(K, dtype=bool) for metric in observed}
+    done = 0
+    active = np.arange(K)
+    while len(active) > 0 and done < max_simulations:
+        size = min(batch, max_simulations - done)
+        simulated = simulate_pair_metrics(disease_prevalence,
+                                          pair_prob1[active],
+                                          pair_prob2[active], sample_size,
+                                          size, rng)
+        for metric in observed:
+            live = active[~stopped[metric][active]]
+            values = simulated[metric][:, ~stopped[metric][active]]
+            cumulative = np.cumsum(is_extreme(metric, values, live), axis=0) + \
+                exceedances[metric][live]
+            reached = cumulative >= h
+            hit = reached.any(axis=0)
+            first = np.argmax(reached, axis=0)
+            simulations[metric][live] = np.where(hit, done + first + 1,
+                                                 done + size)
+            exceedances[metric][live] = np.where(hit, h, cumulative[-1])
+            stopped[metric][live[hit]] = True
+        done += size
+        active = active[~np.all([stopped[metric][active]
+                                 for metric in observed], axis=0)]
+        logger.debug('simulations: {}, pairs left: {}'.format(done,
+                                                               len(active)))
+    p = {}
+    for metric in observed:
+        p[metric] = np.where(stopped[metric],
+                             exceedances[metric] / np.maximum(
+                                 simulations[metric], 1),
+                             (exceedances[metric] + 1) /
+                             (simulations[metric] + 1))
+    return p, simulations
+
+
+def permuted_summaries(P1, P2, d, permutations, batch=16, rng=None):
+    """
+    Summary statistics of the observed phenotypes with randomly permuted
+    diagnosis labels. Only the counts that involve z change under a
+    permutation: the x+z+ and y+z+ counts of all permutations of a batch are
+    counted with one GEMM against the N x batch matrix of permuted labels,
+    and the x+y+z+ counts with a batched matrix product over the case rows
+    of each permutation. The counts of xy regardless of z are counted once.
+    :param P1: a N x M1 phenotype matrix (dense or scipy.sparse)
+    :param P2: a N x M2 phenotype matrix (dense or scipy.sparse)
+    :param d: a size N vector of diagnosis labels (0 or 1)
+    :param permutations: number of permutations
+    :param batch: number of permutations counted at a time
+    :param rng: a numpy random Generator
+    :return: a generator of compact SummaryXYz, one per permutation
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    N, M1 = P1.shape
+    M2 = P2.shape[1]
+    d = np.asarray(d).reshape(N)
+    case_N = int(np.count_nonzero(d))
+    control_N = N - case_N
+    workspace = mf.Workspace()
+    everyone = np.ones(N, dtype=bool)
+    X = mf._select_rows(P1, everyone, 'X', workspace)
+    Y = mf._select_rows(P2, everyone, 'Y', workspace)
+    x_N = mf._column_sums(X)
+    y_N = mf._column_sums(Y)
+    xy_N = mf._cross_counts(X, Y, workspace).copy()
+    is_sparse = sparse.issparse(X) or sparse.issparse(Y)
+    for start in range(0, permutations, batch):
+        B = min(batch, permutations - start)
+        # rows that are cases after each permutation
+        cases = np.stack([rng.permutation(N)[:case_N] for _ in range(B)])
+        Z = np.zeros([N, B])
+        Z[cases, np.arange(B)[:, np.newaxis]] = 1
+        x_case = np.asarray(X.T @ Z).T
+        y_case = np.asarray(Y.T @ Z).T
+        if is_sparse:
+            xy_case = np.stack([mf._cross_counts(X[rows], Y[rows], workspace)
+                                for rows in cases])
+        else:
+            xy_case = np.matmul(X[cases].transpose(0, 2, 1), Y[cases])
+        for b in range(B):
+            summary = mf.SummaryXYz(X_names=np.arange(M1),
+                                    Y_names=np.arange(M2),
+                                    z_name='permuted', compact=True)
+            summary.m1['set1'] = _Xz_counts(x_case[b], x_N, case_N, control_N)
+            summary.m1['set2'] = _Xz_counts(y_case[b], y_N, case_N, control_N)
+            summary.m2_compact = np.stack([xy_case[b], xy_N - xy_case[b]],
+                                          axis=-1).astype(mf.COMPACT_DTYPE)
+            summary.case_N = case_N
+            summary.control_N = control_N
+            summary.version += 1
+            yield summary
+
+
+def _Xz_counts(x_case, x_N, case_N, control_N):
+    # counts of xz (++, +-, -+, --) from the counts of x+ among cases and
+    # among everyone
+    x_control = x_N - x_case
+    return np.stack([x_case, x_control, case_N - x_case,
+                     control_N - x_control], axis=-1).astype(mf.COMPACT_DTYPE)
+
+
+def simulated_metrics(summary):
+    """
+    Mutual information metrics of simulated summary statistics.
+    """
     # we need to retrieve the following information from our simulation:
     # mutual information without considering diagnosis
     # mutual information between X and z
@@ -196,10 +1317,11 @@ def synergy_random(disease_prevalence, phenotype_prob1, phenotype_prob2,
     # mutual information between XY and z
     # conditional mutual information between XY and z
     # synergy between XY for z
+    # all metrics come from one pass over the xyz counts; the counts of xy
+    # regardless of z are their sums over z
     results_to_return = dict()
-    results_to_return['mf_XY_omit_z'] = mf.MutualInfoXY(mocked_XY).mf()
-
-    mutualInfoXYz = mf.MutualInfoXYz(mocked_XYz)
+    mutualInfoXYz = mf.MutualInfoXYz(summary)
+    results_to_return['mf_XY_omit_z'] = mutualInfoXYz.mutual_info_XY_omit_z()
     results_to_return['mf_Xz'] = mutualInfoXYz.mutual_info_Xz()
     results_to_return['mf_Yz'] = mutualInfoXYz.mutual_info_Yz()
     results_to_return['mf_XY_z'] = mutualInfoXYz.mutual_info_XY_z()
@@ -211,7 +1333,9 @@ def synergy_random(disease_prevalence, phenotype_prob1, phenotype_prob2,
 
 def create_empirical_distribution(diag_prevalence, phenotype_prob1,
                                    phenotype_prob2, sample_per_simulation,
-                                   SIMULATION_SIZE, cpu=None, job_id=0):
+                                   SIMULATION_SIZE, cpu=None, job_id=0,
+                                   method='bernoulli', first=0, last=None,
+                                   pool=None):
     """
     Create empirical distributions for each phenotype pair.
     :param diag_case_prob: a scalar for the prevalence of the diagnosis under
@@ -220,37 +1344,205 @@ def create_empirical_distribution(diag_prevalence, phenotype_prob1,
     under study
     :param sample_per_simulation: number of samples for each simulation
     :param SIMULATION_SIZE: total simulations
+    :param method: 'bernoulli' to simulate every observation and count them,
+    or 'multinomial' to sample the count tables directly (see
+    simulate_count_tables), which is independent of the sample size, or
+    'batched' to simulate observations of many replicates at once (see
+    simulate_summaries)
+    :param first, last: only run simulations first to last - 1 of the
+    SIMULATION_SIZE simulations of the job, e.g. to resume a job in chunks;
+    the random seeds stay the same
+    :param pool: a SimulationPool to run the simulations in; if None, a
+    pool of cpu workers is created for this call
     :return: a M x M x SIMULATION_SIZE matrix for the empirical distributions
     """
+    if pool is not None:
+        return pool.create_empirical_distribution(
+            diag_prevalence, phenotype_prob1, phenotype_prob2,
+            sample_per_simulation, SIMULATION_SIZE, job_id, method, first,
+            last)
+    with SimulationPool(cpu) as pool:
+        return pool.create_empirical_distribution(
+            diag_prevalence, phenotype_prob1, phenotype_prob2,
+            sample_per_simulation, SIMULATION_SIZE, job_id, method, first,
+            last)
+
+
+def _simulation_function(method):
+    if method == 'bernoulli':
+        return synergy_random
+    elif method == 'multinomial':
+        return synergy_random_tables
+    elif method == 'batched':
+        return synergy_random_bits
+    raise ValueError('unknown simulation method: {}'.format(method))
+
+
+class SimulationPool:
+    """
+    A pool of worker processes that is kept for many calls, e.g. for all
+    diseases, to create empirical distributions. Simulations are submitted
+    in chunks, and workers write the metrics of every simulation directly
+    into output slabs in shared memory (.npy files in /dev/shm, mapped by
+    the parent and the workers), so results are neither pickled back nor
+    stacked. If /dev/shm is too small for the slabs, they are written to
+    the temporary directory instead. The slab files are unlinked as soon as they are filled; the
+    memory is released when the returned arrays are garbage collected.
+    Use as a context manager, or call close.
+    """
+    def __init__(self, cpu=None):
+        """
+        :param cpu: number of worker processes, default to the number of
+        CPUs
+        """
+        if cpu is None:
+            cpu = os.cpu_count()
+        self.cpu = cpu
+        self._pool = multiprocessing.Pool(cpu)
+        logger.info('number of workers created: {}'.format(cpu))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def create_empirical_distribution(self, diag_prevalence, phenotype_prob1,
+                                      phenotype_prob2, sample_per_simulation,
+                                      SIMULATION_SIZE, job_id=0,
+                                      method='bernoulli', first=0, last=None,
+                                      chunksize=None):
+        """
+        Same as the create_empirical_distribution function, with the
+        workers of this pool.
+        :param chunksize: number of simulations per task, default to about
+        four tasks per worker
+        """
+        # fail early for an unknown method
+        _simulation_function(method)
+        if last is None:
+            last = SIMULATION_SIZE
+        P = last - first
+        M1 = len(phenotype_prob1)
+        M2 = len(phenotype_prob2)
+        shapes = {'mf_XY_omit_z': [M1, M2], 'mf_Xz': [M1], 'mf_Yz': [M2],
+                  'mf_XY_z': [M1, M2], 'mf_XY_given_z': [M1, M2],
+                  'synergy': [M1, M2]}
+        if chunksize is None:
+            chunksize = max(1, int(np.ceil(P / (4 * self.cpu))))
+        # data and a margin for the header of every slab
+        size = sum(8 * int(np.prod(shape)) * P + 4096
+                   for shape in shapes.values())
+        directory = _slab_directory(size)
+        slabs = dict()
+        empirical_distributions = dict()
+        try:
+            for key, shape in shapes.items():
+                handle, path = tempfile.mkstemp(suffix='.npy', dir=directory)
+                os.close(handle)
+                slabs[key] = path
+                empirical_distributions[key] = np.lib.format.open_memmap(
+                    path, mode='w+', dtype=np.float64, shape=tuple(shape) +
+                    (P,))
+                _reserve(path)
+            parameters = (diag_prevalence, phenotype_prob1, phenotype_prob2,
+                          sample_per_simulation)
+            tasks = [(slabs, method, parameters,
+                      [int(i + job_id * SIMULATION_SIZE)
+                       for i in range(start, min(start + chunksize, last))],
+                      start - first)
+                     for start in range(first, last, chunksize)]
+            done = sum(self._pool.starmap(_simulate_into_slabs, tasks))
+            assert(done == P)
+        finally:
+            for path in slabs.values():
+                os.unlink(path)
+        return {key: value.view(np.ndarray)
+                for key, value in empirical_distributions.items()}
+
+
+def _slab_directory(size, candidates=('/dev/shm', None)):
+    """
+    Directory of output slabs with room for size bytes. Writing past the
+    capacity of a file system through a memory map kills the writer with
+    SIGBUS instead of raising, so the space is checked first.
+    :param candidates: directories in order of preference; None is the
+    temporary directory
+    :return: a directory
+    """
+    for directory in candidates:
+        if directory is None:
+            directory = tempfile.gettempdir()
+        if not os.path.isdir(directory):
+            continue
+        stats = os.statvfs(directory)
+        if stats.f_bavail * stats.f_frsize >= size:
+            return directory
+        logger.info('not enough space for output slabs in {}'.format(
+            directory))
+    raise OSError('no directory with {} bytes free for output slabs'.format(
+        size))
+
+
+def _reserve(path):
+    # allocate the blocks of a sparse file, so that running out of space
+    # raises here rather than in a worker writing through a memory map
+    if hasattr(os, 'posix_fallocate'):
+        with open(path, 'r+b') as f:
+            os.posix_fallocate(f.fileno(), 0, os.path.getsize(path))
+
+
+def _simulate_into_slabs(slabs, method, parameters, seeds, offset):
+    """
+    Run simulations in a worker and write their metrics into the output
+    slabs, the simulations being at offset, offset + 1, ... in the last
+    dimension.
+    :return: number of simulations
+    """
+    simulation = _simulation_function(method)
+    outputs = {key: np.lib.format.open_memmap(path, mode='r+')
+               for key, path in slabs.items()}
+    if method == 'batched':
+        # the replicates of the chunk are simulated together
+        results = synergy_random_batched(*parameters, seeds)
+        for key, output in outputs.items():
+            output[..., offset:offset + len(seeds)] = results[key]
+    else:
+        for i, seed in enumerate(seeds):
+            results = simulation(*parameters, seed)
+            for key, output in outputs.items():
+                output[..., offset + i] = results[key]
+    del outputs
+    return len(seeds)
+
+
+def iterate_simulations(diag_prevalence, phenotype_prob1, phenotype_prob2,
+                        sample_per_simulation, SIMULATION_SIZE, cpu=None,
+                        job_id=0, method='bernoulli', first=0, last=None):
+    """
+    Run simulations in a pool of worker processes and yield the metrics of
+    each simulation, in order, as soon as it is available. Parameters are
+    the same as create_empirical_distribution.
+    """
+    if last is None:
+        last = SIMULATION_SIZE
+    simulation = _simulation_function(method)
     logger.info('number of CPU: {}'.format(os.cpu_count()))
     if cpu is None:
         cpu = os.cpu_count()
-    workers = multiprocessing.Pool(cpu)
-    logger.info('number of workers created: {}'.format(cpu))
-    results = [workers.apply_async(synergy_random, args=(diag_prevalence,
-                                                        phenotype_prob1,
-                                                        phenotype_prob2,
-                                                        sample_per_simulation,
-                                                        i + job_id*SIMULATION_SIZE))
-         for i in np.arange(SIMULATION_SIZE)]
-    workers.close()
-    workers.join()
-    assert(len(results) == SIMULATION_SIZE)
-    empirical_distributions = dict()
-    empirical_distributions['mf_XY_omit_z'] = \
-        np.stack([res.get()['mf_XY_omit_z'] for res in results], axis=-1)
-    empirical_distributions['mf_Xz'] = \
-        np.stack([res.get()['mf_Xz'] for res in results], axis=-1)
-    empirical_distributions['mf_Yz'] = \
-        np.stack([res.get()['mf_Yz'] for res in results], axis=-1)
-    empirical_distributions['mf_XY_z'] = \
-        np.stack([res.get()['mf_XY_z'] for res in results], axis=-1)
-    empirical_distributions['mf_XY_given_z'] =\
-        np.stack([res.get()['mf_XY_given_z'] for res in results], axis=-1)
-    empirical_distributions['synergy'] =\
-        np.stack([res.get()['synergy'] for res in results], axis=-1)
-
-    return empirical_distributions
+    seeds = [int(i + job_id * SIMULATION_SIZE)
+             for i in np.arange(first, last)]
+    with multiprocessing.Pool(cpu) as workers:
+        logger.info('number of workers created: {}'.format(cpu))
+        yield from workers.imap(functools.partial(simulation, diag_prevalence,
+                                                  phenotype_prob1,
+                                                  phenotype_prob2,
+                                                  sample_per_simulation),
+                                seeds)
 
 
 if __name__=='__main__':
@@ -0,0 +1,189 @@
+import numpy as np
+import json
+import os
+import os.path
+import logging.config
+import mf
+import mf_random
+from distribution_store import exceedances
+
+
+log_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'log_config.conf')
+logging.config.fileConfig(log_file_path)
+logger = logging.getLogger(__name__)
+
+
+class NullLibrary:
+    """
+    On-disk library of null distributions of pairwise metrics, shared by
+    all diseases and phenotype sets. Under the null, the distribution of a
+    pairwise metric only depends on the disease prevalence, the prevalence
+    of the two phenotypes and the sample size N. The probabilities are
+    quantized on a grid, and the library holds simulations for every grid
+    point that has been used; a point is simulated the first time a pair
+    falls on it.
+
+    Probabilities are quantized on the logit scale, with levels_per_decade
+    grid points per factor of 10. N is not quantized: all diseases of a
+    cohort share it, and the null is simulated at the N of the observed
+    pairs. Values are stored as G statistics, 2 * N * ln(2) * metric, which
+    asymptotically do not depend on the probabilities (chi-square), so
+    that the error of quantizing is limited to finite-sample effects.
+    """
+    def __init__(self, path, simulations=1000, levels_per_decade=10,
+                 min_probability=1e-4, metrics=mf.PAIRWISE_METRICS):
+        """
+        :param path: directory of the library, created if it does not exist.
+        If it exists, the settings of the library are read from it and the
+        other arguments are ignored.
+        :param simulations: number of simulations per grid point
+        :param levels_per_decade: resolution of the grid
+        :param min_probability: probabilities are clipped to
+        [min_probability, 1 - min_probability]
+        :param metrics: pairwise metrics in the library
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        settings_path = os.path.join(path, 'library.json')
+        if os.path.exists(settings_path):
+            with open(settings_path, 'r') as f:
+                settings = json.load(f)
+        else:
+            settings = {'simulations': simulations,
+                        'levels_per_decade': levels_per_decade,
+                        'min_probability': min_probability,
+                        'metrics': list(metrics)}
+            temporary = settings_path + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(settings, f, indent=1)
+            os.replace(temporary, settings_path)
+        self.simulations = settings['simulations']
+        self.levels_per_decade = settings['levels_per_decade']
+        self.min_probability = settings['min_probability']
+        self.metrics = settings['metrics']
+
+    def probability_level(self, p):
+        p = np.clip(np.asarray(p, dtype=np.float64), self.min_probability,
+                    1 - self.min_probability)
+        return np.round(np.log10(p / (1 - p)) *
+                        self.levels_per_decade).astype(int)
+
+    def probability_of_level(self, level):
+        return 1 / (1 + 10 ** (-np.asarray(level) / self.levels_per_decade))
+
+    def size_level(self, N):
+        # the observed and the null G statistics are taken at the same N
+        return np.asarray(N).astype(int)
+
+    def size_of_level(self, level):
+        return np.asarray(level).astype(int)
+
+    def keys(self, disease_prevalence, pair_prob1, pair_prob2, N):
+        """
+        Grid points of pairs. Metrics are symmetric in x and y, so the
+        phenotype levels are sorted.
+        :return: a K x 4 matrix of levels of N, the disease prevalence and
+        the phenotype prevalences
+        """
+        x = self.probability_level(pair_prob1)
+        y = self.probability_level(pair_prob2)
+        keys = np.empty([len(x), 4], dtype=int)
+        keys[:, 0] = self.size_level(N)
+        keys[:, 1] = self.probability_level(disease_prevalence)
+        keys[:, 2] = np.minimum(x, y)
+        keys[:, 3] = np.maximum(x, y)
+        return keys
+
+    def _path(self, key):
+        return os.path.join(self.path, '{}_{}'.format(key[0], key[1]),
+                            '{}_{}.npy'.format(key[2], key[3]))
+
+    def missing(self, keys):
+        """
+        :return: the unique keys that have not been simulated
+        """
+        unique = np.unique(np.asarray(keys).reshape([-1, 4]), axis=0)
+        return unique[[not os.path.exists(self._path(key))
+                       for key in unique]]
+
+    def simulate(self, keys, rng=None):
+        """
+        Simulate the grid points that are not in the library yet. All
+        missing points are simulated together, with the count tables sampled
+        directly (mf_random.simulate_pair_metrics).
+        :param keys: grid points, see keys
+        :param rng: a numpy random Generator
+        :return: number of grid points simulated
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+        missing = self.missing(keys)
+        groups = np.unique(missing[:, :2], axis=0)
+        for n_level, z_level in groups:
+            points = missing[(missing[:, 0] == n_level) &
+                             (missing[:, 1] == z_level)]
+            N = int(self.size_of_level(n_level))
+            simulated = mf_random.simulate_pair_metrics(
+                self.probability_of_level(z_level),
+                self.probability_of_level(points[:, 2]),
+                self.probability_of_level(points[:, 3]), N,
+                self.simulations, rng)
+            G = 2 * N * np.log(2) * np.stack([simulated[metric] for metric
+                                              in self.metrics])
+            os.makedirs(os.path.dirname(self._path(points[0])),
+                        exist_ok=True)
+            for i, key in enumerate(points):
+                path = self._path(key)
+                temporary = path + '.tmp.npy'
+                np.save(temporary, G[:, :, i].astype(np.float32))
+                os.replace(temporary, path)
+        if len(missing) > 0:
+            logger.info('grid points simulated: {}'.format(len(missing)))
+        return len(missing)
+
+    def distribution(self, key):
+        """
+        :return: a matrix of the simulated G statistics of a grid point, one
+        row per metric
+        """
+        return np.load(self._path(key), mmap_mode='r')
+
+    def p_values(self, observed, disease_prevalence, pair_prob1, pair_prob2,
+                 N, alternative='two.sided', rng=None):
+        """
+        Estimate p values of pairs by comparing their G statistics with the
+        distribution of the grid point they fall on. Missing grid points are
+        simulated first.
+        :param observed: a dictionary of observed pairwise metrics, each a
+        size K vector
+        :param disease_prevalence: a scalar for the disease prevalence
+        :param pair_prob1: a size K vector of the prevalence of x of each
+        pair
+        :param pair_prob2: a size K vector of the prevalence of y of each
+        pair
+        :param N: sample size
+        :param alternative: alternative hypothesis
+        :param rng: a numpy random Generator to simulate missing points
+        :return: a dictionary of p values, each a size K vector
+        """
+        keys = self.keys(disease_prevalence, pair_prob1, pair_prob2, N)
+        self.simulate(keys, rng)
+        unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(unique) + 1))
+        p = dict()
+        for metric, value in observed.items():
+            row = self.metrics.index(metric)
+            G = 2 * N * np.log(2) * np.asarray(value, dtype=np.float64)
+            p[metric] = np.zeros(len(G))
+            for i, key in enumerate(unique):
+                pairs = order[bounds[i]:bounds[i + 1]]
+                distribution = np.asarray(self.distribution(key)[row])
+                p[metric][pairs] = exceedances(
+                    G[pairs], np.broadcast_to(distribution,
+                                              [len(pairs),
+                                               len(distribution)]),
+                    alternative) / len(distribution)
+        return p
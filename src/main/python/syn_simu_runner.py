@@ -1,7 +1,10 @@
 import pickle
 import argparse
 import os.path
-from mf_random import MutualInfoRandomizer
+from mf_random import MutualInfoRandomizer, SimulationPool
+from distribution_store import DistributionStore
+from null_library import NullLibrary
+import mf
 import logging.config
 import numpy as np
 import math
@@ -39,6 +42,28 @@ def main():
     simulate_parser.add_argument('-disease', help='specify if only to analyze such disease',
                                  default=[], dest='disease_of_interest',
                                  type=str)
+    simulate_parser.add_argument('-method',
+                                 help='bernoulli: simulate and count every '
+                                      'observation; multinomial: sample the '
+                                      'count tables directly; batched: '
+                                      'simulate and count the observations '
+                                      'of many simulations at once',
+                                 choices=['bernoulli', 'multinomial',
+                                          'batched'],
+                                 default='bernoulli', dest='method')
+    simulate_parser.add_argument('-format',
+                                 help='pickle: one file per disease and job; '
+                                      'store: append chunks to a resumable '
+                                      'distribution store per disease',
+                                 choices=['pickle', 'store'],
+                                 default='pickle', dest='format')
+    simulate_parser.add_argument('-chunk', help='simulations per chunk of '
+                                                'the distribution store',
+                                 default=100, type=int, dest='chunk')
+    simulate_parser.add_argument('-compress', help='compress the chunks of '
+                                                   'the distribution store',
+                                 action='store_true', default=False,
+                                 dest='compress')
     simulate_parser.set_defaults(func=simulate)
 
     estimate_parser = subparser.add_parser('estimate',
@@ -53,8 +78,29 @@ def main():
     estimate_parser.add_argument('-disease', help='specify if only to analyze such disease',
                                  default=[], dest='disease_of_interest',
                                  type=str)
+    estimate_parser.add_argument('-format',
+                                 help='format of the empirical distributions',
+                                 choices=['pickle', 'store'],
+                                 default='pickle', dest='format')
     estimate_parser.set_defaults(func=estimate)
 
+    library_parser = subparser.add_parser('library',
+           help='estimate p values from a null library shared by diseases')
+    library_parser.add_argument('-i', '--input', help='input file path',
+                                action='store', dest='input_path')
+    library_parser.add_argument('-library', help='directory of the library',
+                                action='store', dest='library_path')
+    library_parser.add_argument('-o', '--ouput', help='output file path',
+                                action='store', dest='out_dir')
+    library_parser.add_argument('-N', '--N_SIMULATIONS',
+                                help='simulations per grid point of a new '
+                                     'library',
+                                dest='N_SIMULATIONS', type=int, default=1000)
+    library_parser.add_argument('-disease', help='specify if only to analyze such disease',
+                                default=[], dest='disease_of_interest',
+                                type=str)
+    library_parser.set_defaults(func=estimate_from_library)
+
     args = parser.parse_args()
     if args.command is None:
         parser.print_help()
@@ -71,6 +117,8 @@ def simulate(args):
     cpu = args.cpu
     job_id = args.job_id
     disease_of_interest = args.disease_of_interest
+    method = args.method
+    store_format = getattr(args, 'format', 'pickle') == 'store'
 
     with open(input_path, 'rb') as in_file:
         disease_synergy_map = pickle.load(in_file)
@@ -85,30 +133,65 @@ def simulate(args):
     else:
         job_suffix = '_' + str(job_id)
 
-    for disease, synergy in disease_synergy_map.items():
-        if disease_of_interest is not None and \
-                        disease not in disease_of_interest:
-            continue
-        randmizer = MutualInfoRandomizer(synergy)
-        if verbose:
-            print('start calculating p values for {}'.format(disease))
-        randmizer.simulate(per_simulation, simulations, cpu, job_id)
-        # p = randmizer.p_value()
-        # p_filepath = os.path.join(dir, disease + '_p_value_.obj')
-        # with open(p_filepath, 'wb') as f:
-        #     pickle.dump(p, file=f, protocol=2)
+    # one pool of workers for all diseases
+    with SimulationPool(cpu) as pool:
+        for disease, synergy in disease_synergy_map.items():
+            if disease_of_interest is not None and \
+                            disease not in disease_of_interest:
+                continue
+            randmizer = MutualInfoRandomizer(synergy)
+            if verbose:
+                print('start calculating p values for {}'.format(disease))
+            if store_format:
+                simulate_into_store(randmizer, os.path.join(dir, disease), args,
+                                    pool)
+                continue
+            randmizer.simulate(per_simulation, simulations, cpu, job_id, method,
+                               pool=pool)
+            # p = randmizer.p_value()
+            # p_filepath = os.path.join(dir, disease + '_p_value_.obj')
+            # with open(p_filepath, 'wb') as f:
+            #     pickle.dump(p, file=f, protocol=2)
 
-        distribution_file_path = os.path.join(dir, disease + job_suffix +
-                                              '_distribution.obj')
-        with open(distribution_file_path, 'wb') as f2:
-            pickle.dump(randmizer.empirical_distribution, file=f2, protocol=2)
+            distribution_file_path = os.path.join(dir, disease + job_suffix +
+                                                  '_distribution.obj')
+            with open(distribution_file_path, 'wb') as f2:
+                pickle.dump(randmizer.empirical_distribution, file=f2, protocol=2)
 
-        if verbose:
-            print('saved current batch of simulations {} for {}'.format(
-                job_id, disease))
+            if verbose:
+                print('saved current batch of simulations {} for {}'.format(
+                    job_id, disease))
+
+
+def simulate_into_store(randmizer, path, args, pool=None):
+    """
+    Simulate in chunks and append every chunk to the distribution store at
+    path. Chunks that the job already wrote are skipped, so an interrupted
+    job resumes where it stopped.
+    :param pool: a SimulationPool shared by all chunks (and diseases)
+    """
+    job_id = 0 if args.job_id is None else args.job_id
+    store = DistributionStore(path, compress=args.compress)
+    done = store.simulations(job_id)
+    if done > 0:
+        logger.info('resume job {} after {} simulations'.format(job_id, done))
+    for first in range(done, args.N_SIMULATIONS, args.chunk):
+        last = min(first + args.chunk, args.N_SIMULATIONS)
+        randmizer.simulate(args.n_per_run, args.N_SIMULATIONS, args.cpu,
+                           job_id, args.method, first, last, pool)
+        store.append(randmizer.empirical_distribution, job_id)
+        if args.verbose:
+            print('saved simulations {} to {} of job {}'.format(first, last,
+                                                                job_id))
 
 
 def estimate(args):
+    """
+    Estimate p values of the pairwise metrics from empirical distributions.
+    With -format store, the p values of every disease are written, keyed by
+    disease as in estimate_from_library; otherwise, those of the last
+    disease.
+    """
     input_path = args.input_path
     dist_path = args.dist_path
     out_path = args.out_dir
@@ -120,10 +203,21 @@ def estimate(args):
         logger.info('number of diseases to run simulations for {}'.format(
             len(mf_map)))
 
+    store_format = getattr(args, 'format', 'pickle') == 'store'
+    if store_format:
+        p = dict()
     for disease, summary_statistics in mf_map.items():
         if disease_of_interest is not None and \
                         disease not in disease_of_interest:
             continue
+        if store_format:
+            # distributions are read from memory maps, block by block
+            store = DistributionStore(os.path.join(dist_path, disease))
+            p[disease] = store.p_values(
+                mf.MutualInfoXYz(summary_statistics).metrics(),
+                pairs=getattr(summary_statistics, 'pairs', None))
+            logger.info('p values estimated for {}'.format(disease))
+            continue
         randmizer = MutualInfoRandomizer(summary_statistics)
         empirical_distribution = load_distribution(dist_path, disease)
         # serialize_empirical_distributions(empirical_distribution['synergy'],
@@ -137,6 +231,28 @@ def estimate(args):
     return p
 
 
+def estimate_from_library(args):
+    """
+    Estimate p values of the pairwise metrics of every disease from a null
+    library; grid points that no disease has used before are simulated and
+    added to the library.
+    """
+    library = NullLibrary(args.library_path, simulations=args.N_SIMULATIONS)
+    with open(args.input_path, 'rb') as in_file:
+        mf_map = pickle.load(in_file)
+    p = dict()
+    for disease, summary_statistics in mf_map.items():
+        if args.disease_of_interest is not None and \
+                        disease not in args.disease_of_interest:
+            continue
+        p[disease] = MutualInfoRandomizer(summary_statistics)\
+            .library_p_values(library)
+        logger.info('p values estimated for {}'.format(disease))
+    with open(args.out_dir, 'wb') as f:
+        pickle.dump(p, f, protocol=2)
+    return p
+
+
 def load_distribution(dir, disease_prefix):
     """
     Collect individual distribution profiles
@@ -1,11 +1,15 @@
+import collections
+import hashlib
+import heapq
 import itertools
 import treelib
 import networkx as nx
 import numpy as np
 import pickle
-import copy
+import os
 import sys
 import logging
+import warnings
 
 
 class SynergyTree:
@@ -20,18 +24,31 @@ class SynergyTree:
         :param var_dict: a dictionary that annotate variable ids
         :param mf_dict: a dictionary from subsets of the variables to their
         mutual information with an outcome. The key is a tuple and the value
-        is a number.
+        is a number. It may also be a function of a sorted tuple of variables
+        that returns its mutual information, e.g. a CachedMutualInfo.
         """
         self.var_ids = var_ids
         self.var_dict = var_dict
         self.mf_dict = mf_dict
         self.tree = None
+        self.synergy_lost = None
 
     def _construct_tree(self):
         self.tree = treelib.Tree()
         root_id = tuple(sorted(self.var_ids))
-        self.tree = populate_syn_tree(self.tree, None, root_id,
-                                      self.mf_dict)
+        mf_dict = self.mf_dict
+        if callable(mf_dict):
+            mf_dict = {subset: mf_dict(subset) for subset in
+                       subsets(self.var_ids, include_self=True)}
+        self.tree = populate_syn_tree(self.tree, None, root_id, mf_dict)
+
+    def _construct_approximate_tree(self, beam_width, outcome_entropy):
+        self.tree = treelib.Tree()
+        if outcome_entropy is None:
+            outcome_entropy = getattr(self.mf_dict, 'outcome_entropy', None)
+        self.tree, self.synergy_lost = approximate_syn_tree(
+            self.tree, self.var_ids, LazyMutualInfo(self.mf_dict), beam_width,
+            outcome_entropy)
 
     def _all_keys_sorted(self):
         """
@@ -64,11 +81,29 @@ class SynergyTree:
             raise RuntimeError("key is not sorted")
         self.mf_dict[key] = value
 
-    def synergy_tree(self):
+    def synergy_tree(self, approximate=False, beam_width=1,
+                     outcome_entropy=None):
         """
         Return synergy tree
+        :param approximate: if true, partitions are searched approximately
+        (see approximate_syn_tree), which only needs the mutual information
+        of the subsets visited. mf_dict may then be a function of a sorted
+        tuple of variables instead of a dictionary, e.g. a PatternMutualInfo.
+        An upper bound of the synergy lost at every node is kept in
+        synergy_lost.
+        :param beam_width: number of partitions kept at every step of the
+        approximate search; 1 is a greedy search
+        :param outcome_entropy: entropy of the outcome, which tightens the
+        bounds of the approximate search; default to the outcome_entropy of
+        mf_dict, if any (e.g. a PatternMutualInfo)
         :return: synergy tree
         """
+        if approximate:
+            self._construct_approximate_tree(beam_width, outcome_entropy)
+            return self.tree
+        if callable(self.mf_dict):
+            self._construct_tree()
+            return self.tree
         if not self._all_keys_sorted():
             raise RuntimeError("variables in subsets are not sorted")
 
@@ -85,6 +120,8 @@ class DisjointSerie:
     -- (1,), (2, 3, 4)
     -- (2,), (1, 3, 4)
     -- (1, 2), (3, 4)
+    Only used by disjoint_series; synergy trees are built from
+    best_partitions.
     """
     def __init__(self, series=None):
         if series is None:
@@ -146,77 +183,582 @@ class DisjointSerie:
 def populate_syn_tree(tree, parent, current, mf_dict,
                       disjoint_series_dict=None):
     """
-    A recursive method to populate the synergy tree from the current node.
+    Populate the synergy tree from the current node. The synergy of a node
+    is the mutual information of its variables minus the best (max) summed
+    mutual information of a partition of them into disjoint subsets, and the
+    subsets of that partition are its children. The best partitions of all
+    subsets are found together by best_partitions.
     :param tree: synergy tree
     :param parent: parent id (a tuple)
     :param current: a tuple of variable names
     :param mf_dict: a dictionary of precomputed mutual information, key is a
     tuple of variables, value is the mutual information between the joint
     distribution of those variables and the outcome
+    :param disjoint_series_dict: deprecated and ignored. Partitions are no
+    longer enumerated, so precomputed disjoint series are not needed; it
+    will be removed in a future version.
     :return: synergy tree
     """
+    if disjoint_series_dict is not None:
+        warnings.warn('disjoint_series_dict is deprecated and ignored, '
+                      'partitions are found by best_partitions',
+                      DeprecationWarning, stacklevel=2)
     # if tree has not been defined, or root not added
     if tree is None:
         raise ValueError("tree not initialized error")
+    variables, mf = mf_by_mask(current, mf_dict)
+    split, first, whole_first = best_partitions(mf)
+    _populate_from_partitions(tree, parent, (1 << len(variables)) - 1,
+                              variables, mf, split, first, whole_first)
+    return tree
+
 
+def _populate_from_partitions(tree, parent, mask, variables, mf, split,
+                              first, whole_first):
+    current = mask_to_subset(mask, variables)
     # if there is only one element, this is a leaf and there is no synergy to
     # compute
-    if len(current) == 1:
+    if mask & (mask - 1) == 0:
         tree.create_node(current, current, parent=parent, data=None)
-        return tree
-
-    # if there are more than one element, find the partition that gives the
-    # max summed mutual information, because:
-    # synergy = I - max(I' + I'')
-    mf_joint = mf_dict[current]
-
-    # Important: set it slight below zero to avoid finding no partition at all (
-    # when all
-    #  mf of subsets is zero)
-    mf_max_subset = -0.0000001
-    # We should test all possible disjoint series,
-    # instead of just testing bi-partitions.
-    # It will take a long time to compute all complement series. One solution
-    #  is to precompute them, and load them from disk
-    if disjoint_series_dict is None or len(current) not in \
-            disjoint_series_dict.keys():
-        partitions = disjoint_series(set(current))
-        best_partition = partitions.pop()
-        for partition in partitions:
-            mf_subset = []
-            for i in range(len(partition.serie)):
-                mf_subset.append(mf_dict[partition.serie[i]])
-            if sum(mf_subset) > mf_max_subset:
-                mf_max_subset = sum(mf_subset)
-                best_partition = partition
-    else:
-        # disjoint_series_dict is using integers to represent each element
-        # for example, (0,), (1, 2, 3)
-        # need to convert them into variable ids, such as
-        # ('V1',), ('V2', 'V3', 'V4')
-        current_sorted = np.array(sorted(current))
-        partitions = disjoint_series_dict[current_sorted.size]
-        best_partition = partitions.pop()
-        for partition in partitions:
-            mf_subset = []
-            for i in range(len(partition.serie)):
-                key = tuple(current_sorted[list(partition.serie[i])])
-                mf_subset.append(mf_dict[key])
-            if sum(mf_subset) > mf_max_subset:
-                mf_max_subset = sum(mf_subset)
-                best_partition = partition
-
-    synergy = mf_joint - mf_max_subset
-
-    # update synergy of current node
-    tree.create_node(current, current, parent=parent, data=synergy)
-
-    # recursively call the function on left subset and right subset
-    for i in range(len(best_partition.serie)):
-        tree = populate_syn_tree(tree, current, best_partition.serie[i],
-                                 mf_dict)
+        return
+    # synergy = I - max(I' + I'' + ...)
+    tree.create_node(current, current, parent=parent,
+                     data=mf[mask] - split[mask])
+    for child in sorted(read_partition(mask, first, whole_first),
+                        key=lambda block: mask_to_subset(block, variables)):
+        _populate_from_partitions(tree, current, child, variables, mf, split,
+                                  first, whole_first)
 
-    return tree
+
+def mf_by_mask(var_ids, mf_dict):
+    """
+    Index the mutual information of subsets by subset mask: bit i of a mask
+    is set if the subset has the i-th (sorted) variable.
+    :param var_ids: variables
+    :param mf_dict: a dictionary of precomputed mutual information of all
+    subsets of the variables, keys are sorted tuples
+    :return: the sorted variables, and a vector of the mutual information
+    of the 2^n subsets (0 for the empty set)
+    """
+    variables = tuple(sorted(var_ids))
+    n = len(variables)
+    if n > 30:
+        raise ValueError('too many variables for a synergy tree: {}'.format(n))
+    mf = np.zeros(1 << n)
+    for mask in range(1, 1 << n):
+        mf[mask] = mf_dict[mask_to_subset(mask, variables)]
+    return variables, mf
+
+
+def mask_to_subset(mask, variables):
+    """
+    :return: the sorted tuple of variables of a subset mask
+    """
+    return tuple(variable for i, variable in enumerate(variables)
+                 if mask >> i & 1)
+
+
+def best_partitions(mf, memory_budget=2**22):
+    """
+    Best partitions of every subset by dynamic programming over submasks,
+    bottom-up by subset size. For a subset S, a partition is its block A
+    with the lowest variable of S plus a partition of S - A, so the best
+    summed mutual information of S is
+        whole[S] = max over A of mf[A] + whole[S - A], whole[{}] = 0
+    (including the partition of S into itself), and the best with at least
+    two blocks, used for synergy, excludes A = S. This is O(3^n) instead of
+    enumerating every set partition (Bell numbers).
+    :param mf: a vector of the mutual information of the 2^n subsets by mask
+    :param memory_budget: number of candidate blocks evaluated at a time
+    :return: three vectors by subset mask: the best summed mutual
+    information of partitions into at least two blocks (-inf for single
+    variables), the first block of that partition, and the first block of
+    the best partition that may be the subset itself (see read_partition)
+    """
+    size = len(mf)
+    n = size.bit_length() - 1
+    masks = np.arange(size, dtype=np.int64)
+    popcount = np.zeros(size, dtype=np.int64)
+    for i in range(n):
+        popcount += (masks >> i) & 1
+    whole = np.zeros(size)
+    split = np.full(size, -np.inf)
+    first = np.zeros(size, dtype=np.int64)
+    whole_first = np.zeros(size, dtype=np.int64)
+    singles = masks[popcount == 1]
+    whole[singles] = mf[singles]
+    whole_first[singles] = singles
+    for p in range(2, n + 1):
+        subsets_p = masks[popcount == p]
+        # the blocks with the lowest variable: all combinations of the other
+        # p - 1 variables, the last combination being the subset itself
+        patterns = ((np.arange(1 << (p - 1))[:, np.newaxis] >>
+                     np.arange(p - 1)) & 1)
+        step = max(1, memory_budget >> (p - 1))
+        for start in range(0, len(subsets_p), step):
+            S = subsets_p[start:start + step]
+            bits = np.nonzero((S[:, np.newaxis] >> np.arange(n)) & 1)[1]
+            bits = bits.reshape([len(S), p])
+            A = (patterns @ (1 << bits[:, 1:]).T) | (1 << bits[:, 0])
+            values = mf[A[:-1]] + whole[S ^ A[:-1]]
+            best = np.argmax(values, axis=0)
+            columns = np.arange(len(S))
+            split[S] = values[best, columns]
+            first[S] = A[best, columns]
+            keep_whole = mf[S] >= split[S]
+            whole[S] = np.where(keep_whole, mf[S], split[S])
+            whole_first[S] = np.where(keep_whole, S, first[S])
+    return split, first, whole_first
+
+
+def joint_pattern_counts(patterns, outcome, counts=None):
+    """
+    Count the joint patterns of binary variables and a binary outcome.
+    :param patterns: a N x n matrix of 0/1 values of the (sorted) variables;
+    rows may be observations, or distinct patterns with counts
+    :param outcome: a size N vector of 0/1 values of the outcome
+    :param counts: a size N vector of the number of observations of each
+    row, default to 1
+    :return: a vector of the counts of the 2^(n + 1) patterns by mask: bit i
+    is the i-th variable, bit n the outcome
+    """
+    patterns = np.asarray(patterns) != 0
+    n = patterns.shape[1]
+    codes = patterns @ (1 << np.arange(n, dtype=np.int64)) | \
+        (np.asarray(outcome) != 0).astype(np.int64) << n
+    return np.bincount(codes, weights=counts,
+                       minlength=1 << (n + 1)).astype(np.float64)
+
+
+def _plog2p(p):
+    result = np.zeros(np.shape(p))
+    np.log2(p, out=result, where=p > 0)
+    return np.multiply(result, p, out=result)
+
+
+def mf_by_mask_from_counts(counts, chunk_variables=12):
+    """
+    Mutual information of every subset of the variables with the outcome,
+    from their joint pattern counts. The counts of all subsets are
+    marginalized together: every variable in turn gets a third state, the
+    sum over its two values, which gives the 3^n marginal tables of all
+    subsets (a cell belongs to the subset of the variables that are not
+    summed out). To bound memory, the states of the leading variables are
+    fixed one chunk at a time, and only the last chunk_variables variables
+    are expanded at once, so at most 2 x 3^chunk_variables cells are held.
+    :param counts: joint pattern counts, see joint_pattern_counts
+    :param chunk_variables: number of variables expanded at once
+    :return: a vector of the mutual information of the 2^n subsets by mask,
+    as mf_by_mask
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    n = len(counts).bit_length() - 2
+    # axis 0 is the outcome, axis j the variable n - j
+    table = (counts / np.sum(counts)).reshape([2] * (n + 1))
+    T_outcome = np.sum(_plog2p(np.sum(table, axis=tuple(range(1, n + 1)))))
+    r = min(n, chunk_variables)
+    # subset masks of the cells of the last r variables
+    masks = np.zeros([3] * r, dtype=np.int64)
+    for j in range(r):
+        shape = [1] * r
+        shape[j] = 3
+        masks += (np.arange(3) != 2).astype(np.int64).reshape(shape) << \
+            (r - 1 - j)
+    masks = masks.ravel()
+    mf = np.zeros(1 << n)
+    _marginalize_chunks(table, n - r, 0, masks, mf)
+    mf -= T_outcome
+    mf[0] = 0
+    return mf
+
+
+def _marginalize_chunks(table, leading, high_mask, masks, mf):
+    # fix the states of the leading variables one at a time, then add the
+    # terms of all subsets of the other variables into the 2^r subset masks
+    # that share high_mask, the bits of the leading variables kept
+    if leading > 0:
+        bit = 1 << (table.ndim - 2)
+        _marginalize_chunks(table[:, 0], leading - 1, high_mask | bit, masks,
+                            mf)
+        _marginalize_chunks(table[:, 1], leading - 1, high_mask | bit, masks,
+                            mf)
+        _marginalize_chunks(table[:, 0] + table[:, 1], leading - 1,
+                            high_mask, masks, mf)
+        return
+    for axis in range(1, table.ndim):
+        # the axis has two states so far; sums of slices are faster than
+        # reductions over short axes
+        index = (slice(None),) * axis
+        table = np.concatenate([table, table[index + (slice(0, 1),)] +
+                                table[index + (slice(1, 2),)]], axis=axis)
+    # I(S; outcome) = T(S, outcome) - T(S) - T(outcome), T = sum p log2 p
+    terms = _plog2p(table[0]) + _plog2p(table[1]) - \
+        _plog2p(table[0] + table[1])
+    mf[high_mask:high_mask + (1 << (table.ndim - 1))] += np.bincount(
+        masks, weights=terms.ravel(), minlength=1 << (table.ndim - 1))
+
+
+def mf_dict_from_counts(var_ids, counts):
+    """
+    The dictionary of the mutual information of all subsets (see
+    SynergyTree) from joint pattern counts, the variables being in sorted
+    order in the patterns.
+    """
+    variables = tuple(sorted(var_ids))
+    mf = mf_by_mask_from_counts(counts)
+    return {mask_to_subset(mask, variables): mf[mask]
+            for mask in range(1, len(mf))}
+
+
+def read_partition(mask, first, whole_first):
+    """
+    Read the best partition of a subset into at least two blocks off the
+    tables of best_partitions.
+    :return: a list of subset masks
+    """
+    blocks = [int(first[mask])]
+    rest = mask ^ blocks[0]
+    while rest:
+        blocks.append(int(whole_first[rest]))
+        rest ^= blocks[-1]
+    return blocks
+
+
+class LazyMutualInfo:
+    """
+    Mutual information of subsets, fetched from a source the first time it
+    is needed and memoized. The source is a dictionary like mf_dict, or a
+    function of a sorted tuple of variables.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.cache = {}
+
+    def __getitem__(self, subset):
+        if subset not in self.cache:
+            if callable(self.source):
+                self.cache[subset] = self.source(subset)
+            else:
+                self.cache[subset] = self.source[subset]
+        return self.cache[subset]
+
+    def __len__(self):
+        return len(self.cache)
+
+
+class PatternMutualInfo:
+    """
+    Mutual information of subsets of binary variables with a binary outcome,
+    computed from the observations when a subset is requested, e.g. as the
+    source of an approximate synergy tree of many variables.
+    """
+    def __init__(self, var_ids, patterns, outcome):
+        """
+        :param var_ids: the variables of the columns of patterns
+        :param patterns: a N x n matrix of 0/1 values
+        :param outcome: a size N vector of 0/1 values
+        """
+        self.index = {var_id: i for i, var_id in enumerate(var_ids)}
+        # one row per variable, so that the variables of a subset are read
+        # contiguously
+        self.variables = np.ascontiguousarray(
+            (np.asarray(patterns) != 0).T, dtype=np.float64)
+        self.outcome = (np.asarray(outcome) != 0).astype(np.int64)
+        self.outcome_entropy = -np.sum(_plog2p(
+            np.bincount(self.outcome, minlength=2) / len(self.outcome)))
+        # patterns of more than 52 variables (above the exact integers of
+        # float64) are identified by a random 64-bit hash instead of their
+        # bits; two patterns collide with a negligible probability
+        self.hash_weights = np.random.default_rng(0).integers(
+            -2**63, 2**63, size=len(self.variables), dtype=np.int64)
+
+    def __call__(self, subset):
+        columns = [self.index[var_id] for var_id in subset]
+        if len(columns) <= 52:
+            rows = 2.0 ** np.arange(len(columns)) @ self.variables[columns]
+        else:
+            with np.errstate(over='ignore'):
+                rows = self.hash_weights[columns] @ \
+                    self.variables[columns].astype(np.int64)
+        if len(columns) <= 12:
+            # few enough patterns to count them all
+            codes = rows.astype(np.int64)
+        else:
+            _, codes = np.unique(rows, return_inverse=True)
+            codes = codes.reshape(-1)
+        joint = np.bincount(codes * 2 + self.outcome,
+                            minlength=2 * (np.max(codes) + 1))
+        p = joint.reshape([-1, 2]) / len(codes)
+        return np.sum(_plog2p(p)) - np.sum(_plog2p(np.sum(p, axis=1))) - \
+            np.sum(_plog2p(np.sum(p, axis=0)))
+
+
+class MutualInfoCache:
+    """
+    A size-bounded cache of the mutual information of variable subsets with
+    a diagnosis, shared by synergy trees. Entries are keyed by diagnosis,
+    cohort fingerprint (see cohort_fingerprint) and subset, so that trees of
+    overlapping variables, or built exactly and approximately, compute a
+    subset once. The least recently used entries are evicted first. The
+    cache can be saved to disk and loaded again in another session.
+    """
+    def __init__(self, max_size=2**20, path=None):
+        """
+        :param max_size: maximum number of entries
+        :param path: file of the cache; it is loaded if it exists, and save
+        writes to it
+        """
+        self.max_size = max_size
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                for key, value in pickle.load(f):
+                    self.put(key, value)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def save(self, path=None):
+        """
+        Write the cache, from the least to the most recently used entry
+        :param path: default to the path of the cache
+        """
+        if path is None:
+            path = self.path
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            pickle.dump(list(self.entries.items()), f, protocol=2)
+        os.replace(temporary, path)
+
+    def source(self, diagnosis, cohort, compute=None, names=None):
+        """
+        :param diagnosis: the diagnosis of the mutual information
+        :param cohort: a fingerprint of the observations
+        :param compute: a function of a sorted tuple of variables to its
+        mutual information, called for subsets that are not cached
+        :param names: a dictionary from variables to identifiers that do not
+        change between sessions, e.g. var_dict of analysis_pipeline from
+        column names to phenotypes
+        :return: a CachedMutualInfo
+        """
+        return CachedMutualInfo(self, diagnosis, cohort, compute, names)
+
+
+class CachedMutualInfo:
+    """
+    Mutual information of subsets of one diagnosis and cohort from a
+    MutualInfoCache; missing subsets are computed and cached.
+    """
+    def __init__(self, cache, diagnosis, cohort, compute=None, names=None):
+        self.cache = cache
+        self.diagnosis = diagnosis
+        self.cohort = cohort
+        self.compute = compute
+        self.names = names
+
+    def key(self, subset):
+        if self.names is not None:
+            subset = [self.names[var_id] for var_id in subset]
+        return self.diagnosis, self.cohort, tuple(sorted(subset))
+
+    def missing(self, subsets):
+        """
+        :return: the subsets that are not cached
+        """
+        return [subset for subset in subsets
+                if self.key(subset) not in self.cache]
+
+    def update(self, mf_dict):
+        """
+        Cache the mutual information of subsets, e.g. from
+        mf_dict_from_counts
+        """
+        for subset, value in mf_dict.items():
+            self.cache.put(self.key(subset), value)
+
+    def __call__(self, subset):
+        key = self.key(subset)
+        value = self.cache.get(key)
+        if value is None:
+            if self.compute is None:
+                raise KeyError(subset)
+            value = self.compute(subset)
+            self.cache.put(key, value)
+        return value
+
+
+def cohort_fingerprint(*parts):
+    """
+    A fingerprint of the observations of a cohort, e.g. of the arrays of
+    variables and outcome, or of the parameters that select them
+    :return: a hexadecimal string
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(str((part.shape, part.dtype.str)).encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(repr(part).encode())
+    return digest.hexdigest()
+
+
+def approximate_syn_tree(tree, var_ids, mf, beam_width=1,
+                         outcome_entropy=None):
+    """
+    Populate an approximate synergy tree. The best partitions of subsets
+    are searched by agglomeration: from the partition into single
+    variables, the two blocks that gain the most summed mutual information
+    when merged are merged, while it increases; with beam_width > 1, the
+    beam_width best partitions are kept at every step. Every block formed is
+    a node whose partition is the two blocks it was formed from, and the
+    root is split by the best partition visited. The mutual information of
+    O(n^2 * beam_width) subsets is needed, instead of 2^n.
+    The partition found is at most as good as the best one, so the synergy
+    of a node is at most overestimated by the gap between the two. The gap
+    is bounded by partition_bound, a loose worst case: it grows with the
+    number of blocks a partition of the node can have, and is mostly
+    useful for nodes of a few variables.
+    :param tree: an empty tree
+    :param var_ids: variables
+    :param mf: mutual information of subsets, e.g. a LazyMutualInfo
+    :param beam_width: number of partitions kept at every step
+    :param outcome_entropy: entropy of the outcome, if known, to tighten the
+    bounds
+    :return: synergy tree, and a dictionary from the nodes to an upper bound
+    of the synergy lost
+    """
+    variables = tuple(sorted(var_ids))
+    values = {}
+
+    def mf_of_mask(mask):
+        if mask not in values:
+            values[mask] = mf[mask_to_subset(mask, variables)]
+        return values[mask]
+
+    splits = approximate_partitions(len(variables), mf_of_mask, beam_width)
+    synergy_lost = {}
+    for mask, (value, _) in splits.items():
+        synergy_lost[mask_to_subset(mask, variables)] = max(
+            0, partition_bound(mask, mf_of_mask, outcome_entropy) - value)
+    _populate_from_splits(tree, None, (1 << len(variables)) - 1, variables,
+                          mf_of_mask, splits)
+    return tree, synergy_lost
+
+
+def _populate_from_splits(tree, parent, mask, variables, mf_of_mask, splits):
+    current = mask_to_subset(mask, variables)
+    if mask & (mask - 1) == 0:
+        tree.create_node(current, current, parent=parent, data=None)
+        return
+    value, blocks = splits[mask]
+    tree.create_node(current, current, parent=parent,
+                     data=mf_of_mask(mask) - value)
+    for child in sorted(blocks, key=lambda block: mask_to_subset(block,
+                                                                 variables)):
+        _populate_from_splits(tree, current, child, variables, mf_of_mask,
+                              splits)
+
+
+def approximate_partitions(n, mf_of_mask, beam_width=1):
+    """
+    Agglomerative beam search of partitions, see approximate_syn_tree.
+    :param n: number of variables
+    :param mf_of_mask: a function of a subset mask to its mutual information
+    :param beam_width: number of partitions kept at every step
+    :return: a dictionary from the masks of the root and of every block
+    formed to their best partition found, as the summed mutual information
+    and the list of blocks
+    """
+    full = (1 << n) - 1
+    singles = tuple(1 << i for i in range(n))
+    start = (sum(mf_of_mask(block) for block in singles), singles)
+    splits = {}
+    if n > 1:
+        splits[full] = start
+    gains = {}
+    beam = [start]
+    visited = {singles}
+    while beam:
+        children = []
+        for value, blocks in beam:
+            candidates = []
+            for a, b in itertools.combinations(range(len(blocks)), 2):
+                pair = (blocks[a], blocks[b])
+                if pair not in gains:
+                    gains[pair] = mf_of_mask(pair[0] | pair[1]) - \
+                        mf_of_mask(pair[0]) - mf_of_mask(pair[1])
+                candidates.append((gains[pair], a, b))
+            for gain, a, b in heapq.nlargest(beam_width, candidates):
+                if gain <= 0:
+                    break
+                merged = blocks[a] | blocks[b]
+                split_value = mf_of_mask(blocks[a]) + mf_of_mask(blocks[b])
+                if merged not in splits or splits[merged][0] < split_value:
+                    splits[merged] = (split_value, (blocks[a], blocks[b]))
+                merged_blocks = tuple(sorted(
+                    [block for i, block in enumerate(blocks)
+                     if i not in (a, b)] + [merged]))
+                if merged_blocks not in visited:
+                    visited.add(merged_blocks)
+                    children.append((value + gain, merged_blocks))
+        beam = heapq.nlargest(beam_width, children)
+        for value, blocks in beam:
+            # the best partition of the root has at least two blocks
+            if len(blocks) > 1 and value > splits[full][0]:
+                splits[full] = (value, blocks)
+    return splits
+
+
+def partition_bound(mask, mf_of_mask, outcome_entropy=None):
+    """
+    Upper bound of the summed mutual information of the partitions of a
+    subset into at least two blocks. A partition has single variables and
+    blocks of at least two variables, and a block has at most the mutual
+    information of the largest proper subsets and of the entropy of the
+    outcome, so a partition with m such blocks has at most m times the
+    smaller of the two plus the mutual information of the len(subset) - 2m
+    best single variables.
+    This is a loose worst case. It grows with m, up to len(subset) / 2
+    blocks, and the summed mutual information of a partition can indeed
+    exceed the entropy of the outcome by as much, e.g. if every block
+    determines the outcome by itself. For a subset of many variables whose
+    proper subsets carry almost all the information of the outcome, the
+    bound is then far above the gap of the partitions actually found.
+    :param mask: a subset mask
+    :param mf_of_mask: a function of a subset mask to its mutual information
+    :param outcome_entropy: entropy of the outcome, if known
+    :return: an upper bound
+    """
+    bits = [1 << i for i in range(mask.bit_length()) if mask >> i & 1]
+    size = len(bits)
+    singles = np.cumsum([0] + sorted((mf_of_mask(bit) for bit in bits),
+                                     reverse=True))
+    block = max(mf_of_mask(mask ^ bit) for bit in bits) if size > 2 else 0
+    if outcome_entropy is not None:
+        block = min(block, outcome_entropy)
+    return max(singles[size - 2 * m] + m * block
+               for m in range(size // 2 + 1) if size - m >= 2)
 
 
 def complement_pairs(parent_set, include_self=False):
@@ -246,7 +788,10 @@ def complement_pairs(parent_set, include_self=False):
 
 def disjoint_series(parent_set, include_self=False):
     """
-    Given a set, return all series of disjoint subsets
+    Given a set, return all series of disjoint subsets. The number of
+    series grows as the Bell numbers, so this is only practical for small
+    sets; populate_syn_tree uses best_partitions instead, which does not
+    enumerate them.
     :param parent_set:
     :return:
     """
@@ -328,21 +873,27 @@ def trim_edges(conditional_mf_network, hpo_network, threshold=0.8):
         desire to keep w. In the end, we define a threshold (0 - 1): as
         along as the descendant carries a certain fraction of mf, we choose
         it over its ancestor (w).
+    Edges are taken in the order of the priority queue from a sorted list,
+    and an edge is still in the queue if its position is after the current
+    one. Only the neighbors that are ancestors or descendants of the other
+    node can be removed, so they are looked up in the HPO closure of the
+    nodes of the network (AncestorClosure) when there are fewer of them than
+    neighbors.
     :param conditional_mf_network: a network of mutual information
     conditioned on a common variable
     :param hpo_network: a MultiDiGraph for hpo
     :return: a trimmed network
     """
-    # make a copy of original conditional_mf_network
-    trimmed = copy.deepcopy(conditional_mf_network)
     ordered_edges = sorted(conditional_mf_network.edges.data('mf'),
                            key=lambda edge: edge[2], reverse=True)
-    # find the first edge from the remaining_edges that is still a valid edge
-    #  in the conditional_mf_network
+    # position of every edge in the queue, as (v, w) in the order listed
+    position = {(v, w): i for i, (v, w, _) in enumerate(ordered_edges)}
+    closure = AncestorClosure(hpo_network, conditional_mf_network.nodes)
+    adj = conditional_mf_network.adj
     remove_list = set()
-    while len(ordered_edges) > 1:
-        next_edge = ordered_edges.pop(0)
-        v, w, mf = next_edge
+    # as with a queue, the last edge is never analyzed
+    for i in range(len(ordered_edges) - 1):
+        v, w, mf = ordered_edges[i]
 
         # check both nodes:
         # for each node, check neighbors:
@@ -352,30 +903,13 @@ def trim_edges(conditional_mf_network, hpo_network, threshold=0.8):
         # still above a threshold (percentage), remove the current edge;
         # otherwise, remove the descendant
         if v not in remove_list:
-            for neighbor in trimmed.adj[v].keys():
-                mf_edge = trimmed[v][neighbor]['mf']
-                # check whether the edge is waiting to be analyzed
-                if (v, neighbor, mf_edge) in ordered_edges:
-                    # note: to find ancestors of an ontology term,
-                    # use networkx descendants
-                    if neighbor in nx.descendants(hpo_network, w):
-                        remove_list.add(neighbor)
-                        logging.info('worse ancestor detected: {} for {}, '
-                                     'remove {}'.format(neighbor, w, neighbor))
-                    if w in nx.descendants(hpo_network, neighbor) and \
-                            mf_edge/mf > threshold:
-                        remove_list.add(w)
+            _trim_neighbors(v, w, mf, i, adj, position, closure, threshold,
+                            remove_list)
         if w not in remove_list:
-            for neighbor in trimmed.adj[w].keys():
-                mf_edge = trimmed[w][neighbor]['mf']
-                # check whether the edge is waiting to be analyzed
-                if (w, neighbor, mf_edge) in ordered_edges:
-                    if neighbor in nx.descendants(hpo_network, v):
-                        remove_list.add(neighbor)
-                    if v in nx.descendants(hpo_network, neighbor) and \
-                            mf_edge/mf > threshold:
-                        remove_list.add(v)
+            _trim_neighbors(w, v, mf, i, adj, position, closure, threshold,
+                            remove_list)
 
+    trimmed = conditional_mf_network.copy()
     for node in remove_list:
         trimmed.remove_node(node)
     remove_list.clear()
@@ -383,7 +917,64 @@ def trim_edges(conditional_mf_network, hpo_network, threshold=0.8):
     return trimmed
 
 
+def _trim_neighbors(v, w, mf, i, adj, position, closure, threshold,
+                    remove_list):
+    # the neighbors of v whose edge (v, neighbor) is waiting to be analyzed,
+    # among the ancestors and descendants of w
+    ancestors = closure.ancestors[w]
+    descendants = closure.descendants[w]
+    if len(ancestors) + len(descendants) < len(adj[v]):
+        worse = [neighbor for neighbor in ancestors if neighbor in adj[v]]
+        better = [neighbor for neighbor in descendants if neighbor in adj[v]]
+    else:
+        worse = [neighbor for neighbor in adj[v] if neighbor in ancestors]
+        better = [neighbor for neighbor in adj[v] if neighbor in descendants]
+    for neighbor in worse:
+        if position.get((v, neighbor), -1) > i:
+            remove_list.add(neighbor)
+            logging.info('worse ancestor detected: {} for {}, '
+                         'remove {}'.format(neighbor, w, neighbor))
+    for neighbor in better:
+        if position.get((v, neighbor), -1) > i and \
+                adj[v][neighbor]['mf']/mf > threshold:
+            remove_list.add(w)
+
+
+class AncestorClosure:
+    """
+    Ancestors and descendants of HPO terms among a set of nodes, e.g. the
+    phenotypes of a network. Nodes that are not in the HPO have neither.
+    """
+    def __init__(self, hpo_network, nodes):
+        """
+        :param hpo_network: a MultiDiGraph for hpo, edges from a term to its
+        parents
+        :param nodes: the nodes to keep in the closure
+        """
+        nodes = set(nodes)
+        self.ancestors = {}
+        self.descendants = {node: set() for node in nodes}
+        for node in nodes:
+            if node in hpo_network:
+                # note: to find ancestors of an ontology term, use networkx
+                # descendants
+                ancestors = nodes.intersection(nx.descendants(hpo_network,
+                                                              node))
+            else:
+                ancestors = set()
+            self.ancestors[node] = ancestors
+            for ancestor in ancestors:
+                self.descendants[ancestor].add(node)
+
+
 def precompute_disjoint_series(n, include_self=False, save_path=None):
+    """
+    Deprecated: the precomputed series were only used by populate_syn_tree,
+    which no longer enumerates partitions.
+    """
+    warnings.warn('precompute_disjoint_series is deprecated, synergy trees '
+                  'no longer use precomputed disjoint series',
+                  DeprecationWarning, stacklevel=2)
     original_set = list(range(n))
     result = disjoint_series(original_set, include_self)
     if save_path is not None:
@@ -0,0 +1,111 @@
+import mf_random
+from distribution_store import DistributionStore
+import distribution_store
+import unittest
+import tempfile
+import numpy as np
+import os.path
+
+
+class TestDistributionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temppath = tempfile.mkdtemp()
+        rng = np.random.default_rng(1)
+        self.chunks = [{'synergy': rng.normal(size=[4, 3, n]),
+                        'mf_Xz': rng.normal(size=[4, n])}
+                       for n in [5, 7, 4]]
+
+    def test_append_and_read(self):
+        for compress in [False, True]:
+            store = DistributionStore(os.path.join(self.temppath,
+                                                   str(compress)),
+                                      compress=compress)
+            self.assertEqual(store.simulations(), 0)
+            self.assertEqual(store.load(), dict())
+            store.append(self.chunks[0], job_id=1)
+            store.append(self.chunks[1], job_id=1)
+            store.append(self.chunks[2], job_id=2)
+            self.assertEqual(store.simulations(), 16)
+            self.assertEqual(store.simulations(job_id=1), 12)
+            self.assertEqual(store.simulations(job_id=3), 0)
+
+            synergy = np.concatenate([c['synergy'] for c in self.chunks],
+                                     axis=-1).astype(np.float32)
+            np.testing.assert_array_equal(store.read('synergy'), synergy)
+            np.testing.assert_array_equal(store.read('synergy', (2, 1)),
+                                          synergy[2, 1])
+            np.testing.assert_array_equal(
+                store.read('synergy', (np.array([0, 3]), np.array([2, 1]))),
+                synergy[[0, 3], [2, 1]])
+            loaded = store.load()
+            self.assertEqual(set(loaded), {'synergy', 'mf_Xz'})
+            self.assertEqual(loaded['mf_Xz'].dtype, np.float32)
+
+            # a new instance resumes from the manifests
+            reopened = DistributionStore(store.path)
+            self.assertEqual(reopened.simulations(job_id=1), 12)
+
+        self.assertRaises(ValueError, lambda: store.append(
+            {'synergy': np.zeros([4, 3, 2]), 'mf_Xz': np.zeros([4, 3])}))
+
+    def test_p_values(self):
+        store = DistributionStore(self.temppath)
+        for chunk in self.chunks:
+            store.append(chunk)
+        rng = np.random.default_rng(2)
+        observed = {'synergy': rng.normal(size=[4, 3]),
+                    'mf_Xz': rng.normal(size=4),
+                    'mf_Yz': rng.normal(size=3)}
+        loaded = store.load()
+        for budget in [2**30, 100]:
+            p = store.p_values(observed, memory_budget=budget)
+            self.assertNotIn('mf_Yz', p)
+            np.testing.assert_almost_equal(
+                p['synergy'], mf_random.p_value_estimate(
+                    observed['synergy'], loaded['synergy']))
+            np.testing.assert_almost_equal(
+                p['mf_Xz'], mf_random.p_value_estimate(
+                    observed['mf_Xz'].reshape([1, 4]),
+                    loaded['mf_Xz'].reshape([1, 4, -1]))[0])
+        # packed pairs
+        pairs = (np.array([0, 0, 1]), np.array([1, 2, 2]))
+        p = store.p_values({'synergy': observed['synergy'][pairs]},
+                           pairs=pairs)
+        np.testing.assert_almost_equal(
+            p['synergy'], mf_random.p_value_estimate(
+                observed['synergy'], loaded['synergy'])[pairs])
+
+    def test_exceedances(self):
+        distribution = np.arange(24).reshape([6, 4])
+        observed = np.array([-1, 4, 8.5, 13.5, 19, 24])
+        for alternative in ['two.sided', 'left', 'right']:
+            expected = mf_random.p_value_estimate(
+                observed.reshape([2, 3]), distribution.reshape([2, 3, 4]),
+                alternative).ravel() * 4
+            np.testing.assert_almost_equal(
+                distribution_store.exceedances(observed, distribution,
+                                               alternative), expected)
+
+
+    def test_exceedances_ties(self):
+        # simulations equal to the observed values are counted, although
+        # the store keeps them in float32
+        observed = np.array([0.1, 0.3, 0.7])
+        distribution = np.repeat(observed[:, np.newaxis], 10, axis=1)
+        store = DistributionStore(self.temppath)
+        store.append({'mf_Xz': distribution})
+        for alternative in ['two.sided', 'left', 'right']:
+            np.testing.assert_array_equal(
+                distribution_store.exceedances(
+                    observed, distribution.astype(np.float32), alternative),
+                [10, 10, 10])
+            # both tails of a distribution concentrated at the observed
+            # value count each simulation once
+            np.testing.assert_array_equal(
+                store.p_values({'mf_Xz': observed},
+                               alternative=alternative)['mf_Xz'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import mf
+import mf_parallel
+import unittest
+import numpy as np
+
+
+class TestMFParallel(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(110)
+        N = 1000
+        self.X = np.random.randint(0, 2, N * 6).reshape([N, 6])
+        self.Y = np.random.randint(0, 2, N * 4).reshape([N, 4])
+        self.z = np.random.randint(0, 2, N)
+        # the last batch is smaller than the others
+        self.batches = [(self.X[i:i + 150], self.Y[i:i + 150],
+                         self.z[i:i + 150]) for i in range(0, N, 150)]
+        self.X_names = ['HP:{}'.format(i) for i in range(6)]
+        self.Y_names = ['HP:{}'.format(i) for i in range(6, 10)]
+
+    def test_summarize_in_parallel(self):
+        summaries = [mf.SummaryXYz(self.X_names, self.Y_names, 'z',
+                                   compact=True),
+                     mf.SymmetricSummaryXYz(self.X_names, 'z'),
+                     mf.SummaryXY(self.X_names, self.Y_names)]
+        merged = mf_parallel.summarize_in_parallel(
+            summaries, iter(self.batches), routes=[(0, 1, 2), (0, 2), (0, 1)],
+            workers=3, slots=2)
+
+        expected = mf.SummaryXYz(self.X_names, self.Y_names, 'z')
+        expected.add_batch(self.X, self.Y, self.z)
+        np.testing.assert_array_equal(merged[0].m2, expected.m2)
+        self.assertEqual(merged[0].case_N, expected.case_N)
+        expected = mf.SymmetricSummaryXYz(self.X_names, 'z')
+        expected.add_batch(self.X, self.z)
+        np.testing.assert_array_equal(merged[1].m2, expected.m2)
+        expected = mf.SummaryXY(self.X_names, self.Y_names)
+        expected.add_batch(self.X, self.Y)
+        np.testing.assert_array_equal(merged[2].m, expected.m)
+        self.assertEqual(merged[2].N, 1000)
+        # the summaries passed in are only templates
+        self.assertEqual(summaries[0].case_N, 0)
+
+    def test_worker_error(self):
+        summaries = [mf.SummaryXY(self.X_names, self.X_names)]
+        with self.assertRaises(RuntimeError):
+            mf_parallel.summarize_in_parallel(summaries, self.batches,
+                                              workers=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,10 @@
 import src.main.python.mf as mf
 import src.main.python.mf_random as mf_random
 import unittest
+from unittest import mock
 import numpy as np
+from scipy import sparse
+from scipy import stats
 from os import path
 import pickle
 import tempfile
@@ -51,6 +54,18 @@ class TestMFRandom(unittest.TestCase):
                                                                      100])
         self.assertEqual(list(distribution['synergy'].shape), [10, 10, 100])
 
+    def test_simulate_prevalence(self):
+        # the null keeps the observed prevalence of the diagnosis and the
+        # phenotypes
+        randomiser = mf_random.MutualInfoRandomizer(self.summary)
+        with mock.patch.object(mf_random,
+                               'create_empirical_distribution') as create:
+            randomiser.simulate(simulations=10)
+        diag_prob, phenotype_prob1, phenotype_prob2 = create.call_args[0][:3]
+        self.assertAlmostEqual(diag_prob, np.mean(self.d))
+        np.testing.assert_allclose(phenotype_prob1, np.mean(self.P, axis=0))
+        np.testing.assert_allclose(phenotype_prob2, np.mean(self.P, axis=0))
+
     def test_p_value_estimate(self):
         ordered = np.arange(24).reshape([2, 3, 4])
         query = np.array([[-1, 4, 8.5], [13.5, 19, 24]])
@@ -78,6 +93,332 @@ class TestMFRandom(unittest.TestCase):
         self.assertRaises(ValueError, lambda: mf_random.p_value_estimate(query,
                                             ordered, alternative='e'))
 
+    def test_ExceedanceAccumulator(self):
+        rng = np.random.default_rng(3)
+        observed = {'synergy': rng.normal(size=[3, 4]),
+                    'mf_Xz': rng.normal(size=3)}
+        simulated = [{key: rng.normal(size=value.shape)
+                      for key, value in observed.items()}
+                     for _ in range(50)]
+        distribution = {key: np.stack([s[key] for s in simulated], axis=-1)
+                        for key in observed}
+
+        def expected(key, alternative):
+            return mf_random.p_value_estimate(
+                observed[key].reshape([-1, observed[key].shape[-1]]),
+                distribution[key].reshape(
+                    [-1, observed[key].shape[-1], 50]),
+                alternative).reshape(observed[key].shape)
+
+        for alternative in ['left', 'right']:
+            accumulator = mf_random.ExceedanceAccumulator(
+                observed, alternative=alternative)
+            for s in simulated:
+                accumulator.update(s)
+            for key in observed:
+                np.testing.assert_almost_equal(
+                    accumulator.p_values()[key], expected(key, alternative))
+
+        # two-sided p values from the center of the same simulations
+        center = {key: np.mean(value, axis=-1)
+                  for key, value in distribution.items()}
+        accumulator = mf_random.ExceedanceAccumulator(observed,
+                                                      center=center)
+        for s in simulated:
+            accumulator.update(s)
+        for key in observed:
+            np.testing.assert_almost_equal(accumulator.p_values()[key],
+                                           expected(key, 'two.sided'))
+            np.testing.assert_almost_equal(accumulator.mean[key],
+                                           center[key])
+
+        # the center is estimated from the burn in, which is not counted
+        accumulator = mf_random.ExceedanceAccumulator(observed, burn_in=10)
+        self.assertRaises(ValueError, accumulator.p_values)
+        for s in simulated:
+            accumulator.update(s)
+        self.assertEqual(accumulator.n, 40)
+        self.assertEqual(accumulator.n_total, 50)
+        for key in observed:
+            np.testing.assert_almost_equal(
+                accumulator.center[key],
+                np.mean(distribution[key][..., :10], axis=-1))
+
+        # counts of several jobs can be merged
+        first = mf_random.ExceedanceAccumulator(observed, center=center)
+        second = mf_random.ExceedanceAccumulator(observed, center=center)
+        for i, s in enumerate(simulated):
+            (first if i < 20 else second).update(s)
+        first.merge(second)
+        for key in observed:
+            np.testing.assert_almost_equal(first.p_values()[key],
+                                           expected(key, 'two.sided'))
+        self.assertRaises(ValueError, lambda: first.merge(accumulator))
+
+    def test_simulate_p_values(self):
+        randomiser = mf_random.MutualInfoRandomizer(self.summary)
+        p = randomiser.simulate_p_values(simulations=100, cpu=2,
+                                         method='multinomial', burn_in=20)
+        self.assertEqual(list(p['synergy'].shape), [10, 10])
+        self.assertEqual(list(p['mf_Xz'].shape), [10])
+        self.assertEqual(randomiser.accumulator.n, 100)
+        self.assertTrue(np.all((p['synergy'] >= 0) & (p['synergy'] <= 1)))
+
+    def test_sequential_p_values(self):
+        rng = np.random.default_rng(5)
+        pair_prob = np.array([0.1, 0.3, 0.5, 0.2])
+        simulated = mf_random.simulate_pair_metrics(0.3, pair_prob, pair_prob,
+                                                    2000, 400, rng, block=600)
+        self.assertEqual(list(simulated['synergy'].shape), [400, 4])
+        tables = [mf_random.synergy_random_tables(0.3, pair_prob, pair_prob,
+                                                  2000, seed=i)
+                  for i in range(400)]
+        for metric in ['mf_XY_z', 'synergy']:
+            np.testing.assert_allclose(
+                np.mean(simulated[metric], axis=0),
+                np.mean([np.diagonal(t[metric]) for t in tables], axis=0),
+                atol=5e-4)
+
+        # the first pair is extreme, the others are typical of the null
+        observed = {'synergy': np.array([0.05, 0, 0, 0])}
+        p, simulations = mf_random.sequential_p_values(
+            observed, 0.3, pair_prob, pair_prob, 2000, h=5,
+            max_simulations=500, batch=50, rng=rng)
+        self.assertEqual(simulations['synergy'][0], 500)
+        self.assertAlmostEqual(p['synergy'][0], 1 / 501)
+        self.assertTrue(np.all(simulations['synergy'][1:] < 50))
+        np.testing.assert_almost_equal(p['synergy'][1:],
+                                       5 / simulations['synergy'][1:])
+
+    def test_sequential_p_values_randomizer(self):
+        randomiser = mf_random.MutualInfoRandomizer(self.summary)
+        p, simulations = randomiser.sequential_p_values(
+            h=5, max_simulations=200, metrics=('synergy', 'mf_XY_z'),
+            burn_in=20, seed=1)
+        self.assertEqual(list(p['synergy'].shape), [10, 10])
+        self.assertEqual(list(simulations['mf_XY_z'].shape), [10, 10])
+        self.assertTrue(np.all(simulations['synergy'] <= 200))
+        self.assertTrue(np.all((p['synergy'] > 0) & (p['synergy'] <= 1)))
+
+    def test_randomizer_compact(self):
+        compact = mf.SummaryXYz(self.summary.vars_labels['set1'],
+                                self.summary.vars_labels['set2'],
+                                'heart failure', compact=True)
+        compact.add_batch(self.P, self.P, self.d)
+        with mock.patch.object(mf, 'expand_XYz_counts') as expand:
+            randomiser = mf_random.MutualInfoRandomizer(compact)
+            expand.assert_not_called()
+        np.testing.assert_array_equal(randomiser.m2, self.summary.m2)
+
+    def test_permuted_summaries(self):
+        N = 300
+        rng = np.random.default_rng(2)
+        P1 = (rng.uniform(size=[N, 5]) < 0.3).astype(int)
+        P2 = (rng.uniform(size=[N, 4]) < 0.2).astype(int)
+        d = (rng.uniform(size=N) < 0.25).astype(int)
+        case_N = np.sum(d)
+        for P1_, P2_ in [(P1, P2), (sparse.csr_matrix(P1), P2)]:
+            summaries = list(mf_random.permuted_summaries(
+                P1_, P2_, d, 5, batch=2, rng=np.random.default_rng(9)))
+            self.assertEqual(len(summaries), 5)
+            replay = np.random.default_rng(9)
+            for summary in summaries:
+                permuted = np.zeros(N, dtype=int)
+                permuted[replay.permutation(N)[:case_N]] = 1
+                expected = mf.SummaryXYz(np.arange(5), np.arange(4), 'd')
+                expected.add_batch(P1, P2, permuted)
+                np.testing.assert_array_equal(summary.m2, expected.m2)
+                np.testing.assert_array_equal(summary.m1['set1'],
+                                              expected.m1['set1'])
+                np.testing.assert_array_equal(summary.m1['set2'],
+                                              expected.m1['set2'])
+                self.assertEqual(summary.case_N, case_N)
+
+    def test_permute(self):
+        randomiser = mf_random.MutualInfoRandomizer(self.summary)
+        randomiser.permute(self.P, self.P, self.d, permutations=20, batch=8,
+                           seed=1)
+        self.assertEqual(list(randomiser.empirical_distribution[
+                                  'synergy'].shape), [10, 10, 20])
+        p = randomiser.p_values()
+        self.assertEqual(list(p['synergy'].shape), [10, 10])
+        p = randomiser.permutation_p_values(self.P, self.P, self.d,
+                                            permutations=20, batch=8,
+                                            seed=1, burn_in=5)
+        self.assertEqual(randomiser.accumulator.n, 20)
+        # mutual information regardless of z does not change under
+        # permutation, so every permutation is as extreme as observed
+        np.testing.assert_array_equal(p['mf_XY_omit_z'], 1)
+
+        # the columns of symmetric summaries are sorted by name
+        names = ['HP:' + str(i) for i in [3, 1, 10, 2, 4, 6, 5, 8, 7, 9]]
+        order = np.argsort(names)
+        symmetric = mf.SymmetricSummaryXYz(names, 'heart failure')
+        symmetric.add_batch(self.P, self.d)
+        randomiser = mf_random.MutualInfoRandomizer(symmetric)
+        randomiser.permute(self.P, self.P, self.d, permutations=20, batch=8,
+                           seed=1)
+        P = self.P[:, order]
+        full = mf.SummaryXYz(np.sort(names), np.sort(names), 'heart failure')
+        full.add_batch(P, P, self.d)
+        expected = mf_random.MutualInfoRandomizer(full)
+        expected.permute(P, P, self.d, permutations=20, batch=8, seed=1)
+        for key in expected.empirical_distribution:
+            np.testing.assert_array_equal(
+                randomiser.empirical_distribution[key],
+                expected.empirical_distribution[key])
+        rows, cols = symmetric.pairs
+        np.testing.assert_array_equal(randomiser.p_values()['synergy'],
+                                      expected.p_values()['synergy'][rows,
+                                                                     cols])
+        p = randomiser.permutation_p_values(self.P, self.P, self.d,
+                                            permutations=20, batch=8,
+                                            seed=1, burn_in=5)
+        p_full = expected.permutation_p_values(P, P, self.d, permutations=20,
+                                               batch=8, seed=1, burn_in=5)
+        np.testing.assert_array_equal(p['synergy'],
+                                      p_full['synergy'][rows, cols])
+
+    def test_min_expected_counts(self):
+        expected = mf_random.min_expected_counts(self.heart_failure)
+        N = len(self.d)
+        z = np.array([np.sum(self.d), N - np.sum(self.d)])
+        x = np.array([np.sum(self.P[:, 1]), N - np.sum(self.P[:, 1])])
+        y = np.array([np.sum(self.P[:, 2]), N - np.sum(self.P[:, 2])])
+        self.assertAlmostEqual(expected['mf_Xz'][1], min(x) * min(z) / N)
+        self.assertAlmostEqual(expected['mf_XY_omit_z'][1, 2],
+                               min(x) * min(y) / N)
+        xy = [np.sum((self.P[:, 1] == a) & (self.P[:, 2] == b))
+              for a in [1, 0] for b in [1, 0]]
+        self.assertAlmostEqual(expected['mf_XY_z'][1, 2], min(xy) * min(z) / N)
+        strata = []
+        for k in [1, 0]:
+            cases = self.d == k
+            x_k = [np.sum(self.P[cases, 1] == a) for a in [1, 0]]
+            y_k = [np.sum(self.P[cases, 2] == a) for a in [1, 0]]
+            strata.append(min(x_k) * min(y_k) / np.sum(cases))
+        self.assertAlmostEqual(expected['mf_XY_given_z'][1, 2], min(strata))
+
+    def test_asymptotic_p_values(self):
+        randomiser = mf_random.MutualInfoRandomizer(self.summary)
+        p = randomiser.p_values(method='asymptotic')
+        self.assertNotIn('synergy', p)
+        self.assertEqual(list(p['mf_XY_given_z'].shape), [10, 10])
+        # G test p values agree with the empirical ones when counts are large
+        observed = self.heart_failure.metrics()
+        N = len(self.d)
+        for key, df in [('mf_Xz', 1), ('mf_XY_z', 3), ('mf_XY_given_z', 2)]:
+            self.assertAlmostEqual(
+                p[key].flat[1],
+                1 - stats.chi2.cdf(2 * N * np.log(2) * observed[key].flat[1],
+                                   df))
+        randomiser.simulate(simulations=100, method='multinomial', cpu=2)
+        p = randomiser.p_values(method='asymptotic', adjust='Bonferroni')
+        self.assertEqual(list(p['synergy'].shape), [10, 10])
+        self.assertRaises(ValueError,
+                          lambda: randomiser.p_values(method='exact'))
+
+        # rare phenotypes fall back to simulations
+        N = 2000
+        rng = np.random.default_rng(4)
+        P = (rng.uniform(size=[N, 3]) < [0.002, 0.3, 0.5]).astype(int)
+        d = (rng.uniform(size=N) < 0.3).astype(int)
+        summary = mf.SummaryXYz(np.arange(3), np.arange(3), 'd')
+        summary.add_batch(P, P, d)
+        randomiser = mf_random.MutualInfoRandomizer(summary)
+        g_test = randomiser.asymptotic_p_values(simulations=0)
+        mixed = randomiser.asymptotic_p_values(simulations=200, seed=1)
+        # x = y leaves cells empty, so the diagonal is simulated too
+        self.assertEqual(mixed['mf_XY_z'][1, 2], g_test['mf_XY_z'][1, 2])
+        self.assertEqual(mixed['mf_XY_z'][2, 1], g_test['mf_XY_z'][2, 1])
+        self.assertNotEqual(mixed['mf_Xz'][0], g_test['mf_Xz'][0])
+        self.assertEqual(mixed['mf_Xz'][1], g_test['mf_Xz'][1])
+        # the simulations test the upper tail, as the G test does
+        diag_prob, phenotype_prob1, _, _ = randomiser._null_parameters()
+        simulated = mf_random.simulate_Xz_metrics(
+            diag_prob, phenotype_prob1[:1], N, 200, np.random.default_rng(1))
+        observed = mf.MutualInfoXYz(summary).mutual_info_Xz()[0]
+        self.assertAlmostEqual(mixed['mf_Xz'][0],
+                               np.mean(simulated[:, 0] >= observed))
+        # simulated p values are multiples of 1 / simulations
+        np.testing.assert_almost_equal(mixed['mf_XY_z'][0] * 200,
+                                       np.round(mixed['mf_XY_z'][0] * 200))
+
+    def test_Bonferroni(self):
+        rng = np.random.default_rng(5)
+        P = (rng.uniform(size=[1000, 5]) < 0.3).astype(int)
+        d = (rng.uniform(size=1000) < 0.4).astype(int)
+        names = ['HP:3', 'HP:1', 'HP:5', 'HP:2', 'HP:4']
+        different = mf.SummaryXYz(names[:3], names[3:], 'd')
+        different.add_batch(P[:, :3], P[:, 3:], d)
+        same = mf.SummaryXYz(names, names, 'd')
+        same.add_batch(P, P, d)
+        packed = mf.SymmetricSummaryXYz(names, 'd')
+        packed.add_batch(P, d)
+        for summary, n_X, n_Y, n_XY in [(different, 3, 2, 6),
+                                        (same, 5, 5, 15),
+                                        (packed, 5, 5, 15)]:
+            randomiser = mf_random.MutualInfoRandomizer(summary)
+            p = randomiser.asymptotic_p_values(simulations=0)
+            adjusted = randomiser.p_values(method='asymptotic',
+                                           adjust='Bonferroni',
+                                           simulations=0)
+            np.testing.assert_allclose(adjusted['mf_Xz'], p['mf_Xz'] * n_X)
+            np.testing.assert_allclose(adjusted['mf_Yz'], p['mf_Yz'] * n_Y)
+            for key in ['mf_XY_z', 'mf_XY_given_z', 'mf_XY_omit_z']:
+                np.testing.assert_allclose(adjusted[key], p[key] * n_XY)
+
+    def test_importance_p_values(self):
+        rng = np.random.default_rng(3)
+        N = 2000
+        pair_prob1 = np.array([0.3, 0.3, 0.1])
+        pair_prob2 = np.array([0.4, 0.2, 0.5])
+        p0 = mf_random.null_cell_probabilities(0.3, pair_prob1, pair_prob2)
+        np.testing.assert_almost_equal(np.sum(p0, axis=-1), 1)
+        # +--
+        self.assertAlmostEqual(p0[1, 3], 0.3 * 0.8 * 0.7)
+        # synergy of cell probabilities tilted along the contrast
+        contrast = mf_random.synergy_contrast(0.3)
+        t = mf_random._synergy_tilt(p0, contrast, np.array([1e-3, 0, 1e-3]))
+        synergy = mf_random.table_metrics(
+            mf_random.tilted_cell_probabilities(p0, contrast, t))['synergy']
+        np.testing.assert_almost_equal(synergy, [1e-3, 0, 1e-3])
+
+        # agrees with brute-force simulation where that is feasible
+        observed = np.array([2, 0.3, 5]) / (2 * N * np.log(2))
+        p, se = mf_random.importance_p_values(observed, 0.3, pair_prob1,
+                                              pair_prob2, N, samples=4000,
+                                              rng=rng)
+        simulated = mf_random.simulate_pair_metrics(
+            0.3, pair_prob1, pair_prob2, N, 20000, rng)['synergy']
+        center = np.mean(simulated, axis=0)
+        distance = np.abs(observed - center)
+        brute_force = np.mean((simulated <= center - distance) |
+                              (simulated >= center + distance), axis=0)
+        self.assertTrue(np.all(np.abs(p - brute_force) <
+                               4 * (se + np.sqrt(brute_force / 20000))))
+
+        # resolves p values far below 1 / samples; asymptotically,
+        # 2 * N * ln(2) * synergy follows a chi-square with 1 degree of
+        # freedom
+        observed = np.array([36]) / (2 * N * np.log(2))
+        p, se = mf_random.importance_p_values(observed, 0.3, pair_prob1[:1],
+                                              pair_prob2[:1], N, samples=4000,
+                                              rng=rng, alternative='right')
+        self.assertTrue(0 < p[0] < 1e-6)
+        self.assertAlmostEqual(np.log10(p[0]), np.log10(stats.chi2.sf(36, 1)),
+                               delta=0.5)
+
+    def test_importance_p_values_randomizer(self):
+        randomiser = mf_random.MutualInfoRandomizer(self.summary)
+        mask = np.zeros([10, 10], dtype=bool)
+        mask[0, 1:4] = True
+        p, se = randomiser.importance_p_values(samples=500, mask=mask, seed=1)
+        self.assertEqual(list(p.shape), [10, 10])
+        self.assertTrue(np.all(np.isnan(p[~mask])))
+        self.assertTrue(np.all((p[mask] > 0) & (p[mask] <= 1)))
+        self.assertTrue(np.all(se[mask] >= 0))
+
     def test_synergy_random(self):
         disease_prevalence = 0.4
         phenotype_prob = np.random.uniform(0, 1, 10)
@@ -86,6 +427,143 @@ class TestMFRandom(unittest.TestCase):
                  phenotype_prob, sample_per_simulation)['synergy']
         np.testing.assert_almost_equal(S, np.zeros(S.shape), decimal=3)
 
+    def test_simulate_summaries(self):
+        phenotype_prob1 = np.array([0.001, 0.02, 0, 0.3, 0.6])
+        phenotype_prob2 = np.array([0.04, 0.5, 0.1])
+        N = 3000
+        summaries = mf_random.simulate_summaries(
+            0.3, phenotype_prob1, phenotype_prob2, N,
+            [np.random.default_rng(seed) for seed in [3, 4]], block=N)
+        for seed, summary in zip([3, 4], summaries):
+            # draw the same observations one replicate at a time, in the
+            # order of the kernel, and count them
+            rng = np.random.default_rng(seed)
+            d = rng.random(N) < 0.3
+            P1 = np.zeros([N, 5], dtype=int)
+            P2 = np.zeros([N, 3], dtype=int)
+            j, i = mf_random._rare_positions(rng, phenotype_prob1[0:3], N)
+            P1[i, j] = 1
+            j, i = mf_random._rare_positions(rng, phenotype_prob2[0:1], N)
+            P2[i, j] = 1
+            P1[:, 3:] = rng.random([N, 2], dtype=np.float32) < \
+                phenotype_prob1[3:].astype(np.float32)
+            P2[:, 1:] = rng.random([N, 2], dtype=np.float32) < \
+                phenotype_prob2[1:].astype(np.float32)
+            expected = mf.SummaryXYz(np.arange(5), np.arange(3), 'mocked')
+            expected.add_batch(P1, P2, d.astype(int))
+            self.assertEqual(summary.case_N, np.sum(d))
+            self.assertEqual(np.sum(P1[:, 2]), 0)
+            np.testing.assert_array_equal(summary.m2, expected.m2)
+            np.testing.assert_array_equal(summary.m1['set1'],
+                                          expected.m1['set1'])
+            np.testing.assert_array_equal(summary.m1['set2'],
+                                          expected.m1['set2'])
+
+    def test_synergy_random_batched(self):
+        phenotype_prob = np.array([0.01, 0.05, 0.2, 0.5])
+        kwargs = dict(disease_prevalence=0.2, phenotype_prob1=phenotype_prob,
+                      phenotype_prob2=phenotype_prob, sample_size=2000)
+        batched = mf_random.synergy_random_batched(seeds=list(range(400)),
+                                                   **kwargs)
+        self.assertEqual(list(batched['synergy'].shape), [4, 4, 400])
+        # a replicate does not depend on the batch it is simulated in
+        single = mf_random.synergy_random_bits(seed=7, **kwargs)
+        for key in single:
+            np.testing.assert_array_equal(single[key], batched[key][..., 7])
+        tables = [mf_random.synergy_random_tables(seed=i, **kwargs)
+                  for i in range(400)]
+        for key in ['mf_Xz', 'mf_XY_z', 'synergy']:
+            np.testing.assert_allclose(
+                np.mean(batched[key], axis=-1),
+                np.mean([res[key] for res in tables], axis=0), atol=2e-4)
+        with mf_random.SimulationPool(cpu=2) as pool:
+            distribution = pool.create_empirical_distribution(
+                *kwargs.values(), SIMULATION_SIZE=12, method='batched',
+                chunksize=5)
+        np.testing.assert_array_equal(distribution['synergy'],
+                                      batched['synergy'][..., 0:12])
+
+    def test_simulate_count_tables(self):
+        rng = np.random.default_rng(7)
+        phenotype_prob1 = np.array([0.001, 0.05, 0.3, 0.9])
+        phenotype_prob2 = np.array([0.02, 0.5, 0.7])
+        summary = mf_random.simulate_count_tables(0.3, phenotype_prob1,
+                                                  phenotype_prob2, 5000, rng)
+        self.assertEqual(summary.case_N + summary.control_N, 5000)
+        m2 = summary.m2
+        self.assertEqual(list(m2.shape), [4, 3, 8])
+        self.assertTrue(np.all(m2 >= 0))
+        np.testing.assert_array_equal(np.sum(m2, axis=-1), 5000)
+        # the xyz tables agree with the xz and yz tables
+        np.testing.assert_array_equal(m2[:, 0, 0:4].sum(axis=-1),
+                                      summary.m1['set1'][:, [0, 1]].sum(
+                                          axis=-1))
+        np.testing.assert_array_equal(m2[0, :, [0, 1, 4, 5]].T.sum(axis=-1),
+                                      summary.m1['set2'][:, [0, 1]].sum(
+                                          axis=-1))
+
+        S = mf_random.synergy_random_tables(0.4, phenotype_prob1,
+                                            phenotype_prob2, 5000,
+                                            seed=1)['synergy']
+        np.testing.assert_almost_equal(S, np.zeros(S.shape), decimal=3)
+
+    def test_create_empirical_distribution_multinomial(self):
+        phenotype_prob = np.array([0.05, 0.2, 0.5])
+        kwargs = dict(diag_prevalence=0.2, phenotype_prob1=phenotype_prob,
+                      phenotype_prob2=phenotype_prob,
+                      sample_per_simulation=1000, SIMULATION_SIZE=300, cpu=2)
+        direct = mf_random.create_empirical_distribution(
+            method='multinomial', **kwargs)
+        counted = mf_random.create_empirical_distribution(**kwargs)
+        self.assertEqual(list(direct['synergy'].shape), [3, 3, 300])
+        for key in ['mf_Xz', 'mf_XY_z', 'mf_XY_given_z', 'synergy']:
+            np.testing.assert_allclose(np.mean(direct[key], axis=-1),
+                                       np.mean(counted[key], axis=-1),
+                                       atol=5e-4)
+        self.assertRaises(ValueError, lambda:
+                          mf_random.create_empirical_distribution(
+                              method='exact', **kwargs))
+
+    def test_SimulationPool(self):
+        phenotype_prob1 = np.array([0.05, 0.2, 0.5])
+        phenotype_prob2 = np.array([0.1, 0.3])
+        args = (0.2, phenotype_prob1, phenotype_prob2, 500)
+        expected = [mf_random.synergy_random(*args, seed=i + 2 * 20)
+                    for i in range(5, 17)]
+        with mf_random.SimulationPool(cpu=2) as pool:
+            # the pool is reused by later calls, with different chunks
+            for chunksize in [1, 5, None]:
+                distribution = pool.create_empirical_distribution(
+                    *args, SIMULATION_SIZE=20, job_id=2, first=5, last=17,
+                    chunksize=chunksize)
+                self.assertEqual(list(distribution['mf_Xz'].shape), [3, 12])
+                self.assertEqual(list(distribution['mf_Yz'].shape), [2, 12])
+                for key in expected[0]:
+                    np.testing.assert_array_equal(
+                        distribution[key],
+                        np.stack([res[key] for res in expected], axis=-1))
+            # another disease, and a function call with the pool
+            distribution = mf_random.create_empirical_distribution(
+                0.4, phenotype_prob2, phenotype_prob1, 500, 8, pool=pool)
+            self.assertEqual(list(distribution['synergy'].shape), [2, 3, 8])
+
+    def test_slab_directory(self):
+        free = {'/dev/shm': 64 * 2 ** 20, tempfile.gettempdir(): 2 ** 40}
+
+        def statvfs(directory):
+            return mock.Mock(f_bavail=free[directory], f_frsize=1)
+
+        with mock.patch.object(mf_random.os, 'statvfs', statvfs), \
+                mock.patch.object(mf_random.os.path, 'isdir',
+                                  lambda directory: True):
+            self.assertEqual(mf_random._slab_directory(2 ** 20), '/dev/shm')
+            # slabs that do not fit into /dev/shm go to the temporary
+            # directory
+            self.assertEqual(mf_random._slab_directory(2 ** 30),
+                             tempfile.gettempdir())
+            with self.assertRaises(OSError):
+                mf_random._slab_directory(2 ** 41)
+
     def test_serializing_instance(self):
         cases = sum(self.d)
         with open(path.join(self.tempdir, 'test_serializing.obj'), 'wb') as \
@@ -1,8 +1,11 @@
 import unittest
 import src.main.python.mf as mf
 import numpy as np
+from scipy import sparse
 import math
+import os
 import tempfile
+import pickle
 
 
 class TestMF(unittest.TestCase):
@@ -66,6 +69,82 @@ class TestMF(unittest.TestCase):
         self.assertEqual(ppd[2, 3, :].tolist(), [0,0,2,1,0,2,0,1])
         self.assertEqual(ppd[3, 3, :].tolist(), [0,2,0,0,0,0,2,2])
 
+    def test_summarize_XYz_matches_brute_force(self):
+        np.random.seed(101)
+        X = np.random.randint(0, 2, 60).reshape([12, 5])
+        Y = np.random.randint(0, 2, 36).reshape([12, 3])
+        z = np.random.randint(0, 2, 12)
+        ppd = mf.summarize_XYz(X, Y, z)
+        outcomes = [(1, 1, 1), (1, 1, 0), (1, 0, 1), (1, 0, 0),
+                    (0, 1, 1), (0, 1, 0), (0, 0, 1), (0, 0, 0)]
+        for i in range(5):
+            for j in range(3):
+                expected = [np.sum((X[:, i] == a) & (Y[:, j] == b) & (z == c))
+                            for a, b, c in outcomes]
+                self.assertEqual(ppd[i, j, :].tolist(), expected)
+
+    def test_add_batch_reuses_workspace(self):
+        np.random.seed(102)
+        X = np.random.randint(0, 2, 200).reshape([40, 5])
+        Y = np.random.randint(0, 2, 160).reshape([40, 4])
+        z = np.random.randint(0, 2, 40)
+        summary = mf.SummaryXYz(np.arange(5), np.arange(4), 'z')
+        summary_XY = mf.SummaryXY(np.arange(5), np.arange(4))
+        # uneven batches to make sure buffers are resized correctly
+        for start, end in [(0, 7), (7, 30), (30, 40)]:
+            summary.add_batch(X[start:end], Y[start:end], z[start:end])
+            summary_XY.add_batch(X[start:end], Y[start:end])
+        np.testing.assert_array_equal(summary.m2, mf.summarize_XYz(X, Y, z))
+        np.testing.assert_array_equal(summary_XY.m,
+                                      summary.m2[:, :, [0, 2, 4, 6]] +
+                                      summary.m2[:, :, [1, 3, 5, 7]])
+        self.assertNotIn('_buffers', summary.__getstate__())
+
+    def test_sparse_input(self):
+        np.random.seed(106)
+        X = (np.random.rand(60, 5) < 0.2).astype(int)
+        Y = (np.random.rand(60, 4) < 0.3).astype(int)
+        z = np.random.randint(0, 2, 60)
+        X_sparse = sparse.csr_matrix(X)
+        Y_sparse = sparse.csr_matrix(Y)
+        np.testing.assert_array_equal(mf.summarize_Xz(X_sparse, z),
+                                      mf.summarize_Xz(X, z))
+        np.testing.assert_array_equal(mf.summarize_XYz(X_sparse, Y_sparse, z),
+                                      mf.summarize_XYz(X, Y, z))
+        np.testing.assert_array_equal(mf.summarize_XYz(X_sparse, Y, z),
+                                      mf.summarize_XYz(X, Y, z))
+
+        dense = mf.SummaryXY(list('abcde'), list('fghi'))
+        dense.add_batch(X, Y)
+        summary = mf.SummaryXY(list('abcde'), list('fghi'))
+        summary.add_batch(X_sparse, Y_sparse)
+        np.testing.assert_array_equal(summary.m, dense.m)
+
+        dense = mf.SymmetricSummaryXYz(list('edcba'), 'z', compact=True)
+        dense.add_batch(X, z)
+        summary = mf.SymmetricSummaryXYz(list('edcba'), 'z', compact=True)
+        summary.add_batch(X_sparse, z)
+        np.testing.assert_array_equal(summary.m2, dense.m2)
+
+        D = np.stack([z, 1 - z], axis=-1)
+        multi = mf.MultiOutcomeSummaryXYz(list('abcde'), list('fghi'),
+                                          ['z', 'not z'])
+        multi.add_batch(X_sparse, Y_sparse, D)
+        np.testing.assert_array_equal(multi.view('z').m2,
+                                      mf.summarize_XYz(X, Y, z))
+
+    def test_events_to_matrix(self):
+        matrix = mf.events_to_matrix([0, 0, 2, 2, 3], ['b', 'a', 'b', 'b', 'x'],
+                                     4, ['a', 'b', 'c'])
+        self.assertTrue(sparse.issparse(matrix))
+        np.testing.assert_array_equal(matrix.toarray(),
+                                      [[1, 1, 0], [0, 0, 0], [0, 1, 0],
+                                       [0, 0, 0]])
+        summary = mf.SummaryXYz(['a', 'b', 'c'], ['a', 'b', 'c'], 'z')
+        summary.add_batch(matrix, matrix, np.array([1, 0, 0, 1]))
+        self.assertEqual(summary.m2[0, 1, 0], 1)
+        self.assertEqual(summary.m2[1, 1, 1], 1)
+
     def test_outcome(self):
         current = mf.summarize(self.P, self.P, self.d)
         m1, m2, case_N, control_N = current
@@ -245,6 +324,292 @@ class TestMF(unittest.TestCase):
         np.testing.assert_array_equal(mf_XY,
                                       heart_failure.mutual_info_XY_omit_z())
 
+    def test_pairwise_metrics(self):
+        np.random.seed(108)
+        X = (np.random.rand(80, 6) < 0.3).astype(int)
+        Y = (np.random.rand(80, 5) < 0.1).astype(int)
+        z = (np.random.rand(80) < 0.2).astype(int)
+        m2 = mf.summarize_XYz(X, Y, z)
+        summary_z = mf.summarize_z(z)
+        fused = mf.pairwise_metrics(m2, summary_z)
+        np.testing.assert_almost_equal(fused['mf_XY_z'],
+                                       mf.mf_XY_z(m2, summary_z))
+        np.testing.assert_almost_equal(fused['mf_XY_given_z'],
+                                       mf.mf_XY_given_z(m2, summary_z))
+        m1 = mf.summarize_Xz(X, z)
+        np.testing.assert_almost_equal(
+            mf.mf_Xz_from_entropies(m1, summary_z),
+            mf.mf_Xz(m1, summary_z)[0])
+
+    def test_metrics_are_memoized(self):
+        summary = mf.SummaryXYz(['HP:001', 'HP:002', 'HP:003', 'HP:004'],
+                                ['HP:001', 'HP:002', 'HP:003', 'HP:004'],
+                                'heart failure')
+        summary.add_batch(self.P, self.P, self.d)
+        mutual_info = mf.MutualInfoXYz(summary)
+        metrics = mutual_info.metrics()
+        self.assertEqual(sorted(metrics.keys()),
+                         sorted(('mf_Xz', 'mf_Yz') + mf.PAIRWISE_METRICS))
+        self.assertIs(mutual_info.synergy_XY2z(), metrics['synergy'])
+        self.assertIs(mutual_info.metrics(), metrics)
+        # results are recomputed after the summary changes
+        summary.add_batch(self.P[0:3], self.P[0:3], self.d[0:3])
+        self.assertIsNot(mutual_info.metrics(), metrics)
+        expected = mf.MutualInfoXYz(summary)
+        self.assertEqual(mutual_info.case_N, expected.case_N)
+        np.testing.assert_array_equal(mutual_info.synergy_XY2z(),
+                                      expected.synergy_XY2z())
+
+    def test_top_pairs(self):
+        np.random.seed(109)
+        X = np.random.randint(0, 2, 600).reshape([60, 10])
+        Y = np.random.randint(0, 2, 480).reshape([60, 8])
+        z = np.random.randint(0, 2, 60)
+        summary = mf.SummaryXYz(['X{}'.format(i) for i in range(10)],
+                                ['Y{}'.format(i) for i in range(8)], 'z',
+                                compact=True)
+        summary.add_batch(X, Y, z)
+        mutual_info = mf.MutualInfoXYz(summary)
+        budget = 7 * mf.BYTES_PER_PAIR
+        # computed tile by tile before metrics() is memoized
+        top = mutual_info.top_pairs('synergy', k=5, memory_budget=budget)
+        expected = mutual_info.synergy_XY2z_df().head(5)
+        np.testing.assert_almost_equal(top.synergy.values,
+                                       expected.synergy.values)
+        S = mutual_info.synergy_XY2z()
+        for p1, p2, s in zip(top.P1, top.P2, top.synergy):
+            self.assertAlmostEqual(S[int(p1[1:]), int(p2[1:])], s)
+
+        # memoized values, threshold and smallest values
+        values = mutual_info.mutual_info_XY_given_z()
+        threshold = np.sort(values.ravel())[10]
+        bottom = mutual_info.top_pairs('mf_XY_given_z', threshold=threshold,
+                                       largest=False, p_values=values)
+        self.assertEqual(len(bottom), 11)
+        self.assertTrue(np.all(np.diff(bottom.mf_XY_given_z) >= 0))
+        np.testing.assert_array_equal(bottom.p.values,
+                                      bottom.mf_XY_given_z.values)
+
+        symmetric = mf.SymmetricSummaryXYz(['X{}'.format(i) for i in
+                                            range(10)], 'z')
+        symmetric.add_batch(X, z)
+        packed = mf.MutualInfoXYz(symmetric)
+        top = packed.top_pairs('mf_XY_z', k=3, memory_budget=budget)
+        np.testing.assert_almost_equal(
+            top.mf_XY_z.values, np.sort(packed.mutual_info_XY_z())[::-1][:3])
+        self.assertTrue(np.all(top.P1.values <= top.P2.values))
+        with self.assertRaises(ValueError):
+            packed.top_pairs('synergy')
+
+    def test_merge(self):
+        names = ['HP:001', 'HP:002', 'HP:003', 'HP:004']
+        whole = mf.SummaryXYz(names, names, 'heart failure')
+        whole.add_batch(self.P, self.P, self.d)
+        first = mf.SummaryXYz(names, names, 'heart failure', compact=True)
+        first.add_batch(self.P[:3], self.P[:3], self.d[:3])
+        second = mf.SummaryXYz(names, names, 'heart failure')
+        second.add_batch(self.P[3:], self.P[3:], self.d[3:])
+        merged = first + second
+        self.assertTrue(merged.compact)
+        self.assertEqual(merged.m1['set1'].dtype, mf.COMPACT_DTYPE)
+        np.testing.assert_array_equal(merged.m2, whole.m2)
+        self.assertEqual(merged.case_N, whole.case_N)
+        self.assertEqual(merged.control_N, whole.control_N)
+        # the operands are not modified by +
+        self.assertEqual(first.case_N + first.control_N, 3)
+        np.testing.assert_array_equal(sum([first, second]).m2, whole.m2)
+        np.testing.assert_array_equal(second.merge(first).m2, whole.m2)
+
+        symmetric = [mf.SymmetricSummaryXY(names) for _ in range(2)]
+        symmetric[0].add_batch(self.P[:4])
+        symmetric[1].add_batch(self.P[4:])
+        expected = mf.SymmetricSummaryXY(names)
+        expected.add_batch(self.P)
+        merged = sum(symmetric)
+        np.testing.assert_array_equal(merged.m, expected.m)
+        self.assertEqual(merged.N, 7)
+
+        with self.assertRaises(ValueError):
+            whole.merge(mf.SummaryXYz(names, names, 'kidney failure'))
+        with self.assertRaises(ValueError):
+            whole.merge(mf.SummaryXYz(names[::-1], names, 'heart failure'))
+        with self.assertRaises(TypeError):
+            whole.merge(mf.SymmetricSummaryXYz(names, 'heart failure'))
+
+    def test_SummaryXYz_compact(self):
+        np.random.seed(103)
+        X = np.random.randint(0, 2, 3000).reshape([300, 10])
+        Y = np.random.randint(0, 2, 2400).reshape([300, 8])
+        z = np.random.randint(0, 2, 300)
+        full = mf.SummaryXYz(np.arange(10), np.arange(8), 'z')
+        compact = mf.SummaryXYz(np.arange(10), np.arange(8), 'z',
+                                compact=True)
+        for start in range(0, 300, 100):
+            full.add_batch(X[start:start + 100], Y[start:start + 100],
+                           z[start:start + 100])
+            compact.add_batch(X[start:start + 100], Y[start:start + 100],
+                              z[start:start + 100])
+        self.assertEqual(compact.m2_compact.dtype, mf.COMPACT_DTYPE)
+        self.assertEqual(compact.m1['set1'].dtype, mf.COMPACT_DTYPE)
+        self.assertEqual(compact.m1['set2'].dtype, mf.COMPACT_DTYPE)
+        np.testing.assert_array_equal(compact.m2, full.m2)
+        np.testing.assert_array_equal(
+            mf.MutualInfoXYz(compact).synergy_XY2z(),
+            mf.MutualInfoXYz(full).synergy_XY2z())
+
+        restored = pickle.loads(pickle.dumps(compact))
+        np.testing.assert_array_equal(restored.m2, full.m2)
+        self.assertLess(len(pickle.dumps(compact)), len(pickle.dumps(full)))
+
+    def test_SummaryXYz_unpickle_without_compact(self):
+        summary = mf.SummaryXYz(['a', 'b'], ['c'], 'z')
+        state = summary.__getstate__()
+        # instances pickled before compact mode existed
+        state['m2'] = state.pop('_m2')
+        del state['compact']
+        restored = mf.SummaryXYz.__new__(mf.SummaryXYz)
+        restored.__setstate__(state)
+        self.assertFalse(restored.compact)
+        self.assertEqual(restored.m2.shape, (2, 1, 8))
+
+    def test_SymmetricSummaryXYz(self):
+        np.random.seed(104)
+        names = ['HP:3', 'HP:1', 'HP:4', 'HP:2', 'HP:0']
+        P = np.random.randint(0, 2, 250).reshape([50, 5])
+        d = np.random.randint(0, 2, 50)
+        symmetric = mf.SymmetricSummaryXYz(names, 'z')
+        symmetric.add_batch(P[:20], d[:20])
+        symmetric.add_batch(P[20:], d[20:])
+        self.assertEqual(symmetric.m2.shape, (15, 8))
+        # variables are sorted by name
+        order = np.argsort(names)
+        self.assertEqual(symmetric.vars_labels['set1'].tolist(),
+                         sorted(names))
+        full = mf.SummaryXYz(sorted(names), sorted(names), 'z')
+        full.add_batch(P[:, order], P[:, order], d)
+        np.testing.assert_array_equal(symmetric.full().m2, full.m2)
+
+        packed = mf.MutualInfoXYz(symmetric)
+        expected = mf.MutualInfoXYz(full)
+        rows, cols = packed.pair_index()
+        self.assertTrue(np.all(packed.vars_labels['set1'][rows] <=
+                               packed.vars_labels['set2'][cols]))
+        np.testing.assert_almost_equal(packed.synergy_XY2z(),
+                                       expected.synergy_XY2z()[rows, cols])
+        np.testing.assert_almost_equal(packed.expand(packed.synergy_XY2z()),
+                                       expected.synergy_XY2z())
+        np.testing.assert_almost_equal(
+            packed.expand(packed.mutual_info_XY_given_z()),
+            expected.mutual_info_XY_given_z())
+        np.testing.assert_almost_equal(
+            packed.expand(packed.mutual_info_XY_omit_z()),
+            expected.mutual_info_XY_omit_z())
+
+        compact = mf.SymmetricSummaryXYz(names, 'z', compact=True)
+        compact.add_batch(P, d)
+        np.testing.assert_array_equal(compact.m2, symmetric.m2)
+        self.assertEqual(compact.m1['set1'].dtype, mf.COMPACT_DTYPE)
+        # packed M(M+1)/2 x 8 tables can be assigned back
+        compact.m2 = symmetric.m2
+        np.testing.assert_array_equal(compact.m2, symmetric.m2)
+
+    def test_MultiOutcomeSummaryXYz(self):
+        np.random.seed(105)
+        P1 = np.random.randint(0, 2, 200).reshape([50, 4])
+        P2 = np.random.randint(0, 2, 150).reshape([50, 3])
+        D = np.random.randint(0, 2, 150).reshape([50, 3])
+        D[:, 2] = 0
+        multi = mf.MultiOutcomeSummaryXYz(['a', 'b', 'c', 'd'],
+                                          ['e', 'f', 'g'],
+                                          ['z1', 'z2', 'z3'])
+        multi.add_batch(P1[:30], P2[:30], D[:30])
+        multi.add_batch(P1[30:], P2[30:], D[30:])
+        for k, z_name in enumerate(['z1', 'z2', 'z3']):
+            expected = mf.SummaryXYz(['a', 'b', 'c', 'd'], ['e', 'f', 'g'],
+                                     z_name)
+            expected.add_batch(P1, P2, D[:, k])
+            view = multi.view(z_name)
+            self.assertTrue(view.compact)
+            self.assertEqual(view.case_N, expected.case_N)
+            self.assertEqual(view.control_N, expected.control_N)
+            np.testing.assert_array_equal(view.m1['set1'],
+                                          expected.m1['set1'])
+            np.testing.assert_array_equal(view.m1['set2'],
+                                          expected.m1['set2'])
+            np.testing.assert_array_equal(view.m2, expected.m2)
+        self.assertEqual(sorted(multi.views().keys()), ['z1', 'z2', 'z3'])
+        with self.assertRaises(KeyError):
+            multi.view('z4')
+
+        names = ['HP:3', 'HP:1', 'HP:4', 'HP:2']
+        symmetric = mf.SymmetricMultiOutcomeSummaryXYz(names, ['z1', 'z2'])
+        symmetric.add_batch(P1, D[:, 0:2])
+        for k in range(2):
+            expected = mf.SymmetricSummaryXYz(names, 'z')
+            expected.add_batch(P1, D[:, k])
+            view = symmetric.view(k)
+            self.assertIsInstance(view, mf.SymmetricSummaryXYz)
+            np.testing.assert_array_equal(view.m2, expected.m2)
+            np.testing.assert_almost_equal(
+                mf.MutualInfoXYz(view).synergy_XY2z(),
+                mf.MutualInfoXYz(expected).synergy_XY2z())
+
+    def test_tiled_metrics(self):
+        np.random.seed(107)
+        X = np.random.randint(0, 2, 400).reshape([40, 10])
+        Y = np.random.randint(0, 2, 280).reshape([40, 7])
+        z = np.random.randint(0, 2, 40)
+        summaries = [mf.SummaryXYz(np.arange(10), np.arange(7), 'z'),
+                     mf.SummaryXYz(np.arange(10), np.arange(7), 'z',
+                                   compact=True)]
+        for summary in summaries:
+            summary.add_batch(X, Y, z)
+        symmetric = mf.SymmetricSummaryXYz(np.arange(10), 'z', compact=True)
+        symmetric.add_batch(X, z)
+        summaries.append(symmetric)
+        for summary in summaries:
+            mutual_info = mf.MutualInfoXYz(summary)
+            expected = {'mf_XY_omit_z': mutual_info.mutual_info_XY_omit_z(),
+                        'mf_XY_z': mutual_info.mutual_info_XY_z(),
+                        'mf_XY_given_z': mutual_info.mutual_info_XY_given_z(),
+                        'synergy': mutual_info.synergy_XY2z()}
+            # a budget of 3 pairs per tile forces partial rows
+            self.assertGreater(len(list(mutual_info.tiles(
+                3 * mf.BYTES_PER_PAIR))), 1)
+            tiled = mutual_info.tiled_metrics(
+                memory_budget=3 * mf.BYTES_PER_PAIR)
+            for metric in mf.PAIRWISE_METRICS:
+                np.testing.assert_almost_equal(tiled[metric],
+                                               expected[metric])
+
+        mutual_info = mf.MutualInfoXYz(summaries[1])
+        out = mutual_info.tiled_metrics(['synergy'], memory_budget=5000,
+                                        out=self.tempdir)
+        self.assertIsInstance(out['synergy'], np.memmap)
+        np.testing.assert_almost_equal(
+            np.load(os.path.join(self.tempdir, 'synergy.npy')),
+            mutual_info.synergy_XY2z())
+        with self.assertRaises(ValueError):
+            mutual_info.tiled_metrics(['mf_Xz'])
+
+    def test_SymmetricSummaryXY(self):
+        np.random.seed(105)
+        names = ['b', 'c', 'a']
+        P = np.random.randint(0, 2, 90).reshape([30, 3])
+        symmetric = mf.SymmetricSummaryXY(names)
+        symmetric.add_batch(P)
+        full = mf.SummaryXY(['a', 'b', 'c'], ['a', 'b', 'c'])
+        full.add_batch(P[:, [2, 0, 1]], P[:, [2, 0, 1]])
+        np.testing.assert_array_equal(symmetric.full().m, full.m)
+        mf_packed = mf.MutualInfoXY(symmetric)
+        mf_full = mf.MutualInfoXY(full)
+        rows, cols = symmetric.pairs
+        np.testing.assert_almost_equal(mf_packed.mf(),
+                                       mf_full.mf()[rows, cols])
+        self.assertEqual(len(mf_packed.mf_labeled()), 6)
+        np.testing.assert_almost_equal(mf_packed.entropies()['X'],
+                                       mf_full.entropies()['X'])
+
     def test_MF_withinSet(self):
         labels = ['HP:001', 'HP:002','HP:003', 'HP:004']
         summary = mf.SummaryXYz(X_names=labels,
@@ -262,6 +627,25 @@ class TestMF(unittest.TestCase):
         self.assertEqual(heart_failure.case_N, 8)
         self.assertEqual(heart_failure.control_N, 6)
 
+    def test_plog2p(self):
+        N = 14
+        table = mf.plog2p_table(N)
+        self.assertEqual(len(table), N + 1)
+        self.assertEqual(table[0], 0)
+        self.assertEqual(table[N], 0)
+        p = np.arange(1, N) / N
+        np.testing.assert_array_equal(table[1:N], p * np.log2(p))
+        self.assertFalse(table.flags.writeable)
+        # counts that are not integers within [0, N] bypass the table
+        counts = np.array([[0, 3, 7.5], [14, 2, 1]])
+        expected = np.zeros_like(counts)
+        nonzero = counts > 0
+        expected[nonzero] = counts[nonzero] / N * \
+            np.log2(counts[nonzero] / N)
+        np.testing.assert_array_almost_equal(mf.plog2p(counts, N), expected)
+        np.testing.assert_array_equal(mf.plog2p(counts[:, :2], N),
+                                      table[counts[:, :2].astype(int)])
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,104 @@
+import mf
+import mf_random
+from null_library import NullLibrary
+import unittest
+import tempfile
+import numpy as np
+import os.path
+
+
+class TestNullLibrary(unittest.TestCase):
+
+    def setUp(self):
+        self.temppath = tempfile.mkdtemp()
+
+    def test_grid(self):
+        library = NullLibrary(self.temppath, levels_per_decade=10)
+        p = np.array([1e-6, 0.001, 0.3, 0.5, 0.9, 1])
+        level = library.probability_level(p)
+        self.assertEqual(level[3], 0)
+        self.assertEqual(level[0], library.probability_level(1e-4))
+        self.assertEqual(level[-1], -level[0])
+        # representative probabilities are close on the logit scale
+        np.testing.assert_allclose(library.probability_of_level(level[1:5]),
+                                   p[1:5], rtol=0.15)
+        # N is not quantized
+        for N in [3000, 3001, 10000]:
+            self.assertEqual(library.size_of_level(library.size_level(N)), N)
+        keys = library.keys(0.2, np.array([0.1, 0.5]), np.array([0.5, 0.1]),
+                            5000)
+        np.testing.assert_array_equal(keys[0], keys[1])
+
+        # settings are kept with the library
+        reopened = NullLibrary(self.temppath, levels_per_decade=3)
+        self.assertEqual(reopened.levels_per_decade, 10)
+
+    def test_simulate_missing_points_only(self):
+        library = NullLibrary(self.temppath, simulations=50)
+        keys = library.keys(0.2, np.array([0.1, 0.3, 0.1]),
+                            np.array([0.5, 0.5, 0.5]), 2000)
+        self.assertEqual(len(library.missing(keys)), 2)
+        rng = np.random.default_rng(0)
+        self.assertEqual(library.simulate(keys, rng), 2)
+        self.assertEqual(library.simulate(keys, rng), 0)
+        distribution = library.distribution(keys[0])
+        self.assertEqual(list(distribution.shape),
+                         [len(mf.PAIRWISE_METRICS), 50])
+        more = library.keys(0.2, np.array([0.1, 0.05]),
+                            np.array([0.5, 0.5]), 2000)
+        self.assertEqual(library.simulate(more, rng), 1)
+
+    def test_p_values(self):
+        library = NullLibrary(self.temppath, simulations=2000)
+        rng = np.random.default_rng(1)
+        pair_prob1 = np.array([0.1, 0.3, 0.3])
+        pair_prob2 = np.array([0.5, 0.2, 0.2])
+        N = 3000
+        observed = {'synergy': np.array([1, 4, 0.5]) / (2 * N * np.log(2))}
+        p = library.p_values(observed, 0.2, pair_prob1, pair_prob2, N,
+                             rng=rng)['synergy']
+        # compare with simulations of the exact parameters
+        simulated = mf_random.simulate_pair_metrics(
+            0.2, pair_prob1, pair_prob2, N, 4000, rng)['synergy']
+        center = np.mean(simulated, axis=0)
+        distance = np.abs(observed['synergy'] - center)
+        expected = np.mean((simulated <= center - distance) |
+                           (simulated >= center + distance), axis=0)
+        np.testing.assert_allclose(p, expected, atol=0.05)
+
+        # the largest simulated value is as extreme as itself, although
+        # it was stored in float32 (rounded below the float64 value)
+        key = library.keys(0.2, pair_prob1[:1], pair_prob2[:1], N)[0]
+        row = library.metrics.index('synergy')
+        top = float(np.max(library.distribution(key)[row])) * (1 + 1e-9)
+        p = library.p_values({'synergy': np.array([top]) /
+                              (2 * N * np.log(2))}, 0.2, pair_prob1[:1],
+                             pair_prob2[:1], N, alternative='right')
+        self.assertGreaterEqual(p['synergy'][0], 1 / 2000)
+
+    def test_randomizer(self):
+        M = 6
+        N = 4000
+        rng = np.random.default_rng(2)
+        P = (rng.uniform(size=[N, M]) < np.linspace(0.05, 0.5, M)).astype(int)
+        d = (rng.uniform(size=N) < 0.2).astype(int)
+        summary = mf.SummaryXYz(np.arange(M), np.arange(M), 'd')
+        summary.add_batch(P, P, d)
+        library = NullLibrary(self.temppath, simulations=200)
+        p = mf_random.MutualInfoRandomizer(summary).library_p_values(
+            library, seed=1)
+        self.assertEqual(list(p['synergy'].shape), [M, M])
+        np.testing.assert_array_equal(p['synergy'], p['synergy'].T)
+        # a second disease with the same prevalences needs no simulations
+        def grid_points():
+            return sorted(name for _, _, names in os.walk(self.temppath)
+                          for name in names)
+        simulated = grid_points()
+        summary2 = mf.SummaryXYz(np.arange(M), np.arange(M), 'd2')
+        summary2.add_batch(P[::-1], P[::-1], d[::-1])
+        mf_random.MutualInfoRandomizer(summary2).library_p_values(library)
+        self.assertEqual(grid_points(), simulated)
+
+
+if __name__ == '__main__':
+    unittest.main()
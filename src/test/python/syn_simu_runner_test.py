@@ -28,9 +28,9 @@ class TestSynSimuRunner(unittest.TestCase):
                            np.random.randint(0, 2, M2 * N2).reshape([N2, M2]),
                            np.random.randint(0, 2, N2))
 
-        summaries = {'D1': summary1, 'D2': summary2}
+        self.summaries = {'D1': summary1, 'D2': summary2}
         with open(self.f, 'wb') as f1:
-            pickle.dump(summaries, file=f1, protocol=2)
+            pickle.dump(self.summaries, file=f1, protocol=2)
 
     def test_test_data_created(self):
         self.assertTrue(os.path.exists(os.path.join(self.temppath,
@@ -46,6 +46,7 @@ class TestSynSimuRunner(unittest.TestCase):
         args.cpu = 4
         args.job_id = 1
         args.disease_of_interest = 'D2'
+        args.method = 'bernoulli'
         syn_simu_runner.simulate(args)
 
         result_out_path = os.path.join(args.out_dir,
@@ -58,6 +59,66 @@ class TestSynSimuRunner(unittest.TestCase):
             print(k)
             print(v.shape)
 
+    def test_simulate_into_store(self):
+        args = MockedArgsObj()
+        args.input_path = self.f
+        args.n_per_run = None
+        args.N_SIMULATIONS = 10
+        args.verbose = False
+        args.out_dir = self.temppath
+        args.cpu = 2
+        args.job_id = 3
+        args.disease_of_interest = 'D2'
+        args.method = 'multinomial'
+        args.format = 'store'
+        args.chunk = 4
+        args.compress = False
+        syn_simu_runner.simulate(args)
+        store = syn_simu_runner.DistributionStore(
+            os.path.join(self.temppath, 'D2'))
+        self.assertEqual(store.simulations(job_id=3), 10)
+        self.assertEqual([chunk['simulations'] for chunk in store.chunks()],
+                         [4, 4, 2])
+        complete = store.read('synergy')
+
+        # an interrupted job resumes after the last chunk in its manifest
+        manifest = store.manifest(3)
+        manifest['chunks'] = manifest['chunks'][:1]
+        store._write_manifest(manifest)
+        self.assertEqual(store.simulations(), 4)
+        syn_simu_runner.simulate(args)
+        self.assertEqual(store.simulations(), 10)
+        np.testing.assert_array_equal(store.read('synergy'), complete)
+
+        args.dist_path = self.temppath
+        args.out_dir = os.path.join(self.temppath, 'p_values.obj')
+        p = syn_simu_runner.estimate(args)
+        self.assertEqual(list(p['D2']['synergy'].shape), [30, 30])
+
+        # p values are kept for every disease, not only the last one
+        args.job_id = 0
+        args.disease_of_interest = ['D1', 'D2']
+        syn_simu_runner.simulate_into_store(
+            syn_simu_runner.MutualInfoRandomizer(self.summaries['D1']),
+            os.path.join(self.temppath, 'D1'), args)
+        p = syn_simu_runner.estimate(args)
+        self.assertEqual(sorted(p), ['D1', 'D2'])
+        self.assertEqual(list(p['D1']['synergy'].shape), [20, 20])
+        with open(args.out_dir, 'rb') as f:
+            self.assertEqual(sorted(pickle.load(f)), ['D1', 'D2'])
+
+    def test_estimate_from_library(self):
+        args = MockedArgsObj()
+        args.input_path = self.f
+        args.library_path = os.path.join(self.temppath, 'library')
+        args.out_dir = os.path.join(self.temppath, 'p_values.obj')
+        args.N_SIMULATIONS = 50
+        args.disease_of_interest = ['D1', 'D2']
+        p = syn_simu_runner.estimate_from_library(args)
+        self.assertEqual(list(p['D1']['synergy'].shape), [20, 20])
+        self.assertEqual(list(p['D2']['mf_XY_z'].shape), [30, 30])
+        self.assertTrue(os.path.exists(args.out_dir))
+
     def test_serialize_empirical_distributions(self):
         distribution = np.random.randn(10000).reshape([10,10,-1])
         path = os.path.join(self.temppath + 'distribution_subset.obj')
@@ -1,9 +1,13 @@
 import unittest
 import src.main.python.synergy_tree as synergy_tree
 import treelib
+import numpy as np
 import networkx as nx
 import time
 import pickle
+import os
+import tempfile
+import tracemalloc
 
 
 class TestSynergyTree(unittest.TestCase):
@@ -59,6 +63,245 @@ class TestSynergyTree(unittest.TestCase):
         syn_tree = synergy_tree.populate_syn_tree(syn_tree, None, root_id,
                                                    mf_dict)
         #syn_tree.show()
+        with self.assertWarns(DeprecationWarning):
+            synergy_tree.populate_syn_tree(treelib.Tree(), None, root_id,
+                                           mf_dict, {4: set()})
+
+    def test_best_partitions(self):
+        variables = ['a', 'b', 'c', 'd', 'e']
+        mf_dict = {subset: len(subset) ** 1.5 / 10 for subset in
+                   synergy_tree.subsets(variables, include_self=True)}
+        # the best partition of (a, b, c, d, e) is unique
+        mf_dict[('a', 'c')] = 1
+        mf_dict[('b', 'd', 'e')] = 1
+        syn_tree = synergy_tree.populate_syn_tree(
+            treelib.Tree(), None, tuple(variables), mf_dict)
+        self.assertEqual(sorted(child.identifier for child in
+                                syn_tree.children(tuple(variables))),
+                         [('a', 'c'), ('b', 'd', 'e')])
+        self.assertAlmostEqual(syn_tree[tuple(variables)].data,
+                               mf_dict[tuple(variables)] - 2)
+        # every node agrees with the enumeration of all partitions
+        for node in syn_tree.all_nodes():
+            if len(node.identifier) == 1:
+                self.assertIsNone(node.data)
+                continue
+            best = max(sum(mf_dict[subset] for subset in partition.serie)
+                       for partition in synergy_tree.disjoint_series(
+                           set(node.identifier)))
+            self.assertAlmostEqual(node.data,
+                                   mf_dict[node.identifier] - best)
+            children = [child.identifier for child in
+                        syn_tree.children(node.identifier)]
+            self.assertAlmostEqual(sum(mf_dict[child] for child in children),
+                                   best)
+
+        variables, mf = synergy_tree.mf_by_mask(variables, mf_dict)
+        split, first, whole_first = synergy_tree.best_partitions(mf)
+        self.assertEqual(mf[0b00101], 1)
+        self.assertEqual(sorted(synergy_tree.read_partition(
+            0b11111, first, whole_first)), [0b00101, 0b11010])
+        self.assertEqual(split[0b00001], -float('inf'))
+
+    def test_mf_dict_from_counts(self):
+        rng = np.random.default_rng(0)
+        N = 2000
+        V = (rng.random([N, 4]) < [0.1, 0.3, 0.5, 0.2]).astype(int)
+        d = (rng.random(N) < 0.2 + 0.3 * V[:, 0] * V[:, 2]).astype(int)
+        counts = synergy_tree.joint_pattern_counts(V, d)
+        self.assertEqual(len(counts), 32)
+        self.assertEqual(counts[0b10101], np.sum((V == [1, 0, 1, 0]).all(
+            axis=1) & (d == 1)))
+        # the same counts from distinct patterns with their counts
+        patterns, n = np.unique(np.column_stack([V, d]), axis=0,
+                                return_counts=True)
+        np.testing.assert_array_equal(synergy_tree.joint_pattern_counts(
+            patterns[:, 0:4], patterns[:, 4], n), counts)
+
+        variables = ['V1', 'V2', 'V3', 'V4']
+        mf_dict = synergy_tree.mf_dict_from_counts(variables, counts)
+        self.assertEqual(set(mf_dict.keys()),
+                         synergy_tree.subsets(variables, include_self=True))
+        for subset, value in mf_dict.items():
+            columns = [variables.index(variable) for variable in subset]
+            # mutual information from the counts of the subset patterns
+            patterns, joint = np.unique(np.column_stack([V[:, columns], d]),
+                                        axis=0, return_counts=True)
+            _, inverse = np.unique(patterns[:, :-1], axis=0,
+                                   return_inverse=True)
+            inverse = inverse.reshape(-1)
+            marginal = np.bincount(inverse, weights=joint)[inverse]
+            outcome = np.bincount(d)[patterns[:, -1]]
+            p = joint / N
+            expected = np.sum(p * np.log2(joint * N / (marginal * outcome)))
+            self.assertAlmostEqual(value, expected, places=12)
+
+    def test_mf_by_mask_from_counts_chunks(self):
+        rng = np.random.default_rng(1)
+        V = (rng.random([3000, 7]) < 0.3).astype(int)
+        d = (rng.random(3000) < 0.2 + 0.3 * V[:, 1] * V[:, 5]).astype(int)
+        counts = synergy_tree.joint_pattern_counts(V, d)
+        expected = synergy_tree.mf_by_mask_from_counts(counts,
+                                                       chunk_variables=7)
+        for chunk_variables in range(7):
+            np.testing.assert_allclose(
+                synergy_tree.mf_by_mask_from_counts(counts, chunk_variables),
+                expected, atol=1e-12)
+
+        # memory is bounded by the chunks, not by the 3^n x 2 cells of all
+        # marginal tables (688 MB at n = 16)
+        n = 16
+        V = (rng.random([5000, n]) < 0.3).astype(int)
+        d = (rng.random(5000) < 0.3).astype(int)
+        counts = synergy_tree.joint_pattern_counts(V, d)
+        tracemalloc.start()
+        mf = synergy_tree.mf_by_mask_from_counts(counts)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertEqual(len(mf), 2 ** n)
+        self.assertLess(peak, 64 * 2 ** 20)
+
+    def test_approximate_synergy_tree(self):
+        rng = np.random.default_rng(2)
+        N = 3000
+        variables = ['V' + str(i) for i in range(6)]
+        V = (rng.random([N, 6]) < 0.3).astype(int)
+        d = (rng.random(N) < 0.1 + 0.5 * V[:, 0] * V[:, 1] +
+             0.2 * V[:, 2]).astype(int)
+        mf_dict = synergy_tree.mf_dict_from_counts(
+            variables, synergy_tree.joint_pattern_counts(V, d))
+        source = synergy_tree.PatternMutualInfo(variables, V, d)
+        for subset in [('V0',), ('V1', 'V4'), tuple(variables)]:
+            self.assertAlmostEqual(source(subset), mf_dict[subset],
+                                   places=12)
+
+        for beam_width in [1, 3]:
+            syn_tree = synergy_tree.SynergyTree(variables, None, source)
+            approximate = syn_tree.synergy_tree(approximate=True,
+                                                beam_width=beam_width)
+            self.assertEqual(sorted(leaf.identifier for leaf in
+                                    approximate.leaves()),
+                             [(variable,) for variable in variables])
+            # the exact synergy of every node is within the bound
+            for node in approximate.all_nodes():
+                if node.data is None:
+                    continue
+                exact = synergy_tree.populate_syn_tree(
+                    treelib.Tree(), None, node.identifier,
+                    mf_dict)[node.identifier].data
+                lost = syn_tree.synergy_lost[node.identifier]
+                self.assertGreaterEqual(node.data, exact - 1e-12)
+                self.assertLessEqual(node.data - lost, exact + 1e-12)
+            self.assertIn(('V0', 'V1'), approximate)
+
+        # only the subsets visited are fetched
+        variables = ['V' + str(i) for i in range(12)]
+        V = (rng.random([N, 12]) < 0.3).astype(int)
+        mf = synergy_tree.LazyMutualInfo(
+            synergy_tree.PatternMutualInfo(variables, V, d))
+        synergy_tree.approximate_syn_tree(treelib.Tree(), variables, mf)
+        self.assertLess(len(mf), 2 ** 12 / 4)
+
+    def test_partition_bound(self):
+        rng = np.random.default_rng(4)
+        n = 6
+        for trial in range(20):
+            V = (rng.random([2000, n]) < rng.uniform(0.1, 0.5, n)).astype(int)
+            d = (rng.random(2000) < 0.1 + 0.4 * (V[:, 0] ^ V[:, 1]) +
+                 0.3 * V[:, 2] * V[:, 3] * (trial % 2)).astype(int)
+            mf = synergy_tree.mf_by_mask_from_counts(
+                synergy_tree.joint_pattern_counts(V, d))
+            best, _, _ = synergy_tree.best_partitions(mf)
+            entropy = synergy_tree.PatternMutualInfo(
+                range(n), V, d).outcome_entropy
+            splits = synergy_tree.approximate_partitions(n, mf.__getitem__)
+            for mask in range(1, 2 ** n):
+                if mask & (mask - 1) == 0:
+                    continue
+                bound = synergy_tree.partition_bound(mask, mf.__getitem__)
+                capped = synergy_tree.partition_bound(mask, mf.__getitem__,
+                                                      entropy)
+                self.assertLessEqual(capped, bound)
+                # the bound holds for the best partition of the DP, so it
+                # bounds the gap to the partition found
+                self.assertLessEqual(best[mask], capped + 1e-12)
+                if mask in splits:
+                    self.assertLessEqual(best[mask] - splits[mask][0],
+                                         capped - splits[mask][0] + 1e-12)
+
+        # blocks that each determine the outcome: the best partition sums
+        # the entropy of the outcome once per block, which the bound reaches
+        z = rng.integers(0, 2, 4000)
+        a = rng.integers(0, 2, [4000, 3])
+        V = np.column_stack([a, a ^ z[:, np.newaxis]])
+        mf = synergy_tree.mf_by_mask_from_counts(
+            synergy_tree.joint_pattern_counts(V, z))
+        best, _, _ = synergy_tree.best_partitions(mf)
+        entropy = synergy_tree.PatternMutualInfo(range(6), V, z).\
+            outcome_entropy
+        self.assertAlmostEqual(best[-1], 3 * entropy, places=2)
+        self.assertAlmostEqual(synergy_tree.partition_bound(
+            2 ** 6 - 1, mf.__getitem__, entropy), best[-1], places=2)
+
+    def test_mutual_info_cache(self):
+        rng = np.random.default_rng(3)
+        N = 2000
+        variables = ['V' + str(i) for i in range(5)]
+        V = (rng.random([N, 5]) < 0.3).astype(int)
+        d = (rng.random(N) < 0.1 + 0.5 * V[:, 0] * V[:, 1]).astype(int)
+        mf_dict = synergy_tree.mf_dict_from_counts(
+            variables, synergy_tree.joint_pattern_counts(V, d))
+        calls = []
+
+        def compute(subset):
+            calls.append(subset)
+            return mf_dict[subset]
+
+        cache = synergy_tree.MutualInfoCache()
+        cohort = synergy_tree.cohort_fingerprint(V, d)
+        self.assertNotEqual(cohort, synergy_tree.cohort_fingerprint(V, 1 - d))
+        source = cache.source('038', cohort, compute)
+
+        exact = synergy_tree.SynergyTree(variables, None, mf_dict)
+        expected = exact.synergy_tree()
+        tree = synergy_tree.SynergyTree(variables, None, source).synergy_tree()
+        self.assertEqual(tree.to_dict(with_data=True),
+                         expected.to_dict(with_data=True))
+        self.assertEqual(len(calls), 2 ** 5 - 1)
+        # the approximate tree and a tree of fewer variables are cached
+        synergy_tree.SynergyTree(variables, None, source).synergy_tree(
+            approximate=True)
+        synergy_tree.SynergyTree(variables[:3], None, source).synergy_tree()
+        self.assertEqual(len(calls), 2 ** 5 - 1)
+
+        # the same phenotypes under other variable names share entries
+        names = {'X' + str(i): variable for i, variable in
+                 enumerate(variables)}
+        renamed = cache.source('038', cohort, names=names)
+        self.assertEqual(renamed(('X1', 'X0')), mf_dict[('V0', 'V1')])
+        self.assertEqual(renamed.missing([('X0',), ('X1', 'X2')]), [])
+        other = cache.source('584', cohort)
+        self.assertEqual(other.missing([('V0',)]), [('V0',)])
+        with self.assertRaises(KeyError):
+            other(('V0',))
+
+        # least recently used entries are evicted
+        small = synergy_tree.MutualInfoCache(max_size=2)
+        small.put('a', 1)
+        small.put('b', 2)
+        small.get('a')
+        small.put('c', 3)
+        self.assertEqual(sorted(small.entries), ['a', 'c'])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.obj')
+            cache.path = path
+            cache.save()
+            loaded = synergy_tree.MutualInfoCache(path=path)
+            self.assertEqual(loaded.entries, cache.entries)
+            loaded = synergy_tree.MutualInfoCache(max_size=3, path=path)
+            self.assertEqual(list(loaded.entries),
+                             list(cache.entries)[-3:])
 
     def test_SynergyTree(self):
         var_set = {'a', 'b', 'c', 'd'}
@@ -178,11 +421,54 @@ class TestSynergyTree(unittest.TestCase):
         self.assertEqual(list(trimed_network.nodes),
                          ['HP:1', 'HP:2', 'HP:4'])
 
+    def test_trim_edges_random(self):
+        # the same nodes are removed as by analyzing edges from a list
+        rng = np.random.default_rng(1)
+        for trial in range(50):
+            n = int(rng.integers(3, 30))
+            terms = ['HP:' + str(i) for i in range(n)]
+            mocked_hpo = nx.MultiDiGraph()
+            mocked_hpo.add_nodes_from(terms)
+            for i in range(1, n):
+                mocked_hpo.add_edge(terms[i], terms[int(rng.integers(0, i))])
+            network = nx.Graph()
+            for _ in range(int(rng.integers(1, 3 * n))):
+                v, w = rng.choice(n, 2, replace=False)
+                network.add_edge(terms[v], terms[w],
+                                 mf=float(rng.choice([0.1, 0.2, 0.5])))
+            trimmed = synergy_tree.trim_edges(network, mocked_hpo, 0.6)
+            self.assertEqual(list(trimmed.nodes),
+                             list(trim_edges_by_list(network, mocked_hpo,
+                                                     0.6).nodes))
+
     # def test_precompute_disjoint_series(self):
     #     n = 3
     #     synergy_tree.precompute_disjoint_series(n, False,
     #            'disjoint_series_{}.obj'.format(str(n)))
 
 
+def trim_edges_by_list(conditional_mf_network, hpo_network, threshold):
+    # trim_edges analyzing the edges from a list with linear scans
+    ordered_edges = sorted(conditional_mf_network.edges.data('mf'),
+                           key=lambda edge: edge[2], reverse=True)
+    remove_list = set()
+    while len(ordered_edges) > 1:
+        v, w, mf = ordered_edges.pop(0)
+        for v, w in [(v, w), (w, v)]:
+            if v in remove_list:
+                continue
+            for neighbor in conditional_mf_network.adj[v]:
+                mf_edge = conditional_mf_network[v][neighbor]['mf']
+                if (v, neighbor, mf_edge) in ordered_edges:
+                    if neighbor in nx.descendants(hpo_network, w):
+                        remove_list.add(neighbor)
+                    if w in nx.descendants(hpo_network, neighbor) and \
+                            mf_edge / mf > threshold:
+                        remove_list.add(w)
+    trimmed = conditional_mf_network.copy()
+    trimmed.remove_nodes_from(remove_list)
+    return trimmed
+
+
 if __name__ == '__main__':
     unittest.main()